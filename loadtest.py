@@ -1,6 +1,692 @@
-# Include some comments, just to see what happens
+#! /usr/bin/env python
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
 
-def foo():
-    print("Hello from imported file.")
 
-print("Completed import.")
+"""Monjon benchmark suite.
+
+Runs a local echo server, and a proxy (a TCPListener and its
+TcpSessions, in a process of its own) in front of it, then drives
+load through the proxy from one or more load-generating processes.
+The same load is also run directly against the server, as a
+baseline, so monjon's overhead can be seen.
+
+Benchmarks:
+
+  throughput
+      Each session streams messages to the server and reads them
+      back, keeping a window of messages in flight.  Reports MB/s
+      echoed, and the proxy's CPU seconds per GB forwarded (counting
+      both directions).
+
+  latency
+      Each session sends a message and waits for its echo before
+      sending the next.  Reports p50 and p99 round-trip times, and,
+      for the proxy, the latency added over the direct baseline.
+
+  connect
+      Each session repeatedly connects, exchanges one byte, and
+      closes.  Reports connections per second, the p50 and p99 time
+      to the first echoed byte, and the proxy's CPU per connection.
+
+Every measurement is written as a JSON object on its own line
+(preceded by a "meta" record describing the run), so results can be
+collected and compared over time.
+
+Usage: loadtest.py [options]
+
+  -b, --benchmark NAME
+      Run this benchmark (throughput, latency or connect).  May be
+      repeated.  Default: all.
+
+  -d, --dispatcher NAME
+      Proxy using this Dispatcher (poller, asyncio or uvloop).  May
+      be repeated.  Default: poller.
+
+  -n, --sessions N[,N...]
+      Concurrent sessions to sweep.  Default: 1,10,100,1000,10000.
+
+  -s, --sizes N[,N...]
+      Message sizes in bytes.  Default: 64,65536.
+
+  -t, --duration SECONDS
+      Length of each measurement.  Default: 2.
+
+  -p, --processes N
+      Load-generating processes.  Default: up to 4, one per CPU.
+
+  -o, --output FILE
+      Append results to FILE, rather than writing to stdout.
+
+  -q, --quick
+      Short run: 1, 10 and 100 sessions for one second each.
+
+  --no-baseline
+      Skip the direct (unproxied) runs.
+
+  --table
+      Also print a summary table to stderr.
+
+  -h, --help
+      Print this message."""
+
+import getopt, json, multiprocessing, os, platform, resource, selectors
+import socket, subprocess, sys, threading, time
+import monjon.core, monjon.proxy
+
+
+BENCHMARKS = ["throughput", "latency", "connect"]
+DEFAULT_SESSIONS = [1, 10, 100, 1000, 10000]
+DEFAULT_SIZES = [64, 65536]
+
+# Messages kept in flight by each throughput session.
+WINDOW = 16
+
+# Most round-trip samples kept by each load process.
+MAX_SAMPLES = 200000
+
+# Listen backlog for the server and proxy.
+BACKLOG = 4096
+
+
+def raise_fd_limit():
+    """Raise this process's descriptor limit as far as allowed.
+
+    Returns the new limit."""
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1024 * 1024
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        soft = hard
+    except (ValueError, OSError):
+        pass
+    return soft
+
+
+def percentile(samples, fraction):
+    """Return the 'fraction' percentile of sorted 'samples'."""
+
+    if not samples:
+        return None
+    return samples[min(int(len(samples) * fraction), len(samples) - 1)]
+
+
+########################################################################
+# Server
+
+def run_server(conn):
+    """Echo server process.
+
+    Echoes everything it receives, and stops reading from a client
+    while its echo can't be sent.  Answers "bytes" requests on 'conn'
+    with the number of bytes received so far."""
+
+    raise_fd_limit()
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    server.listen(BACKLOG)
+    server.setblocking(False)
+    conn.send(server.getsockname()[1])
+
+    sel = selectors.DefaultSelector()
+    sel.register(server, selectors.EVENT_READ, None)
+    sel.register(conn, selectors.EVENT_READ, None)
+    buf = bytearray(262144)
+    received = 0
+
+    while True:
+        for key, mask in sel.select():
+            sock = key.fileobj
+            if sock is conn:
+                if conn.recv() == "stop":
+                    return
+                conn.send(received)
+
+            elif sock is server:
+                while True:
+                    try:
+                        s, a = server.accept()
+                    except (BlockingIOError, InterruptedError):
+                        break
+                    s.setblocking(False)
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    sel.register(s, selectors.EVENT_READ, bytearray())
+
+            else:
+                pending = key.data
+                if mask & selectors.EVENT_READ:
+                    try:
+                        n = sock.recv_into(buf)
+                    except (BlockingIOError, InterruptedError):
+                        n = -1
+                    except OSError:
+                        n = 0
+                    if n == 0:
+                        sel.unregister(sock)
+                        sock.close()
+                        continue
+                    if n > 0:
+                        received += n
+                        pending += buf[:n]
+
+                try:
+                    sent = sock.send(pending) if pending else 0
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except OSError:
+                    sel.unregister(sock)
+                    sock.close()
+                    continue
+                del pending[:sent]
+                sel.modify(sock, selectors.EVENT_WRITE if pending
+                           else selectors.EVENT_READ, pending)
+
+
+def run_proxy(conn, dispatcherName, port):
+    """Proxy process: forwards to 'port' until told to stop.
+
+    Answers "cpu" requests on 'conn' with its CPU time so far."""
+
+    raise_fd_limit()
+    dispatcher = make_dispatcher(dispatcherName)
+    listener = monjon.proxy.TCPListener(dispatcher, 0, "127.0.0.1", port,
+                                        backlog=BACKLOG)
+    dispatcher.register_source(listener)
+    conn.send(listener.localPort)
+
+    def control():
+        while True:
+            if conn.recv() == "stop":
+                os._exit(0)
+            conn.send(time.process_time())
+
+    t = threading.Thread(target=control)
+    t.daemon = True
+    t.start()
+    dispatcher.run()
+    return
+
+
+class Process:
+    """A server or proxy process, and its control pipe."""
+
+    def __init__(self, target, *args):
+        self._conn, child = multiprocessing.Pipe()
+        self._process = multiprocessing.Process(target=target,
+                                                args=(child,) + args)
+        self._process.daemon = True
+        self._process.start()
+        self._port = self._conn.recv()
+        return
+
+    def get_port(self):
+        return self._port
+
+    def request(self, message):
+        self._conn.send(message)
+        return self._conn.recv()
+
+    def stop(self):
+        self._conn.send("stop")
+        self._process.join(5)
+        if self._process.is_alive():
+            self._process.terminate()
+        return
+
+
+def make_dispatcher(name):
+    """Return a new Dispatcher of the kind called 'name'."""
+
+    if name == "poller":
+        return monjon.core.Dispatcher()
+    elif name == "asyncio":
+        return monjon.core.AsyncioDispatcher()
+    elif name == "uvloop":
+        return monjon.core.AsyncioDispatcher(uvloop=True)
+    raise ValueError("Unknown dispatcher %r" % name)
+
+
+def available_dispatchers():
+    """Return the names of the Dispatchers that can be used here."""
+
+    result = ["poller", "asyncio"]
+    try:
+        import uvloop
+        result.append("uvloop")
+    except ImportError:
+        pass
+    return result
+
+
+########################################################################
+# Load generators
+#
+# Each runs in a load process, for its share of the sessions, and
+# returns a dictionary of totals and samples.
+
+def open_sessions(port, n):
+    """Open 'n' connections to 'port', and return them."""
+
+    socks = []
+    for i in range(n):
+        s = socket.create_connection(("127.0.0.1", port))
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.setblocking(False)
+        socks.append(s)
+    return socks
+
+
+def throughput_load(sync, port, sessions, size, duration):
+    raise_fd_limit()
+    socks = open_sessions(port, sessions)
+    sel = selectors.DefaultSelector()
+    both = selectors.EVENT_READ | selectors.EVENT_WRITE
+    for s in socks:
+        # [bytes in flight, registered mask]
+        sel.register(s, both, [0, both])
+
+    msg = b"x" * size
+    limit = WINDOW * size
+    buf = bytearray(262144)
+    received = 0
+    sync()
+    start = time.time()
+    end = start + duration
+
+    while time.time() < end:
+        for key, mask in sel.select(0.1):
+            s, state = key.fileobj, key.data
+            if mask & selectors.EVENT_READ:
+                try:
+                    n = s.recv_into(buf)
+                except (BlockingIOError, InterruptedError):
+                    n = 0
+                received += n
+                state[0] -= n
+
+            if mask & selectors.EVENT_WRITE and state[0] < limit:
+                try:
+                    state[0] += s.send(msg)
+                except (BlockingIOError, InterruptedError):
+                    pass
+
+            # Only ask to write while the window has room.
+            want = both if state[0] < limit else selectors.EVENT_READ
+            if want != state[1]:
+                state[1] = want
+                sel.modify(s, want, state)
+
+    elapsed = time.time() - start
+    sync()
+    for s in socks:
+        s.close()
+    return {"bytes": received, "elapsed": elapsed}
+
+
+def latency_load(sync, port, sessions, size, duration):
+    raise_fd_limit()
+    socks = open_sessions(port, sessions)
+    sel = selectors.DefaultSelector()
+    msg = b"x" * size
+    samples = []
+    buf = bytearray(262144)
+    sync()
+    start = time.time()
+    end = start + duration
+
+    for s in socks:
+        # [bytes still expected, send time]
+        state = [size, time.perf_counter()]
+        s.sendall(msg)
+        sel.register(s, selectors.EVENT_READ, state)
+
+    count = 0
+    while time.time() < end:
+        for key, mask in sel.select(0.1):
+            s, state = key.fileobj, key.data
+            try:
+                n = s.recv_into(buf)
+            except (BlockingIOError, InterruptedError):
+                continue
+            state[0] -= n
+            if state[0] > 0:
+                continue
+
+            now = time.perf_counter()
+            count += 1
+            if len(samples) < MAX_SAMPLES:
+                samples.append(now - state[1])
+            state[0] = size
+            state[1] = now
+            s.setblocking(True)
+            s.sendall(msg)
+            s.setblocking(False)
+
+    elapsed = time.time() - start
+    sync()
+    for s in socks:
+        s.close()
+    return {"count": count, "samples": samples, "elapsed": elapsed}
+
+
+def connect_load(sync, port, sessions, size, duration):
+    raise_fd_limit()
+    sel = selectors.DefaultSelector()
+    samples = []
+    count = 0
+    failures = 0
+
+    def start_one():
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setblocking(False)
+        s.connect_ex(("127.0.0.1", port))
+        # [send time, or None until connected]
+        sel.register(s, selectors.EVENT_WRITE, [time.perf_counter(), False])
+        return
+
+    sync()
+    for i in range(sessions):
+        start_one()
+
+    start = time.time()
+    end = start + duration
+    while time.time() < end:
+        for key, mask in sel.select(0.1):
+            s, state = key.fileobj, key.data
+            if not state[1]:
+                # Connected (or failed): send a byte.
+                try:
+                    s.send(b"x")
+                    state[1] = True
+                    sel.modify(s, selectors.EVENT_READ, state)
+                    continue
+                except OSError:
+                    failures += 1
+            else:
+                try:
+                    if s.recv(1):
+                        count += 1
+                        if len(samples) < MAX_SAMPLES:
+                            samples.append(time.perf_counter() - state[0])
+                    else:
+                        failures += 1
+                except OSError:
+                    failures += 1
+
+            sel.unregister(s)
+            s.close()
+            start_one()
+
+    elapsed = time.time() - start
+    sync()
+    for key in list(sel.get_map().values()):
+        key.fileobj.close()
+    return {"count": count, "failures": failures, "samples": samples,
+            "elapsed": elapsed}
+
+
+LOADS = {"throughput": throughput_load,
+         "latency": latency_load,
+         "connect": connect_load}
+
+
+def load_process(barrier, results, benchmark, args):
+    """Entry point for a load-generating process."""
+
+    results.put(LOADS[benchmark](barrier.wait, *args))
+    return
+
+
+def run_load(processes, benchmark, port, sessions, size, duration,
+             proxy=None):
+    """Run a benchmark's load, split across 'processes', and combine.
+
+    The load processes open their sessions, then all start together,
+    and stop together before closing them, so the proxy's CPU time is
+    only measured for the load itself."""
+
+    shares = [sessions // processes + (1 if i < sessions % processes else 0)
+              for i in range(processes)]
+    shares = [n for n in shares if n]
+
+    barrier = multiprocessing.Barrier(len(shares) + 1)
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=load_process,
+                                       args=(barrier, results, benchmark,
+                                             (port, n, size, duration)))
+               for n in shares]
+    for w in workers:
+        w.daemon = True
+        w.start()
+
+    barrier.wait()
+    cpu = proxy.request("cpu") if proxy else None
+    barrier.wait()
+    if proxy:
+        cpu = proxy.request("cpu") - cpu
+
+    total = {"bytes": 0, "count": 0, "failures": 0, "samples": [],
+             "elapsed": 0.0, "cpu": cpu}
+    for w in workers:
+        result = results.get()
+        for key, value in result.items():
+            if key == "elapsed":
+                total[key] = max(total[key], value)
+            else:
+                total[key] += value
+    for w in workers:
+        w.join()
+    total["samples"].sort()
+    return total
+
+
+########################################################################
+# Benchmarks
+
+def measure(processes, benchmark, port, sessions, size, duration,
+            proxy=None):
+    """Run one measurement, and return its result record."""
+
+    load = run_load(processes, benchmark, port, sessions, size, duration,
+                    proxy)
+    cpu = load["cpu"]
+
+    elapsed = load["elapsed"]
+    samples = load["samples"]
+    record = {"elapsed_s": round(elapsed, 3)}
+
+    if benchmark == "throughput":
+        record["mb_per_s"] = round(load["bytes"] / elapsed / 1e6, 2)
+        if proxy and load["bytes"]:
+            # Forwarded in both directions.
+            record["cpu_s_per_gb"] = round(cpu / (2 * load["bytes"] / 1e9),
+                                           3)
+
+    elif benchmark == "latency":
+        record["messages_per_s"] = round(load["count"] / elapsed, 1)
+        record["p50_us"] = round(percentile(samples, 0.5) * 1e6, 1) \
+                           if samples else None
+        record["p99_us"] = round(percentile(samples, 0.99) * 1e6, 1) \
+                           if samples else None
+
+    elif benchmark == "connect":
+        record["conn_per_s"] = round(load["count"] / elapsed, 1)
+        record["failures"] = load["failures"]
+        record["p50_us"] = round(percentile(samples, 0.5) * 1e6, 1) \
+                           if samples else None
+        record["p99_us"] = round(percentile(samples, 0.99) * 1e6, 1) \
+                           if samples else None
+        if proxy and load["count"]:
+            record["cpu_us_per_conn"] = round(cpu / load["count"] * 1e6, 1)
+
+    if proxy:
+        record["proxy_cpu_s"] = round(cpu, 3)
+    return record
+
+
+def meta(options):
+    """Return a record describing this run."""
+
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {"type": "meta",
+            "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "commit": commit,
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "options": options}
+
+
+def main():
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "b:d:n:s:t:p:o:qh",
+                                   ["benchmark=", "dispatcher=",
+                                    "sessions=", "sizes=", "duration=",
+                                    "processes=", "output=", "quick",
+                                    "no-baseline", "table", "help"])
+    except getopt.GetoptError as e:
+        print(e)
+        print(__doc__)
+        sys.exit(1)
+
+    benchmarks = []
+    dispatchers = []
+    sessions = DEFAULT_SESSIONS
+    sizes = DEFAULT_SIZES
+    duration = 2.0
+    processes = min(4, os.cpu_count() or 1)
+    output = None
+    baseline = True
+    table = False
+    for opt, value in opts:
+        if opt in ("-b", "--benchmark"):
+            if value not in BENCHMARKS:
+                print("Unknown benchmark %r" % value)
+                sys.exit(1)
+            benchmarks.append(value)
+        elif opt in ("-d", "--dispatcher"):
+            if value not in available_dispatchers():
+                print("Dispatcher %r is not available" % value)
+                sys.exit(1)
+            dispatchers.append(value)
+        elif opt in ("-n", "--sessions"):
+            sessions = [int(n) for n in value.split(",")]
+        elif opt in ("-s", "--sizes"):
+            sizes = [int(n) for n in value.split(",")]
+        elif opt in ("-t", "--duration"):
+            duration = float(value)
+        elif opt in ("-p", "--processes"):
+            processes = int(value)
+        elif opt in ("-o", "--output"):
+            output = value
+        elif opt in ("-q", "--quick"):
+            sessions = [1, 10, 100]
+            duration = 1.0
+        elif opt == "--no-baseline":
+            baseline = False
+        elif opt == "--table":
+            table = True
+        elif opt in ("-h", "--help"):
+            print(__doc__)
+            sys.exit(0)
+
+    benchmarks = benchmarks or BENCHMARKS
+    dispatchers = dispatchers or ["poller"]
+    out = open(output, "a") if output else sys.stdout
+
+    def emit(record):
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        if table and record.get("type") == "result":
+            print("%-10s %-8s %6u %6u  %s" % (
+                record["benchmark"], record["proxy"], record["sessions"],
+                record["size"],
+                "  ".join("%s=%s" % (k, v) for k, v in record.items()
+                          if k.endswith(("_s", "_us", "_gb", "_conn",
+                                         "failures", "skipped")) and
+                          k != "elapsed_s")), file=sys.stderr)
+        return
+
+    emit(meta({"benchmarks": benchmarks, "dispatchers": dispatchers,
+               "sessions": sessions, "sizes": sizes, "duration": duration,
+               "processes": processes}))
+
+    # Each session needs a descriptor in the load process, two in the
+    # proxy, and one in the server.
+    limit = raise_fd_limit()
+
+    server = Process(run_server)
+    proxies = [(name, Process(run_proxy, name, server.get_port()))
+               for name in dispatchers]
+    targets = ([("direct", None)] if baseline else []) + proxies
+
+    try:
+        for benchmark in benchmarks:
+            for n in sessions:
+                for size in sizes if benchmark != "connect" else [1]:
+                    baselines = {}
+                    for name, proxy in targets:
+                        record = {"type": "result",
+                                  "benchmark": benchmark,
+                                  "proxy": name,
+                                  "sessions": n,
+                                  "size": size}
+                        if 2 * n + 64 > limit:
+                            record["skipped"] = "descriptor limit %u" % limit
+                            emit(record)
+                            continue
+
+                        port = proxy.get_port() if proxy \
+                               else server.get_port()
+                        record.update(measure(processes, benchmark,
+                                              port, n, size, duration,
+                                              proxy))
+
+                        # Overhead over the direct run.
+                        if not proxy:
+                            baselines = record
+                        elif benchmark == "latency" and baselines and \
+                             record["p50_us"] is not None:
+                            record["added_p50_us"] = round(
+                                record["p50_us"] - baselines["p50_us"], 1)
+                            record["added_p99_us"] = round(
+                                record["p99_us"] - baselines["p99_us"], 1)
+                        emit(record)
+    finally:
+        for name, proxy in proxies:
+            proxy.stop()
+        server.stop()
+        if output:
+            out.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
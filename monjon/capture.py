@@ -0,0 +1,667 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import queue, socket, struct, threading, time
+import monjon.core
+
+
+# pcapng block types.
+SECTION_HEADER = 0x0A0D0D0A
+INTERFACE_DESCRIPTION = 0x00000001
+SIMPLE_PACKET = 0x00000003
+ENHANCED_PACKET = 0x00000006
+
+# Interface description option: timestamp resolution.
+IF_TSRESOL = 9
+
+# Classic pcap file magic numbers (microsecond and nanosecond).
+PCAP_MAGIC = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+
+# Byte-order magic for the section header.
+BYTE_ORDER_MAGIC = 0x1A2B3C4D
+
+# Link types: Ethernet, and raw IPv4/IPv6 packets.
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+
+# TCP flags.
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_PSH = 0x08
+TCP_ACK = 0x10
+
+# Largest TCP payload in one synthesized packet.
+MAX_SEGMENT = 65000
+
+
+def _checksum(header):
+    """Return the Internet checksum of 'header'."""
+
+    total = sum(struct.unpack("!%uH" % (len(header) // 2), header))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+
+def _address(host):
+    """Return the packed address for 'host', and its family."""
+
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_pton(family, host), family
+        except (OSError, TypeError):
+            pass
+
+    # Unresolved name: use the unspecified address.
+    return bytes(4), socket.AF_INET
+
+
+class PcapngWriter:
+    """Streams dispatched traffic to a pcapng file.
+
+    Attach to a Dispatcher with add_capture().  Each client_recv and
+    server_recv event's payload is written as a TCP/IP packet between
+    its Connection's source and destination addresses, with sequence
+    numbers, a synthetic handshake when a connection is first seen,
+    and FINs when it's closed, so that Wireshark can follow the
+    streams.
+
+    Blocks are collected into batches, which are written to the file
+    by a background thread, so capturing doesn't block forwarding.  If
+    'dispatcher' is given, a batch is also handed over by a timer once
+    it's BATCH_AGE seconds old, so an idle capture's last packets
+    reach the file.
+
+    If writing fails (for example, because the disk is full), nothing
+    more is captured, and the error is raised by the next flush() or
+    by close()."""
+
+    # Hand a batch to the writer thread once it's this big (in bytes),
+    # or this old (in seconds).
+    BATCH_SIZE = 256 * 1024
+    BATCH_AGE = 1.0
+
+    def __init__(self, filename, dispatcher=None):
+        self._filename = filename
+        self._file = open(filename, "wb")
+        self._dispatcher = dispatcher
+
+        # Blocks not yet handed to the writer thread.
+        self._batch = []
+        self._batchBytes = 0
+        self._batchTime = time.time()
+
+        # Timer to hand over the batch once it's BATCH_AGE old.
+        self._timer = None
+
+        # Table of {connection: [client seq, server seq]}
+        self._flows = {}
+
+        # Number of packets written.
+        self._count = 0
+
+        # Batches for the writer thread; None tells it to stop.
+        self._queue = queue.Queue()
+
+        # Exception raised by the writer thread, if any.
+        self._error = None
+        self._thread = threading.Thread(target=self._write_batches,
+                                        name="pcapng writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+        # Section header: no options, unspecified section length.
+        self._append(struct.pack("<IIIHHqI", SECTION_HEADER, 28,
+                                 BYTE_ORDER_MAGIC, 1, 0, -1, 28))
+
+        # Single interface, microsecond timestamps (the default).
+        self._append(struct.pack("<IIHHII", INTERFACE_DESCRIPTION, 20,
+                                 LINKTYPE_RAW, 0, 0, 20))
+        return
+
+    def get_filename(self):
+        """Return the name of the capture file."""
+        return self._filename
+
+    def get_count(self):
+        """Return the number of packets captured."""
+        return self._count
+
+    def on_event(self, event):
+        """Capture an event (called by the Dispatcher)."""
+
+        eventType = event.get_type()
+        if eventType not in ("client_recv", "server_recv", "close") or \
+           self._error:
+            return
+
+        connection = event.get_connection()
+        if connection is None or not connection._src or not connection._dst:
+            return
+
+        t = event.get_time()
+        if eventType == "close":
+            flow = self._flows.pop(connection, None)
+            if flow:
+                self._segment(t, connection, flow, True, TCP_FIN | TCP_ACK)
+                self._segment(t, connection, flow, False, TCP_FIN | TCP_ACK)
+        else:
+            flow = self._flows.get(connection)
+            if flow is None:
+                flow = self._open(t, connection)
+
+            # server_recv events carry data from the client.
+            fromClient = eventType == "server_recv"
+            payload = event.get_packet().get_payload()
+            for i in range(0, len(payload), MAX_SEGMENT):
+                self._segment(t, connection, flow, fromClient,
+                              TCP_PSH | TCP_ACK,
+                              bytes(payload[i:i + MAX_SEGMENT]))
+
+        if self._batchBytes >= self.BATCH_SIZE or \
+           t - self._batchTime >= self.BATCH_AGE:
+            self._hand_off()
+        elif self._timer is None and self._dispatcher and self._batch:
+            self._timer = self._dispatcher.call_later(self.BATCH_AGE,
+                                                      self._on_timer)
+        return
+
+    def flush(self):
+        """Hand buffered blocks to the writer thread.
+
+        Raises the writer thread's exception, if it has failed."""
+
+        self._hand_off()
+        if self._error:
+            raise self._error
+        return
+
+    def close(self):
+        """Write any buffered blocks, and close the file.
+
+        Raises the writer thread's exception, if it has failed."""
+
+        if self._file:
+            self._hand_off()
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+            self._file = None
+        if self._error:
+            raise self._error
+        return
+
+    def _hand_off(self):
+        """Queue the current batch for the writer thread."""
+
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._batch:
+            if not self._error:
+                self._queue.put(self._batch)
+            self._batch = []
+            self._batchBytes = 0
+        self._batchTime = time.time()
+        return
+
+    def _on_timer(self):
+        self._timer = None
+        self._hand_off()
+        return
+
+    def _write_batches(self):
+        while True:
+            batch = self._queue.get()
+            if batch is None:
+                break
+
+            # After an error, discard batches until told to stop.
+            if self._error:
+                continue
+            try:
+                self._file.write(b"".join(batch))
+                self._file.flush()
+            except Exception as e:
+                self._error = e
+        return
+
+    def _append(self, block):
+        self._batch.append(block)
+        self._batchBytes += len(block)
+        return
+
+    def _open(self, t, connection):
+        """Start a flow for a connection, with a synthetic handshake."""
+
+        flow = [0, 0]
+        self._flows[connection] = flow
+        self._segment(t, connection, flow, True, TCP_SYN)
+        self._segment(t, connection, flow, False, TCP_SYN | TCP_ACK)
+        self._segment(t, connection, flow, True, TCP_ACK)
+        return flow
+
+    def _segment(self, t, connection, flow, fromClient, flags, payload=b""):
+        """Append a TCP/IP packet to the batch, and advance 'flow'."""
+
+        if fromClient:
+            (src, sport), (dst, dport) = connection._src[:2], connection._dst[:2]
+            seq, ack = flow
+        else:
+            (src, sport), (dst, dport) = connection._dst[:2], connection._src[:2]
+            ack, seq = flow
+
+        tcp = struct.pack("!HHIIBBHHH", sport, dport, seq, ack,
+                          5 << 4, flags, 65535, 0, 0) + payload
+
+        # SYN and FIN each consume a sequence number.
+        n = len(payload) + (1 if flags & (TCP_SYN | TCP_FIN) else 0)
+        flow[0 if fromClient else 1] = (seq + n) & 0xffffffff
+
+        src, srcFamily = _address(src)
+        dst, dstFamily = _address(dst)
+        if srcFamily == dstFamily == socket.AF_INET:
+            header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + len(tcp),
+                                 self._count & 0xffff, 0x4000, 64, 6, 0,
+                                 src, dst)
+            header = header[:10] + struct.pack("!H", _checksum(header)) + \
+                     header[12:]
+        else:
+            # Map any IPv4 address into IPv6.
+            if srcFamily == socket.AF_INET:
+                src = bytes(10) + b"\xff\xff" + src
+            if dstFamily == socket.AF_INET:
+                dst = bytes(10) + b"\xff\xff" + dst
+            header = struct.pack("!IHBB16s16s", 0x60000000, len(tcp),
+                                 6, 64, src, dst)
+
+        data = header + tcp
+        ts = int(t * 1000000)
+        pad = -len(data) % 4
+        total = 32 + len(data) + pad
+        self._append(struct.pack("<IIIIIII", ENHANCED_PACKET, total, 0,
+                                 ts >> 32, ts & 0xffffffff,
+                                 len(data), len(data)) +
+                     data + bytes(pad) + struct.pack("<I", total))
+        self._count += 1
+        return
+
+    def __repr__(self):
+        return "<pcapng capture: %s, %u packets>" % (self._filename,
+                                                     self._count)
+
+
+class CaptureReader:
+    """Reads packets from a pcapng or classic pcap file.
+
+    Iterating over a reader yields (timestamp, linktype, data) tuples.
+    The file is read a block at a time, so captures of any size can be
+    read in constant memory."""
+
+    def __init__(self, filename):
+        self._filename = filename
+        return
+
+    def __iter__(self):
+        with open(self._filename, "rb") as f:
+            head = f.read(4)
+            if len(head) < 4:
+                return
+
+            if struct.unpack("<I", head)[0] == SECTION_HEADER:
+                f.seek(0)
+                for packet in self._read_pcapng(f):
+                    yield packet
+            else:
+                for packet in self._read_pcap(f, head):
+                    yield packet
+        return
+
+    @staticmethod
+    def _read_pcap(f, magic):
+        for endian in ("<", ">"):
+            m = struct.unpack(endian + "I", magic)[0]
+            if m in (PCAP_MAGIC, PCAP_MAGIC_NS):
+                break
+        else:
+            raise ValueError("not a pcap or pcapng file")
+
+        scale = 1e-9 if m == PCAP_MAGIC_NS else 1e-6
+        header = f.read(20)
+        linktype = struct.unpack(endian + "HHiIII", header)[5]
+
+        while True:
+            record = f.read(16)
+            if len(record) < 16:
+                return
+            sec, frac, caplen, origlen = struct.unpack(endian + "IIII", record)
+            data = f.read(caplen)
+            if len(data) < caplen:
+                return
+            yield (sec + frac * scale, linktype, data)
+
+    @staticmethod
+    def _read_pcapng(f):
+        endian = "<"
+
+        # Table of (linktype, timestamp resolution) for each interface
+        # in the current section.
+        interfaces = []
+
+        while True:
+            head = f.read(8)
+            if len(head) < 8:
+                return
+
+            if struct.unpack("<I", head[:4])[0] == SECTION_HEADER:
+                # New section: byte order is given by its magic.
+                magic = f.read(4)
+                endian = "<" if struct.unpack("<I", magic)[0] == \
+                         BYTE_ORDER_MAGIC else ">"
+                length = struct.unpack(endian + "I", head[4:])[0]
+                f.seek(length - 12, 1)
+                interfaces = []
+                continue
+
+            blockType, length = struct.unpack(endian + "II", head)
+            body = f.read(length - 8)
+            if len(body) < length - 8:
+                return
+
+            if blockType == INTERFACE_DESCRIPTION:
+                linktype = struct.unpack(endian + "H", body[:2])[0]
+                interfaces.append((linktype,
+                                   CaptureReader._resolution(endian,
+                                                             body[8:-4])))
+
+            elif blockType == ENHANCED_PACKET:
+                iface, high, low, caplen = struct.unpack(endian + "IIII",
+                                                         body[:16])
+                linktype, resolution = interfaces[iface]
+                yield (((high << 32) | low) * resolution, linktype,
+                       body[20:20 + caplen])
+
+            elif blockType == SIMPLE_PACKET:
+                # No timestamp, and always interface zero.
+                linktype, resolution = interfaces[0]
+                yield (None, linktype, body[4:-4])
+        return
+
+    @staticmethod
+    def _resolution(endian, options):
+        """Return the timestamp resolution from interface options."""
+
+        i = 0
+        while i + 4 <= len(options):
+            code, length = struct.unpack(endian + "HH", options[i:i + 4])
+            if code == 0:
+                break
+            if code == IF_TSRESOL and length >= 1:
+                v = options[i + 4]
+                return 2.0 ** -(v & 0x7f) if v & 0x80 else 10.0 ** -v
+            i += 4 + length + (-length % 4)
+        return 1e-6
+
+
+def decode_tcp(linktype, data):
+    """Decode a captured TCP/IP packet.
+
+    Returns (src, sport, dst, dport, flags, payload), or None if the
+    packet isn't TCP over IPv4 or IPv6."""
+
+    if linktype == LINKTYPE_ETHERNET:
+        etherType = struct.unpack("!H", data[12:14])[0]
+        offset = 14
+        if etherType == 0x8100:
+            # 802.1Q VLAN tag.
+            etherType = struct.unpack("!H", data[16:18])[0]
+            offset = 18
+        if etherType not in (0x0800, 0x86DD):
+            return None
+        data = data[offset:]
+
+    elif linktype != LINKTYPE_RAW:
+        return None
+
+    if not data:
+        return None
+
+    version = data[0] >> 4
+    if version == 4:
+        ihl = (data[0] & 0x0f) * 4
+        total, proto = struct.unpack("!H", data[2:4])[0], data[9]
+        if proto != 6:
+            return None
+        src = socket.inet_ntop(socket.AF_INET, data[12:16])
+        dst = socket.inet_ntop(socket.AF_INET, data[16:20])
+        tcp = data[ihl:total]
+
+    elif version == 6:
+        length, nextHeader = struct.unpack("!HB", data[4:7])
+        if nextHeader != 6:
+            return None
+        src = socket.inet_ntop(socket.AF_INET6, data[8:24])
+        dst = socket.inet_ntop(socket.AF_INET6, data[24:40])
+        tcp = data[40:40 + length]
+
+    else:
+        return None
+
+    if len(tcp) < 20:
+        return None
+
+    sport, dport = struct.unpack("!HH", tcp[:4])
+    offset = (tcp[12] >> 4) * 4
+    return src, sport, dst, dport, tcp[13], tcp[offset:]
+
+
+class ReplaySession(monjon.core.EventSource):
+    """A TCP connection found in a replayed capture."""
+
+    def __init__(self, replay, connection):
+        super().__init__()
+        self._replay = replay
+        self._parent = replay
+        self._connection = connection
+        return
+
+    def get_connection(self):
+        """Return the Connection for this session."""
+        return self._connection
+
+    def __repr__(self):
+        return "<Replayed TCP Session: %s:%u -> %s:%u>" % (
+            self._connection._src + self._connection._dst)
+
+
+class CaptureReplay(monjon.core.EventSource):
+    """Replays a capture file through the Dispatcher.
+
+    Each TCP connection in the capture becomes a ReplaySession source,
+    and its packets become accept, server_recv, client_recv and close
+    events, which are dispatched (and can be broken on) just like live
+    traffic, but whose actions do nothing.  The side which sent the
+    SYN, or failing that the first packet, is taken to be the client.
+
+    By default, events are generated as fast as they can be
+    dispatched.  If 'realtime' is set, they're generated with the
+    recorded gaps between packets, divided by 'speed'.
+
+    Packets are taken from the capture in order: retransmitted or
+    reordered segments are not reassembled."""
+
+    # Most events to queue per call to generate().
+    BATCH = 1024
+
+    def __init__(self, dispatcher, filename, realtime=False, speed=1.0):
+        super().__init__()
+        self._dispatcher = dispatcher
+        self._filename = filename
+        self._realtime = realtime
+        self._speed = speed
+
+        self._packets = iter(CaptureReader(filename))
+
+        # Next decoded packet, if it's not due yet.
+        self._next = None
+
+        # Capture time of the first packet, and wall clock time then.
+        self._start = None
+        self._wallStart = None
+
+        # Table of {(src, sport, dst, dport): (session, fromClient)}
+        self._flows = {}
+
+        # Number of packets replayed.
+        self._count = 0
+
+        self._dispatcher.register_source(self)
+        self._dispatcher.add_generator(self)
+        return
+
+    def get_count(self):
+        """Return the number of packets replayed so far."""
+        return self._count
+
+    def get_sessions(self):
+        """Return the currently open replayed sessions."""
+        return list(set(session for session, fromClient
+                        in self._flows.values()))
+
+    def generate(self):
+        """Queue events for packets that are due."""
+
+        queued = 0
+        while queued < self.BATCH:
+            if self._next is None:
+                self._next = self._read()
+                if self._next is None:
+                    # End of capture.
+                    self._dispatcher.remove_generator(self)
+                    return None
+
+            t = self._next[0]
+            if self._realtime and t is not None:
+                if self._start is None:
+                    self._start = t
+                    self._wallStart = time.time()
+                due = self._wallStart + (t - self._start) / self._speed
+                delay = due - time.time()
+                if delay > 0:
+                    return delay
+
+            queued += self._replay(*self._next)
+            self._next = None
+        return 0
+
+    def _read(self):
+        """Return the next TCP packet from the capture, or None."""
+
+        for t, linktype, data in self._packets:
+            tcp = decode_tcp(linktype, data)
+            if tcp:
+                return (t,) + tcp
+        return None
+
+    def _replay(self, t, src, sport, dst, dport, flags, payload):
+        """Queue the events for one packet, returning how many."""
+
+        self._count += 1
+        key = (src, sport, dst, dport)
+        flow = self._flows.get(key)
+        queued = 0
+
+        if flow is None:
+            if flags & (TCP_FIN | TCP_RST):
+                # Tail of a connection we never saw.
+                return 0
+
+            # New connection: the SYN's sender (or the sender of the
+            # first packet we see) is the client.
+            if flags & TCP_SYN and flags & TCP_ACK:
+                src, sport, dst, dport = dst, dport, src, sport
+            connection = monjon.core.Connection()
+            connection._listener = self
+            connection._src = (src, sport)
+            connection._dst = (dst, dport)
+            connection._proto = "tcp"
+
+            session = ReplaySession(self, connection)
+            session.get_stats().set_parent(self._stats)
+            self._stats.add_accept()
+            self._dispatcher.register_source(session)
+            self._flows[(src, sport, dst, dport)] = (session, True)
+            self._flows[(dst, dport, src, sport)] = (session, False)
+            flow = self._flows[key]
+
+            e = monjon.core.AcceptEvent(self)
+            e._connection = connection
+            self._queue(e, t)
+            queued += 1
+
+        session, fromClient = flow
+        connection = session.get_connection()
+
+        if payload:
+            session.get_stats().add_recv(fromClient, len(payload))
+            if fromClient:
+                e = monjon.core.ServerReceiveEvent(session)
+            else:
+                e = monjon.core.ClientReceiveEvent(session)
+            e.set_packet(monjon.core.Packet(payload, connection))
+            self._queue(e, t)
+            queued += 1
+
+        if flags & (TCP_FIN | TCP_RST):
+            # Close on the first FIN or RST, and forget the flow.
+            del self._flows[(connection._src + connection._dst)]
+            del self._flows[(connection._dst + connection._src)]
+            e = monjon.core.CloseEvent(session)
+            e._connection = connection
+            e.set_action(self._close)
+            self._queue(e, t)
+            queued += 1
+
+        return queued
+
+    def _queue(self, event, t):
+        if event.get_action() is None:
+            event.set_action(self._nothing)
+        if t is not None:
+            event.set_time(t)
+        self._dispatcher.queue_event(event)
+        return
+
+    def _nothing(self, event):
+        return
+
+    def _close(self, event):
+        event.get_source().get_stats().add_close()
+        self._dispatcher.deregister_source(event.get_source())
+        return
+
+    def __repr__(self):
+        return "<Capture Replay: %s, %u packets>" % (self._filename,
+                                                     self._count)
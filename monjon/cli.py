@@ -20,7 +20,11 @@
 #HEADER_END
 ########################################################################
 
-import os, readline, select, sys, time, traceback, types
+import os, re, readline, select, sys, time, traceback, types
+import monjon.capture
+import monjon.control
+import monjon.decode
+import monjon.profiler
 import monjon.proxy
 import monjon.core
 
@@ -90,6 +94,26 @@ server_recv = EventType("server_recv",
                         "Event triggered when a packet is received from "
                         "the listener of a connection.")
 close = EventType("close", "Event triggered when a connection is closed.")
+connect = EventType("connect",
+                    "Event triggered when a connection to the server "
+                    "is established.")
+connect_failed = EventType("connect_failed",
+                           "Event triggered when a connection to the "
+                           "server cannot be established.")
+
+# Message event constants, for decoded streams (see decode()).
+http_request = EventType("http_request",
+                         "Event triggered when an HTTP request has been "
+                         "received from the client.")
+http_response = EventType("http_response",
+                          "Event triggered when an HTTP response has "
+                          "been received from the server.")
+frame = EventType("frame",
+                  "Event triggered when a length-prefixed message has "
+                  "been received.")
+line = EventType("line",
+                 "Event triggered when a line of text has been "
+                 "received.")
 
 
 ########################################################################
@@ -97,18 +121,27 @@ close = EventType("close", "Event triggered when a connection is closed.")
 class CLI:
     """Monjon command-line user interface."""
 
-    def __init__(self):
+    def __init__(self, dispatcher=None):
 
         # Functions
         self.functions = {}
+        self.functions["attach"] = self.attach
         self.functions["breakpoint"] = self.breakpoint
+        self.functions["capture"] = self.capture
+        self.functions["decode"] = self.decode
         self.functions["exit"] = self.exit
         self.functions["help"] = self.help
         self.functions["history"] = self.history
         self.functions["listen"] = self.listen
         self.functions["load"] = self.load
+        self.functions["profile"] = self.profile
+        self.functions["record"] = self.record
+        self.functions["replay"] = self.replay
         self.functions["run"] = self.run
+        self.functions["shape"] = self.shape
+        self.functions["stats"] = self.stats
         self.functions["step"] = self.step
+        self.functions["watchpoint"] = self.watchpoint
 
         # Global namespace
         #
@@ -125,6 +158,12 @@ class CLI:
         self.globals["client_recv"] = client_recv
         self.globals["server_recv"] = server_recv
         self.globals["close"] = close
+        self.globals["connect"] = connect
+        self.globals["connect_failed"] = connect_failed
+        self.globals["http_request"] = http_request
+        self.globals["http_response"] = http_response
+        self.globals["frame"] = frame
+        self.globals["line"] = line
         # Protocols
         self.globals["tcp"] = tcp
         self.globals["udp"] = udp
@@ -136,15 +175,24 @@ class CLI:
         self.histfile = os.path.join(self.confdir, "history")
 
         # Debugger core
-        self.dispatcher = monjon.core.Dispatcher()
+        self.dispatcher = dispatcher if dispatcher else monjon.core.Dispatcher()
         self.dispatcher.set_listener(self)
 
+        # Active pcapng capture, if any.
+        self._capture = None
+
+        # Active profiler, if any.
+        self._profiler = None
+
         # Install table of event sources in namespace.
         self.globals["s"] = self.dispatcher.get_sources()
 
         # Install table of breakpoints in namespace.
         self.globals["b"] = self.dispatcher.get_breakpoints()
 
+        # Install table of watchpoints in namespace.
+        self.globals["w"] = self.dispatcher.get_watchpoints()
+
         return
 
     def main(self):
@@ -231,6 +279,11 @@ class CLI:
         """Callback from core when breakpoint is hit."""
 
         print("b[%u]: %s" % (breakpoint.get_name(), event.get_description()))
+        event.retain()
+        if breakpoint.get_error():
+            print("    condition raised %r" % breakpoint.get_error())
+        for pattern, end in breakpoint.get_found():
+            print("    found %r, ending at stream offset %u" % (pattern, end))
         self.globals["e"] = event
         self.dispatcher.stop()
         return
@@ -242,6 +295,8 @@ class CLI:
             cond = "always"
         else:
             cond = "if %s" % breakpoint.get_condition()
+        if breakpoint.get_match():
+            cond = "matching %r, %s" % (breakpoint.get_match(), cond)
 
         src = breakpoint.get_source()
         if src:
@@ -264,7 +319,13 @@ class CLI:
     def on_watch(self, watchpoint, value, event):
         """Callback from core when watchpoint is hit."""
 
-        print("Callback for watchpoint")
+        print("w[%u]: %s = %r" % (watchpoint.get_name(),
+                                  watchpoint.get_expression(), value))
+        print("    after %s" % event.get_description())
+        event.retain()
+        self.globals["e"] = event
+        self.dispatcher.stop()
+        return
 
 
     def error(self, message):
@@ -276,9 +337,28 @@ class CLI:
     ####################################################################
     # Commands
 
-    def breakpoint(self, *args):
+    def attach(self, path):
+        """CLI command to attach to a headless monjon-proxy."""
+
+        try:
+            client = monjon.control.ControlClient(path)
+        except OSError as e:
+            self.error("Cannot attach to %s: %s" % (path, e))
+            return None
+
+        print("Attached to %s." % path)
+        return client
+
+    def breakpoint(self, *args, match=None):
         """CLI command to set a breakpoint."""
 
+        # With patterns to match, the condition is optional.
+        if match is not None and args and isinstance(args[-1], EventType):
+            args = args + ("True",)
+
+        if match is not None and not isinstance(match, (list, tuple)):
+            match = [match]
+
         if len(args) < 2:
             self.error("breakpoint() missing required arguments")
             return
@@ -295,7 +375,8 @@ class CLI:
                            "conditional expression.")
                 return
     
-            self.dispatcher.set_breakpoint(None, args[0], args[1])
+            source = None
+            event, condition = args
 
         elif len(args) == 3:
             # Specific source form: breakpoint(source, event, condition)
@@ -309,26 +390,80 @@ class CLI:
                            "conditional expression.")
                 return
     
-            if isinstance(args[0], monjon.proxy.Listener):
-                # Listener
-                # FIXME: should this be in monjon.core, not monjon.proxy?
-                self.dispatcher.set_breakpoint(args[0], args[1], args[2])
-
-            elif isinstance(args[0], monjon.core.EventSource):
-                # Session of some sort
-                self.dispatcher.set_breakpoint(args[0], args[1], args[2])
-
-            else:
+            # Listener, or session of some sort.
+            # FIXME: should Listener be in monjon.core, not monjon.proxy?
+            if not isinstance(args[0], monjon.core.EventSource):
                 self.error("Unknown event source (first parameter)")
                 return
+
+            source, event, condition = args
         else:
             self.error("breakpoint() accepts only 2 or 3 parameters.")
-            
+            return
+
+        try:
+            self.dispatcher.set_breakpoint(source, event, condition, match)
+        except SyntaxError as e:
+            self.error("Invalid condition: %s" % e)
+        except (TypeError, ValueError, re.error) as e:
+            self.error("Invalid match: %s" % e)
+        return
+
+    def capture(self, filename=None):
+        """CLI command to start or stop capturing to a pcapng file."""
+
+        # Stop any current capture.
+        if self._capture:
+            self.dispatcher.remove_capture(self._capture)
+            try:
+                self._capture.close()
+                print("Captured %u packets to %s." % (
+                    self._capture.get_count(), self._capture.get_filename()))
+            except OSError as e:
+                self.error("Capture to %s failed: %s" %
+                           (self._capture.get_filename(), e))
+            self._capture = None
+
+        if filename:
+            self._capture = monjon.capture.PcapngWriter(filename,
+                                                        self.dispatcher)
+            self.dispatcher.add_capture(self._capture)
+            print("Capturing to %s." % filename)
+        return
+
+
+    def decode(self, source, decoder=None, *args, **kwargs):
+        """CLI command to decode a listener's or session's streams."""
+
+        if not hasattr(source, "set_decoder"):
+            self.error("Source s[%s] has no stream to decode." %
+                       source.get_name())
+            return
+
+        if isinstance(decoder, str):
+            try:
+                decoder = monjon.decode.get_decoder(decoder, *args, **kwargs)
+            except KeyError:
+                self.error("Unknown decoder '%s': expecting one of %s." %
+                           (decoder, ", ".join(sorted(
+                               monjon.decode.DECODERS.keys()))))
+                return
+
+        source.set_decoder(decoder)
+        if decoder is None:
+            print("s[%u] not decoding." % source.get_name())
+        else:
+            print("s[%u] decoding %s." % (
+                source.get_name(),
+                ", ".join(sorted(set(decoder.EVENTS.values())))))
         return
 
     def exit(self):
         """CLI command to exit the debugger."""
 
+        if self._capture:
+            self.capture()
+
         if os.path.isdir(self.confdir):
             readline.write_history_file(self.histfile)
 
@@ -396,13 +531,15 @@ class CLI:
                localPort=0,
                remoteHost=None,
                remotePort=0,
-               protocol="tcp"):
+               protocol="tcp",
+               backlog=128):
         """CLI command to create a proxy session."""
 
         # Create the listener
         if protocol.lower() == "tcp":
             l = monjon.proxy.TCPListener(self.dispatcher,
-                                         localPort, remoteHost, remotePort)
+                                         localPort, remoteHost, remotePort,
+                                         backlog)
         elif protocol.lower() == "udp":
             l = monjon.proxy.UDPListener(self.dispatcher,
                                          localPort, remoteHost, remotePort)
@@ -419,6 +556,91 @@ class CLI:
         return
 
 
+    def profile(self, on=True, sample=0):
+        """CLI command to start or stop profiling the dispatcher."""
+
+        if on:
+            if self._profiler:
+                self._profiler.stop()
+            self._profiler = monjon.profiler.Profiler(self.dispatcher,
+                                                      sample)
+            self._profiler.start()
+            if sample:
+                print("Profiling, sampling every %g ms." % (sample * 1000))
+            else:
+                print("Profiling.")
+            return
+
+        if not self._profiler:
+            self.error("Not profiling.")
+            return
+
+        self._profiler.stop()
+        report = self._profiler.get_report()
+        self._profiler = None
+
+        print("Profiled %.1f seconds." % report["elapsed"])
+        print("%-16s %9s %10s %9s %9s %9s %9s" % (
+            "", "count", "total s", "mean us", "p50 us", "p99 us",
+            "max us"))
+
+        def line(name, values):
+            print("%-16s %9u %10.3f %9.1f %9.1f %9.1f %9.1f" % (
+                name, values["count"], values["total"],
+                values["mean"] * 1e6, values["p50"] * 1e6,
+                values["p99"] * 1e6, values["max"] * 1e6))
+            return
+
+        for phase in monjon.profiler.Profiler.PHASES:
+            line(phase, report["phases"][phase])
+        for eventType in sorted(report["events"].keys()):
+            line(eventType, report["events"][eventType])
+
+        samples = report["samples"]
+        if samples["total"]:
+            print("\n%u samples:" % samples["total"])
+            for phase, n in sorted(samples["phases"].items(),
+                                   key=lambda x: -x[1]):
+                print("    %5.1f%%  %s" % (n * 100.0 / samples["total"],
+                                           phase))
+            print()
+            for name, n in samples["functions"]:
+                print("    %5.1f%%  %s" % (n * 100.0 / samples["total"],
+                                           name))
+        return
+
+
+    def record(self, on=True, memory=64, perConnection=8, disk=1024):
+        """CLI command to start or stop recording traffic history."""
+
+        if not on:
+            self.dispatcher.set_history(None)
+            print("Recording stopped.")
+            return
+
+        mb = 1024 * 1024
+        history = monjon.core.TrafficHistory(memory * mb,
+                                             perConnection * mb,
+                                             disk * mb)
+        self.dispatcher.set_history(history)
+        print("Recording: %u MB in memory (%u MB per connection), "
+              "%u MB on disk." % (memory, perConnection, disk))
+        return
+
+
+    def replay(self, filename, realtime=False, speed=1.0):
+        """CLI command to replay a capture file as events."""
+
+        if not os.path.isfile(filename):
+            self.error("Cannot replay '%s': not a file." % filename)
+            return
+
+        r = monjon.capture.CaptureReplay(self.dispatcher, filename,
+                                         realtime, speed)
+        print("s[%u] => %s" % (r.get_name(), r))
+        return
+
+
     def run(self):
         """CLI command to run until breakpoint or interrupt."""
 
@@ -430,14 +652,111 @@ class CLI:
         return self.dispatcher.run()
 
 
+    def shape(self, source, delay=0.0, jitter=0.0, rate=None, loss=0.0,
+              direction=None):
+        """CLI command to apply network conditions to a source."""
+
+        if not hasattr(source, "set_shaping"):
+            self.error("Cannot shape the traffic of s[%s]." %
+                       source.get_name())
+            return
+
+        if direction not in (None, "client", "server"):
+            self.error("Direction must be 'client', 'server' or None.")
+            return
+
+        if not (delay or jitter or rate or loss):
+            source.set_shaping(None, direction)
+            print("s[%u] not shaped." % source.get_name())
+            return
+
+        shaping = monjon.proxy.Shaping(delay, jitter, rate, loss)
+        source.set_shaping(shaping, direction)
+        print("s[%u] => %s" % (source.get_name(), shaping))
+        return
+
+
+    def stats(self, source=None):
+        """CLI command to show traffic and dispatch statistics."""
+
+        if source is not None:
+            values = self.dispatcher.get_stats(source)
+            print("s[%u] %s" % (source.get_name(), source))
+            for key in sorted(values.keys()):
+                print("    %-20s %s" % (key, values[key]))
+            return
+
+        print("%-6s %12s %12s %7s %7s %6s %9s %8s %8s" % (
+            "source", "from client", "from server", "accepts", "closes",
+            "queued", "events", "ev/s", "us/ev"))
+
+        def line(name, values):
+            events = values["events"]
+            print("%-6s %12u %12u %7u %7u %6u %9u %8.1f %8.1f" % (
+                name, values["server_recv_bytes"],
+                values["client_recv_bytes"], values["accepts"],
+                values["closes"], values["queued"], events,
+                values["events_per_s"],
+                values["dispatch_time"] / events * 1e6 if events else 0))
+            return
+
+        sources = self.dispatcher.get_sources()
+        for name in sorted(sources.keys()):
+            line("s[%u]" % name, self.dispatcher.get_stats(sources[name]))
+        line("total", self.dispatcher.get_stats())
+        return
+
     def step(self):
         """CLI command to execute until the next event."""
         return self.dispatcher.step()
         
 
+    def watchpoint(self, source, expression):
+        """CLI command to set a watchpoint."""
+
+        if not isinstance(source, monjon.core.EventSource):
+            self.error("Unknown event source (first parameter)")
+            return
+
+        if not isinstance(expression, type("")):
+            self.error("Second parameter must be string-form expression.")
+            return
+
+        try:
+            wp = self.dispatcher.set_watchpoint(source, expression)
+        except SyntaxError as e:
+            self.error("Invalid expression: %s" % e)
+            return
+
+        print("w[%u] => %s on s[%u], now %r" % (wp.get_name(),
+                                               expression,
+                                               source.get_name(),
+                                               wp.get_value()))
+        return
+
+
     ####################################################################
     # Help
 
+    attach.__help__ = '''Attach to a headless monjon-proxy.
+
+    attach("/path/to/control.sock")
+
+    Connect to a monjon-proxy started with "--control", which forwards
+    traffic continuously, whether or not anyone is attached.  Returns
+    a client object whose methods send requests to the proxy.  For
+    example
+
+    (monjon) p = attach("/tmp/monjon.sock")
+    Attached to /tmp/monjon.sock.
+    (monjon) p.listen(1234, "localhost", 5678)
+    (monjon) p.breakpoint(None, server_recv, "payload[:3] == b'GET'")
+    (monjon) p.get_notifications(10)
+    (monjon) p.step()
+    (monjon) p.resume()
+
+    See help(p) for its commands.'''
+
     breakpoint.__help__ = '''Break execution.
 
     breakpoint(source, event[, condition])
@@ -446,19 +765,53 @@ class CLI:
     Break the flow of execution when the specified event occurs for
     the specified source, and condition evaluates true.
 
-    Supported event names are: all, none, accept, server_recv,
-    client_recv, close.
+    Supported event names are: all, none, accept, connect,
+    connect_failed, server_recv, client_recv, close.
 
     Condition is a Python conditional expression.  If it evaluates to
     True, execution will break.  Otherwise, execution will continue.
-    The default condition is "True".'''
+    The default condition is "True".
+
+    The condition is compiled when the breakpoint is set, and can
+    refer to "event", "payload" (the packet's bytes, if any), "source"
+    and "connection".  The payload is a memoryview: compare slices of
+    it with bytes, or use bytes(payload) for a copy.  For example
+
+    (monjon) breakpoint(s[1], server_recv, "payload[:3] == b'GET'")
+
+    breakpoint(source, event, match=[pattern, ...][, condition])
+
+    Break when one of the patterns is found in the data received,
+    even if it's split across packets.  Each pattern is either a
+    bytes literal, or a regular expression (a string, or a compiled
+    bytes pattern).  Each session and direction is scanned as a
+    stream, with no data scanned twice, except that a regular
+    expression is searched for across the last 1 KB of the previous
+    packet as well.  The condition, if any, is only evaluated once a
+    pattern is found, and can refer to "found", a list of the
+    (pattern, stream offset) pairs found.  For example
+
+    (monjon) breakpoint(s[1], server_recv,
+                        match=[b"DELETE ", r"Cookie: session=\\w+"])
+    '''
 
     commands = Help('''List of built-in functions (commands).
 
-    breakpoint([source, ]event[, condition])
+    attach(path)
+        Attach to a headless monjon-proxy's control socket.
+
+    breakpoint([source, ]event[, condition][, match=patterns])
         Break flow of execution for event matching condition from
-        source.
+        source, optionally once one of the patterns is found in the
+        stream of data.
             
+    capture([filename])
+        Start capturing traffic to a pcapng file, or stop capturing.
+
+    decode(source, decoder)
+        Decode the TCP streams of a listener's sessions, or of one
+        session, into messages that can be broken on.
+
     exit()
         Exit monjon.
 
@@ -469,13 +822,83 @@ class CLI:
         Listen for connections on "localPort", and forward to
         "remoteHost" on "remotePort".
             
+    profile([on[, sample]])
+        Start profiling where the dispatcher spends its time, or stop
+        and show the results.
+
+    record([on[, memory[, perConnection[, disk]]]])
+        Start (or stop) recording traffic, so earlier packets of a
+        session can be examined.
+
+    replay(filename[, realtime[, speed]])
+        Replay the TCP traffic in a pcap or pcapng file as events.
+
     run()
         Begin processing events continuously, stopping only for
         breakpoints or if interrupted by the user.
 
+    shape(source[, delay[, jitter[, rate[, loss[, direction]]]]])
+        Delay, pace or lose the data forwarded by a TCP listener's
+        sessions, or one session.
+
+    stats([source])
+        Show traffic and dispatch statistics for all sources, or in
+        detail for one.
+
     step()
         Process the next queued event, and then return to the prompt.
-        If no events are queued, wait until one occurs.''')
+        If no events are queued, wait until one occurs.
+
+    watchpoint(source, expression)
+        Break flow of execution when the value of expression, over
+        the source's state, changes.''')
+
+    capture.__help__ = '''Capture traffic to a pcapng file.
+
+    capture("/path/to/file.pcapng")
+    capture()
+
+    Write all traffic forwarded from now on to a pcapng file, which
+    can be opened with Wireshark or tcpdump.  TCP/IP headers are
+    synthesized from each connection's addresses.  Calling capture()
+    with no file name stops capturing and closes the file.
+
+    While capturing, every event is queued and dispatched, so kernel
+    relay mode is not used.'''
+
+    decode.__help__ = '''Decode streams into messages.
+
+    decode(source, "http")
+    decode(source, "line"[, delimiter])
+    decode(source, "length"[, size[, byteorder[, offset[, adjust]]]])
+    decode(source, decoder)
+    decode(source, None)
+
+    Frame the data of a TCP listener's sessions (or of one session)
+    into protocol messages, which become events that breakpoints can
+    target: http_request and http_response for "http", line for
+    "line", and frame for "length", where each message starts with a
+    "size"-byte length field.  Conditions can refer to the decoded
+    "message", whose fields are only parsed if asked for.  For
+    example
+
+    (monjon) decode(s[0], "http")
+    (monjon) breakpoint(http_request, "message.get_method() == 'POST'")
+    (monjon) breakpoint(frame, "message.get_length() > 65536")
+
+    Messages are framed as data arrives, looking only at new data.
+    The message's event comes before that of the data completing it,
+    so a break happens before the whole message has been forwarded.
+
+    A message that can't be framed (such as an HTTP body with a bad
+    chunk size) has a description of the problem in
+    message.get_error(), and the rest of that stream isn't decoded:
+
+    (monjon) breakpoint(http_response, "message.get_error()")
+
+    For other protocols, "decoder" can be an instance of a subclass
+    of monjon.decode.Decoder, or the name it was given with
+    monjon.decode.register_decoder().'''
 
     exit.__help__ = '''Exit the debugger.
 
@@ -505,11 +928,17 @@ class CLI:
 
     listen.__help__ = '''Listen for connections and forward to destination.
 
-    listen(localPort, remoteHost[, remotePort[, protocol]])
+    listen(localPort, remoteHost[, remotePort[, protocol[, backlog]]])
     
     Listen for connections on "localPort", and forward to
     "remoteHost" on "remotePort".  "protocol" defaults to
-    "tcp", but can be overridden by specifying "udp".
+    "tcp", but can be overridden by specifying "udp".  For TCP,
+    "backlog" sets the length of the queue of connections waiting to
+    be accepted (default 128).
+
+    For UDP, each client address is a session, with its own socket
+    for talking to the server.  Sessions idle for a minute are
+    closed: use set_idle_timeout() on the listener to change this.
 
     The result is an active Listener, which is added to the
     global sources dictionary: "s".  For example
@@ -520,6 +949,14 @@ class CLI:
     []
     (monjon)
 
+    To examine a TCP session's data as a stream of bytes, rather than
+    packet by packet, keep streams for the listener's sessions.  Each
+    session's "client_stream" (data for the client) and
+    "server_stream" (data for the server) can then be sliced by
+    offset, without copying.  For example
+
+    (monjon) s[0].set_streams(True, retention=1024 * 1024)
+    (monjon) bytes(s[1].client_stream[1000:2000])
     '''
 
     load.__help__ = '''Load a Python file.
@@ -537,6 +974,66 @@ class CLI:
     Any commands in the file outside of function or class definitions
     are executed during the loading process.'''
     
+    profile.__help__ = '''Profile the dispatcher.
+
+    profile()
+    profile(on=False)
+    profile(sample=0.001)
+
+    Time each poll, and each event dispatched, until profile(False)
+    is used, and then show the results.  Time is divided between
+    waiting for sockets ("poll"), sources reading and forwarding
+    ready sockets ("io"), checking breakpoints ("match"), writing a
+    capture ("capture"), and performing the event's action, such as
+    forwarding a packet ("action").  The total time to dispatch each
+    type of event is shown as well.  For example
+
+    (monjon) profile()
+    Profiling.
+    (monjon) run()
+    ^C
+    (monjon) profile(False)
+
+    If "sample" is given, the dispatcher's stack is also sampled
+    every "sample" seconds, to show which functions take the time.
+
+    While not profiling, there is no measurable cost.'''
+
+    record.__help__ = '''Record traffic history.
+
+    record()
+    record(on=False)
+    record(memory=64, perConnection=8, disk=1024)
+
+    Keep a copy of the traffic for each connection, so that earlier
+    packets can be examined after they've been forwarded.  For example
+
+    (monjon) record()
+    (monjon) h = s[1].get_connection().get_history()
+    (monjon) print(h[0].get_packet().dump())
+
+    The most recent traffic is kept in memory: at most "memory" MB in
+    total, and "perConnection" MB for each connection.  Older traffic
+    is moved to a temporary file of up to "disk" MB, after which the
+    oldest traffic is discarded.
+
+    Recording stops kernel relay mode from being used.'''
+
+    replay.__help__ = '''Replay a capture file.
+
+    replay("/path/to/file.pcapng")
+    replay("/path/to/file.pcapng", realtime=True, speed=2.0)
+
+    Read TCP traffic from a pcapng or pcap file (such as one written
+    by capture()), and generate the same events as live traffic would:
+    each connection becomes a new source in "s", and breakpoints and
+    conditions apply as usual.  Replayed events are not forwarded
+    anywhere.
+
+    The file is read incrementally, as events are needed.  By default
+    events are generated as fast as they're processed; if "realtime"
+    is set, they follow the recorded timing, sped up by "speed".'''
+
     run.__help__ = '''Begin processing events continuously, stopping
     only for breakpoints or if interrupted by the user.
 
@@ -546,8 +1043,72 @@ class CLI:
     and continuing, so use run() to restart execution following a
     breakpoint as well.'''
 
+    shape.__help__ = '''Apply network conditions to traffic.
+
+    shape(source, delay=0.1)
+    shape(source, delay=0.05, jitter=0.01, rate=128 * 1024, loss=0.01)
+    shape(source, rate=1000000, direction="client")
+    shape(source)
+
+    Hold back the data forwarded by a TCP listener's sessions (or by
+    one session) to reproduce a slow or distant network: "delay" and
+    "jitter" are in seconds, "rate" caps the bandwidth in bytes per
+    second, and "loss" is the probability that a chunk of data is
+    lost, and so delayed by a 0.2 second retransmission.  Data is
+    still delivered in order.  "direction" limits shaping to the data
+    sent to the "client" or to the "server".  With no conditions,
+    shaping is removed.
+
+    Data is held using timers, so the debugger carries on handling
+    other sessions meanwhile, and reading from a session is paused
+    while too much of its data is held.'''
+
+    stats.__help__ = '''Show traffic and dispatch statistics.
+
+    stats()
+    stats(source)
+
+    With no arguments, shows a line for each source, and the totals:
+    bytes received from clients and from servers, connections
+    accepted and closed, events queued and dispatched, the rate of
+    dispatched events since stats() was last used, and the average
+    time taken to dispatch each one.  A listener's figures include
+    its sessions, even once they're closed.
+
+    Given a source, shows all of its counters.  For example
+
+    (monjon) stats(s[0])
+    '''
+
     step.__help__ = '''Execute until the next event only.'''
 
+    watchpoint.__help__ = '''Break when a value changes.
+
+    watchpoint(source, expression)
+
+    Break the flow of execution whenever the value of expression
+    changes.  The expression is evaluated over the state of the
+    source, and can refer to
+
+      sessions             number of open sessions (for a listener)
+      state                the source's state
+      accepts, closes      connections accepted and closed
+      bytes, packets       received in both directions
+      client_recv_bytes    received from the server, for the client
+      server_recv_bytes    received from the client, for the server
+      client_recv_packets, server_recv_packets
+      payload              the last payload received, as bytes
+      source, event        the source, and the triggering event
+
+    A listener's figures include its sessions.  The expression is
+    only evaluated after events that could change it: one using just
+    "sessions", for instance, after accept and close events, so other
+    traffic is still forwarded at full speed.  For example
+
+    (monjon) watchpoint(s[0], "sessions > 10")
+    (monjon) watchpoint(s[2], "payload[:4]")
+    '''
+
     variables = Help("""
 
     'b' is a dictionary containing active breakpoints.  When a new
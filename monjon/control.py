@@ -0,0 +1,599 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import errno, json, os, re, select, socket, stat, time
+import monjon.core
+import monjon.profiler
+import monjon.proxy
+from   monjon.workers import Channel
+
+
+class ControlError(Exception):
+    """Error reported by a ControlServer in reply to a request."""
+    pass
+
+
+class ControlServer(monjon.core.Listener, monjon.core.EventSource):
+    """Runs a Dispatcher headless, controlled through a Unix socket.
+
+    Traffic is forwarded continuously by serve(), whether or not any
+    client is attached.  Clients connect to 'path' and exchange JSON
+    messages, one per line (see ControlClient).  Each request gets a
+    "result" or "error" reply; break notifications are sent to every
+    client as they happen.
+
+    A breakpoint set with 'stop' pauses the data plane when it is hit,
+    as the CLI does: while paused, only the control socket is polled,
+    and clients can step, inspect and continue.  Otherwise, hits are
+    just reported, and traffic keeps flowing."""
+
+    # Seconds a step waits for an event before giving up.
+    STEP_TIMEOUT = 1.0
+
+    # Most bytes of replies and notifications to hold for a client
+    # that isn't reading them, before it's disconnected.
+    CLIENT_LIMIT = 1024 * 1024
+
+    def __init__(self, dispatcher, path):
+        monjon.core.EventSource.__init__(self)
+        self._dispatcher = dispatcher
+        self._path = path
+
+        # Replace a stale socket left by an earlier server, but nothing
+        # else.
+        try:
+            if stat.S_ISSOCK(os.stat(path).st_mode):
+                os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+        # Conditions sent by clients are evaluated, so only the owner
+        # may connect: the socket is created with that mode, rather
+        # than changed after it's bound.
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            self._socket.bind(path)
+        finally:
+            os.umask(umask)
+        self._socket.listen(16)
+        self._socket.setblocking(False)
+
+        # Attached clients.
+        self._clients = []
+
+        # Identifiers of breakpoints that pause the data plane.
+        self._stopping = set()
+
+        # Breakpoint most recently set.
+        self._lastSet = None
+
+        # Active profiler, if any.
+        self._profiler = None
+
+        self._paused = False
+        self._run = False
+
+        self._dispatcher.set_listener(self)
+        self._dispatcher.register_source(self)
+        return
+
+    def get_path(self):
+        """Return the path of the control socket."""
+        return self._path
+
+    def get_clients(self):
+        """Return the list of attached clients' Channels."""
+        return self._clients
+
+    def is_paused(self):
+        """Return True if the data plane is paused."""
+        return self._paused
+
+    def get_sockets(self):
+        return [self._socket]
+
+    def on_readable(self, sock):
+        """Accept new clients."""
+
+        while True:
+            try:
+                s, a = self._socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                if e.errno in (errno.EMFILE, errno.ENFILE):
+                    break
+                continue
+            self._clients.append(Channel(self._dispatcher, s,
+                                         self.on_message,
+                                         self.CLIENT_LIMIT))
+        return
+
+    def serve(self):
+        """Forward traffic and handle requests until stopped or C-c."""
+
+        self._run = True
+        try:
+            while self._run:
+                if self._paused:
+                    self._poll_control()
+                elif not self._dispatcher._step():
+                    break
+        except KeyboardInterrupt:
+            pass
+        return
+
+    def stop(self):
+        """Stop serve()."""
+
+        self._run = False
+        self._wake()
+        return
+
+    def close(self):
+        """Detach all clients, and remove the control socket."""
+
+        for channel in list(self._clients):
+            channel.close()
+        self._clients = []
+        if self._socket:
+            self._dispatcher.deregister_source(self)
+            self._socket.close()
+            self._socket = None
+            os.unlink(self._path)
+        return
+
+    def _wake(self):
+        """Make the Dispatcher's _step() return, to see a state change.
+
+        It only returns once an event has been processed, so queue one
+        that does nothing (and that step() skips)."""
+
+        e = monjon.core.Event(self, "wake")
+        e.set_action(lambda event: None)
+        self._dispatcher.queue_event(e)
+        return
+
+    def _control_sockets(self):
+        return [self._socket] + [c.get_sockets()[0] for c in self._clients]
+
+    def _poll_control(self):
+        """While paused, wait for and handle requests only."""
+
+        sockets = self._control_sockets()
+        pending = [c.get_sockets()[0] for c in self._clients
+                   if c.get_pending()]
+        readable, writeable, failed = select.select(sockets, pending, [])
+        for sock in readable:
+            source = self._dispatcher._sourceSockets.get(sock)
+            if source:
+                source.on_readable(sock)
+        for sock in writeable:
+            source = self._dispatcher._sourceSockets.get(sock)
+            if source:
+                source.on_writeable(sock)
+        return
+
+    ####################################################################
+    # Listener interface
+
+    def on_set_breakpoint(self, breakpoint):
+        self._lastSet = breakpoint
+        return
+
+    def on_clear_breakpoint(self, breakpoint):
+        self._stopping.discard(breakpoint.get_name())
+        return
+
+    def on_break(self, breakpoint, event):
+        stop = breakpoint.get_name() in self._stopping
+        if stop and not self._paused:
+            self._paused = True
+            self._wake()
+
+        error = breakpoint.get_error()
+        self._notify({"type": "break",
+                      "breakpoint": breakpoint.get_name(),
+                      "source": event.get_source().get_name(),
+                      "event": event.get_type(),
+                      "description": event.get_description(),
+                      "error": repr(error) if error else None,
+                      "found": [end for pattern, end in
+                                breakpoint.get_found()],
+                      "paused": self._paused})
+        return
+
+    def _notify(self, message):
+        for channel in list(self._clients):
+            channel.send(message)
+        return
+
+    ####################################################################
+    # Requests
+
+    def on_message(self, channel, message):
+        """Handle a request from a client."""
+
+        if message is None:
+            if channel in self._clients:
+                self._clients.remove(channel)
+            return
+
+        handler = getattr(self, "do_" + str(message.get("cmd")), None)
+        if handler is None:
+            channel.send({"type": "error",
+                          "message": "Unknown command %r" %
+                                     message.get("cmd")})
+            return
+
+        try:
+            result = handler(message)
+        except ControlError as e:
+            channel.send({"type": "error", "message": str(e)})
+            return
+        except SyntaxError as e:
+            channel.send({"type": "error",
+                          "message": "Invalid condition: %s" % e})
+            return
+        except (AttributeError, OSError, TypeError, ValueError,
+                re.error) as e:
+            channel.send({"type": "error", "message": str(e) or repr(e)})
+            return
+
+        result["type"] = "result"
+        channel.send(result)
+        return
+
+    def _get_source(self, name):
+        """Return the source named 'name', or None for None."""
+
+        if name is None:
+            return None
+        source = self._dispatcher.get_sources().get(name)
+        if source is None:
+            raise ControlError("No source %r" % name)
+        return source
+
+    def do_listen(self, message):
+        protocol = message.get("protocol", "tcp").lower()
+        args = (self._dispatcher,
+                message.get("localPort", 0),
+                message.get("remoteHost"),
+                message.get("remotePort", 0))
+        if protocol == "tcp":
+            l = monjon.proxy.TCPListener(*args,
+                                         backlog=message.get("backlog", 128))
+        elif protocol == "udp":
+            l = monjon.proxy.UDPListener(*args)
+        else:
+            raise ControlError("Undefined protocol '%s': expecting 'tcp' "
+                               "or 'udp'." % protocol)
+
+        self._dispatcher.register_source(l)
+        return {"source": l.get_name(), "description": repr(l),
+                "localPort": l.localPort}
+
+    def do_breakpoint(self, message):
+        source = self._get_source(message.get("source"))
+        self._lastSet = None
+        self._dispatcher.set_breakpoint(source, str(message["event"]),
+                                        message.get("condition", "True"),
+                                        message.get("match"))
+        name = self._lastSet.get_name()
+        if message.get("stop", True):
+            self._stopping.add(name)
+        return {"breakpoint": name}
+
+    def do_clear(self, message):
+        bp = self._dispatcher.get_breakpoints().get(message["breakpoint"])
+        if bp is None:
+            raise ControlError("No breakpoint %r" % message["breakpoint"])
+        bp.clear()
+        return {}
+
+    def do_pause(self, message):
+        if not self._paused:
+            self._paused = True
+            self._wake()
+        return {"paused": True}
+
+    def do_continue(self, message):
+        self._paused = False
+        return {"paused": False}
+
+    def do_step(self, message):
+        """Process events one at a time, pausing first if necessary.
+
+        Only traffic sources are polled, so no further requests are
+        read until the step completes."""
+
+        self.do_pause(message)
+
+        d = self._dispatcher
+        d.set_interest(self._socket, 0)
+        for channel in self._clients:
+            channel.set_reading(False)
+        d._stepping = True
+
+        events = []
+        try:
+            deadline = time.time() + message.get("timeout",
+                                                 self.STEP_TIMEOUT)
+            while len(events) < message.get("count", 1):
+                if len(d._queue) < 1:
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    d._handle_ready(d._poller.poll(timeout))
+                    continue
+
+                event = d._queue.get()
+                if event.get_source() is self:
+                    event.perform_action()
+                    continue
+
+                # Describe it first: its payload is released after.
+                events.append({"source": event.get_source().get_name(),
+                               "event": event.get_type(),
+                               "description": event.get_description()})
+                d.dispatch(event)
+        finally:
+            d._stepping = False
+            d.set_interest(self._socket, monjon.core.POLL_READ)
+            for channel in self._clients:
+                channel.set_reading(True)
+
+        return {"events": events}
+
+    def do_inspect(self, message):
+        d = self._dispatcher
+        if message.get("source") is not None:
+            return {"source": self._describe(
+                self._get_source(message["source"]))}
+
+        return {"paused": self._paused,
+                "queued": d.get_queue_depth(),
+                "sources": [self._describe(s) for s in
+                            d.get_sources().values()
+                            if s is not self and s not in self._clients],
+                "breakpoints": [self._describe_breakpoint(bp) for bp in
+                                d.get_breakpoints().values()]}
+
+    def do_stats(self, message):
+        d = self._dispatcher
+        if message.get("source") is not None:
+            return {"stats": d.get_stats(self._get_source(message["source"]))}
+
+        return {"total": d.get_stats(),
+                "sources": {str(name): d.get_stats(source)
+                            for name, source in d.get_sources().items()}}
+
+    def do_profile(self, message):
+        if message.get("on", True):
+            if self._profiler:
+                self._profiler.stop()
+            self._profiler = monjon.profiler.Profiler(
+                self._dispatcher, message.get("sample", 0))
+            self._profiler.start()
+            return {}
+
+        if not self._profiler:
+            raise ControlError("Not profiling")
+        self._profiler.stop()
+        report = self._profiler.get_report()
+        self._profiler = None
+        return {"profile": report}
+
+    def do_stop(self, message):
+        self.stop()
+        return {}
+
+    def _describe(self, source):
+        """Return a summary of 'source', for inspect."""
+
+        info = {"name": source.get_name(),
+                "description": repr(source),
+                "state": source.get_state(),
+                "queued": self._dispatcher.get_queue_depth(source)}
+
+        if hasattr(source, "get_sessions"):
+            info["sessions"] = [s.get_name() for s in source.get_sessions()
+                                if s.get_state() != "closed"]
+
+        connection = getattr(source, "get_connection", lambda: None)()
+        if connection:
+            info["src"] = connection._src
+            info["dst"] = connection._dst
+            info["proto"] = connection._proto
+        return info
+
+    def _describe_breakpoint(self, bp):
+        source = bp.get_source()
+        return {"breakpoint": bp.get_name(),
+                "source": source.get_name() if source else None,
+                "event": str(bp.get_event()),
+                "condition": bp.get_condition(),
+                "match": bp.get_match(),
+                "stop": bp.get_name() in self._stopping}
+
+    def __repr__(self):
+        return "<Control Server: %s>" % self._path
+
+
+class ControlClient:
+    """Client for a ControlServer.
+
+    Each method sends a request, and waits for its reply, returning
+    the reply's fields as a dictionary, or raising ControlError.
+    Break notifications received meanwhile are kept, and returned by
+    get_notifications()."""
+
+    def __init__(self, path):
+        self._path = path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(path)
+        self._buffer = b""
+        self._notifications = []
+        return
+
+    def request(self, cmd, **args):
+        """Send request 'cmd', with 'args', and return its reply."""
+
+        args["cmd"] = cmd
+        self._socket.sendall(json.dumps(args).encode() + b"\n")
+
+        while True:
+            message = self._read()
+            if message["type"] == "result":
+                del message["type"]
+                return message
+            elif message["type"] == "error":
+                raise ControlError(message["message"])
+            self._notifications.append(message)
+
+    def _read(self, timeout=None):
+        """Return the next message, or None after 'timeout' seconds."""
+
+        self._socket.settimeout(timeout)
+        while b"\n" not in self._buffer:
+            try:
+                buf = self._socket.recv(65536)
+            except (socket.timeout, BlockingIOError):
+                return None
+            if not buf:
+                raise ControlError("Server closed connection")
+            self._buffer += buf
+
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return json.loads(line.decode())
+
+    def get_notifications(self, timeout=0):
+        """Return notifications received since the last call.
+
+        Waits up to 'timeout' seconds for one, if none are waiting."""
+
+        if not self._notifications:
+            message = self._read(timeout)
+            while message:
+                self._notifications.append(message)
+                message = self._read(0)
+
+        notifications = self._notifications
+        self._notifications = []
+        return notifications
+
+    def listen(self, localPort=0, remoteHost=None, remotePort=0,
+               protocol="tcp", backlog=128):
+        return self.request("listen", localPort=localPort,
+                            remoteHost=remoteHost, remotePort=remotePort,
+                            protocol=str(protocol), backlog=backlog)
+
+    def breakpoint(self, source, event, condition="True", stop=True,
+                   match=None):
+        return self.request("breakpoint", source=source, event=str(event),
+                            condition=condition, stop=stop,
+                            match=match)["breakpoint"]
+
+    def clear(self, breakpoint):
+        self.request("clear", breakpoint=breakpoint)
+        return
+
+    def pause(self):
+        self.request("pause")
+        return
+
+    def resume(self):
+        self.request("continue")
+        return
+
+    def step(self, count=1, timeout=1.0):
+        return self.request("step", count=count, timeout=timeout)["events"]
+
+    def inspect(self, source=None):
+        return self.request("inspect", source=source)
+
+    def stats(self, source=None):
+        return self.request("stats", source=source)
+
+    def profile(self, on=True, sample=0):
+        return self.request("profile", on=on, sample=sample)
+
+    def stop(self):
+        self.request("stop")
+        return
+
+    def close(self):
+        if self._socket:
+            self._socket.close()
+            self._socket = None
+        return
+
+    def __repr__(self):
+        return "<Control Client: %s>" % self._path
+
+    __help__ = """Help for control client.
+
+    listen([localPort[, remoteHost[, remotePort[, protocol[, backlog]]]]])
+        Listen for connections in the server, as the listen() command.
+        Returns the listener's source number and description.
+
+    breakpoint(source, event[, condition[, stop[, match]]])
+        Set a breakpoint in the server.  'source' is a source number,
+        or None for all sources.  If 'stop' is True (the default), a
+        hit pauses the server.  'match' is a list of regular
+        expressions (as strings) to find in the stream of data, as
+        for the breakpoint() command.  Returns the breakpoint number.
+
+    clear(breakpoint)
+        Clear a breakpoint.
+
+    pause()
+        Pause forwarding.
+
+    resume()
+        Continue forwarding.
+
+    step([count[, timeout]])
+        Pause, and process up to 'count' events, waiting no more than
+        'timeout' seconds.  Returns a list of the events processed.
+
+    inspect([source])
+        Return the server's state, or that of one source.
+
+    stats([source])
+        Return the server's traffic and dispatch counters, in total and
+        for each source, or for one source.
+
+    profile([on[, sample]])
+        Start profiling the server, as the profile() command, or stop
+        and return the results.
+
+    get_notifications([timeout])
+        Return the breakpoint hits reported since the last call.
+
+    stop()
+        Stop the server.
+
+    close()
+        Detach from the server."""
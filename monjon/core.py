@@ -20,20 +20,373 @@
 #HEADER_END
 ########################################################################
 
-import select, socket
+import asyncio, bisect, collections, mmap, select, selectors, socket
+import tempfile, time, types, weakref
+import monjon.match
+
+
+# Poller interest flags.
+POLL_READ = 1
+POLL_WRITE = 2
+
+
+class Poller:
+    """Base class for socket readiness pollers.
+
+    A Poller holds a persistent set of registered sockets, each with
+    an interest mask of POLL_READ and/or POLL_WRITE.  The Dispatcher
+    calls poll() to wait for some of them to become ready."""
+
+    def register(self, sock, events):
+        """Add 'sock' to the poll set with interest mask 'events'."""
+        return
+
+    def modify(self, sock, events):
+        """Change the interest mask for an already-registered 'sock'."""
+        return
+
+    def unregister(self, sock):
+        """Remove 'sock' from the poll set."""
+        return
+
+    def poll(self, timeout=None):
+        """Wait for registered sockets to become ready.
+
+        'timeout' is in seconds; None blocks until at least one socket
+        is ready.  Returns a list of (socket, readable, writeable)
+        tuples."""
+        return []
+
+    def close(self):
+        """Release any resources held by the poller."""
+        return
+
+
+class EpollPoller(Poller):
+    """Poller using Linux epoll(7)."""
+
+    def __init__(self):
+        self._epoll = select.epoll()
+
+        # Table of {fd: socket}
+        self._sockets = {}
+        return
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & POLL_READ:
+            mask |= select.EPOLLIN
+        if events & POLL_WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, sock, events):
+        fd = sock.fileno()
+        self._epoll.register(fd, self._mask(events))
+        self._sockets[fd] = sock
+        return
+
+    def modify(self, sock, events):
+        self._epoll.modify(sock.fileno(), self._mask(events))
+        return
+
+    def unregister(self, sock):
+        fd = sock.fileno()
+        if fd in self._sockets:
+            del self._sockets[fd]
+            self._epoll.unregister(fd)
+        return
+
+    def poll(self, timeout=None):
+        ready = []
+        for fd, mask in self._epoll.poll(-1 if timeout is None else timeout):
+            sock = self._sockets.get(fd)
+            if sock is None:
+                continue
+
+            # Errors and hangups are reported as readable, so that the
+            # owning source discovers them on its next recv().
+            readable = bool(mask & (select.EPOLLIN | select.EPOLLHUP |
+                                    select.EPOLLERR))
+            writeable = bool(mask & select.EPOLLOUT)
+            ready.append((sock, readable, writeable))
+        return ready
+
+    def close(self):
+        self._epoll.close()
+        self._sockets = {}
+        return
+
+
+class SelectorPoller(Poller):
+    """Portable poller using the standard library selectors module."""
+
+    def __init__(self):
+        self._selector = selectors.DefaultSelector()
+        return
+
+    @staticmethod
+    def _mask(events):
+        mask = 0
+        if events & POLL_READ:
+            mask |= selectors.EVENT_READ
+        if events & POLL_WRITE:
+            mask |= selectors.EVENT_WRITE
+        return mask
+
+    def register(self, sock, events):
+        self._selector.register(sock, self._mask(events))
+        return
+
+    def modify(self, sock, events):
+        self._selector.modify(sock, self._mask(events))
+        return
+
+    def unregister(self, sock):
+        try:
+            self._selector.unregister(sock)
+        except KeyError:
+            pass
+        return
+
+    def poll(self, timeout=None):
+        ready = []
+        for key, mask in self._selector.select(timeout):
+            ready.append((key.fileobj,
+                          bool(mask & selectors.EVENT_READ),
+                          bool(mask & selectors.EVENT_WRITE)))
+        return ready
+
+    def close(self):
+        self._selector.close()
+        return
+
+
+class AsyncioPoller(Poller):
+    """Poller using an asyncio event loop's reader and writer callbacks.
+
+    poll() runs the loop until a registered socket is ready (or the
+    timeout expires), so timers and other tasks scheduled on the same
+    loop also run while the Dispatcher is waiting.  wait() is the
+    equivalent coroutine, for use when the loop is already running."""
+
+    def __init__(self, loop):
+        self._loop = loop
+
+        # Table of {socket: interest mask}
+        self._sockets = {}
+
+        # Table of {socket: ready mask} collected since the last poll.
+        self._ready = {}
+
+        # Future to complete when something becomes ready.
+        self._waiter = None
+        return
+
+    def get_loop(self):
+        return self._loop
+
+    def register(self, sock, events):
+        self._sockets[sock] = 0
+        self.modify(sock, events)
+        return
+
+    def modify(self, sock, events):
+        old = self._sockets[sock]
+        if events & POLL_READ and not old & POLL_READ:
+            self._loop.add_reader(sock, self._on_ready, sock, POLL_READ)
+        elif old & POLL_READ and not events & POLL_READ:
+            self._loop.remove_reader(sock)
+
+        if events & POLL_WRITE and not old & POLL_WRITE:
+            self._loop.add_writer(sock, self._on_ready, sock, POLL_WRITE)
+        elif old & POLL_WRITE and not events & POLL_WRITE:
+            self._loop.remove_writer(sock)
+
+        self._sockets[sock] = events
+        return
+
+    def unregister(self, sock):
+        if sock in self._sockets:
+            self.modify(sock, 0)
+            del self._sockets[sock]
+            self._ready.pop(sock, None)
+        return
+
+    def _on_ready(self, sock, events):
+        self._ready[sock] = self._ready.get(sock, 0) | events
+        self.wake()
+        return
+
+    def wake(self):
+        """Make a pending poll() or wait() return."""
+
+        if self._waiter and not self._waiter.done():
+            self._waiter.set_result(None)
+        return
+
+    async def wait(self, timeout=None):
+        """Coroutine equivalent of poll()."""
+
+        # Readiness is level-triggered, so anything collected before now
+        # may be stale: wait for at least one pass of the loop.
+        self._ready = {}
+        self._waiter = self._loop.create_future()
+        if timeout == 0:
+            timer = self._loop.call_soon(self.wake)
+        elif timeout is not None:
+            timer = self._loop.call_later(timeout, self.wake)
+        else:
+            timer = None
+
+        try:
+            await self._waiter
+        finally:
+            self._waiter = None
+            if timer:
+                timer.cancel()
+
+        ready = [(sock, bool(mask & POLL_READ), bool(mask & POLL_WRITE))
+                 for sock, mask in self._ready.items()]
+        self._ready = {}
+        return ready
+
+    def poll(self, timeout=None):
+        return self._loop.run_until_complete(self.wait(timeout))
+
+    def close(self):
+        for sock in list(self._sockets.keys()):
+            self.unregister(sock)
+        return
+
+
+def create_poller():
+    """Return the best available Poller for this platform."""
+
+    if hasattr(select, "epoll"):
+        return EpollPoller()
+    return SelectorPoller()
 
 
 class Breakpoint:
-    """Base class for breakpoints."""
+    """Base class for breakpoints.
 
-    def __init__(self, dispatcher, index, source, event, condition):
+    The condition is compiled when the breakpoint is created, so a
+    syntax error is raised immediately (as SyntaxError) rather than
+    when the breakpoint is first checked, and each check only has to
+    evaluate the already-compiled code."""
+
+    def __init__(self, dispatcher, index, source, event, condition,
+                 match=None):
         self._dispatcher = dispatcher
         self._name = index
         self._source = source
         self._event = event
         self._condition = condition
+
+        # Patterns to find in the stream of payloads, if any, with the
+        # matcher's state for each source's stream, and the matches
+        # found in the most recent payload.
+        self._match = match
+        if match:
+            self._matcher = monjon.match.StreamMatcher(match)
+        else:
+            self._matcher = None
+        self._streams = weakref.WeakKeyDictionary()
+        self._found = []
+
+        # Compiled condition, or None if it's unconditional.
+        if condition is None or condition.strip() == "True":
+            self._code = None
+        else:
+            self._code = compile(condition.strip(), "<breakpoint>", "eval")
+
+        # Exception raised by the most recent evaluation, if any.
+        self._error = None
         return
 
+    def matches(self, event):
+        """Evaluate this breakpoint's condition for 'event'.
+
+        If the breakpoint has patterns to match, the event's payload
+        is scanned first, as the continuation of the stream of
+        payloads from its source, and the condition is only evaluated
+        if a pattern is found.
+
+        The condition is evaluated in a namespace containing:
+          event       the Event being dispatched
+          payload     its packet's payload (a memoryview), or None
+          source      the Event's source
+          connection  the Connection it relates to, or None
+          offset      the payload's offset in its stream, or None
+          message     the decoded Message (see monjon.decode), or None
+          found       the patterns found (see get_found())
+
+        If evaluation raises an exception, it's saved (see get_error())
+        and the breakpoint is treated as matching, so that the user
+        gets to see the problem."""
+
+        packet = event.get_packet()
+        if self._matcher is not None:
+            if packet is None or not self.scan(event):
+                return False
+
+        if self._code is None:
+            return True
+
+        namespace = {"event": event,
+                     "payload": packet.get_payload() if packet else None,
+                     "source": event.get_source(),
+                     "connection": event.get_connection(),
+                     "offset": packet.get_offset() if packet else None,
+                     "message": event.get_message(),
+                     "found": self._found}
+        try:
+            self._error = None
+            return bool(eval(self._code, namespace))
+        except Exception as e:
+            self._error = e
+            return True
+
+    def scan(self, event):
+        """Scan 'event's payload for this breakpoint's patterns.
+
+        The payload continues the stream of its source's payloads, so
+        every payload must be scanned, in order, even if the event
+        breaks on another breakpoint.  Returns the matches found (see
+        get_found())."""
+
+        packet = event.get_packet()
+        if self._matcher is None or packet is None:
+            self._found = []
+            return self._found
+
+        source = event.get_source()
+        stream = self._streams.get(source)
+        if stream is None:
+            stream = self._streams[source] = self._matcher.new_stream()
+        self._found = self._matcher.scan(stream, packet.get_payload(),
+                                         packet.get_offset())
+        return self._found
+
+    def get_error(self):
+        """Return the exception from the last condition evaluation."""
+        return self._error
+
+    def get_match(self):
+        """Return the patterns to match, or None."""
+        return self._match
+
+    def get_found(self):
+        """Return the matches found in the most recent payload.
+
+        A list of (pattern, end) pairs, where 'end' is the offset in
+        the source's stream just after the match.  If the source keeps
+        streams, these are its stream offsets: otherwise they count
+        from when the breakpoint was set."""
+        return self._found
+
     def get_name(self):
         """Returns the index number for this breakpoint."""
         return self._name
@@ -72,19 +425,225 @@ class Breakpoint:
     get_condition()
         Returns the conditional expresssion that must evaluate to True
         for this breakpoint to break the flow of execution.  The
-        default condition is 'True' (which will always break)."""
+        default condition is 'True' (which will always break).
+
+        The condition can refer to 'event', 'payload', 'source',
+        'connection', 'offset', 'message' and 'found'.
+
+    get_match()
+        Returns the patterns which must be found in the stream of
+        payloads before the condition is evaluated, or None.
+
+    get_found()
+        Returns the patterns found in the most recent payload, as
+        a list of (pattern, stream offset after the match) pairs.
+
+    get_error()
+        Returns the exception raised when the condition was last
+        evaluated, or None."""
 
 
 class Watchpoint:
-    """Base class for watchpoint."""
+    """Watches the value of an expression over a source's state.
+
+    The expression is compiled when the watchpoint is set, and then
+    evaluated after each event that could change its value, and the
+    Dispatcher's listener told (see Listener.on_watch()) whenever the
+    value differs from the previous one.
+
+    Which events could change it is found from the names the
+    expression uses (see PROPERTIES): an expression using only
+    "sessions", for example, is evaluated after accept and close
+    events, and nothing else.  Sources only queue events for the
+    types some watchpoint depends on, so other traffic still takes the
+    fast path, and a watchpoint costs nothing until its source has a
+    relevant event.  A listener's watchpoints see its sessions' events
+    too."""
+
+    # Names available to an expression, with the event types that can
+    # change each one.  An expression using none of them could depend
+    # on anything, so it's evaluated after every event.
+    RECV = ("client_recv", "server_recv")
+    ALL = ("accept", "connect", "connect_failed", "client_recv",
+           "server_recv", "close")
+    PROPERTIES = {
+        "source": ALL,
+        "event": ALL,
+        "state": ("accept", "connect", "connect_failed", "close"),
+        "sessions": ("accept", "close"),
+        "accepts": ("accept",),
+        "closes": ("close",),
+        "bytes": RECV,
+        "packets": RECV,
+        "client_recv_bytes": ("client_recv",),
+        "client_recv_packets": ("client_recv",),
+        "server_recv_bytes": ("server_recv",),
+        "server_recv_packets": ("server_recv",),
+        "payload": RECV,
+    }
+
+    def __init__(self, dispatcher, index, source, expression):
+        self._dispatcher = dispatcher
+        self._name = index
+        self._source = source
+        self._expression = expression
+        self._code = compile(expression.strip(), "<watchpoint>", "eval")
+
+        # Event types that can change the value.
+        names = set()
+        self._find_names(self._code, names)
+        eventTypes = set()
+        for name in names:
+            eventTypes.update(self.PROPERTIES.get(name, ()))
+        self._events = frozenset(eventTypes or self.ALL)
+
+        # The last payload received by the source, if it's watched.
+        self._payload = None
+        self._usesPayload = "payload" in names
+
+        self._value = self._evaluate(None)
+        return
 
-    def __init__(self):
-        self._source = None
-        self._property = None
-        self._condition = None
+    def _find_names(self, code, names):
+        """Add the names used by 'code', including nested code, to
+        'names'."""
+
+        names.update(code.co_names)
+        for const in code.co_consts:
+            if isinstance(const, types.CodeType):
+                self._find_names(const, names)
         return
 
-    __help__ = """Help for watchpoint."""
+    def _evaluate(self, event):
+        """Return the value of the expression.
+
+        If evaluation raises an exception, the exception is the
+        value."""
+
+        source = self._source
+        stats = source.get_stats()
+        if self._usesPayload and event is not None:
+            packet = event.get_packet()
+            if packet is not None:
+                self._payload = bytes(packet.get_payload())
+
+        # A listener's closes include its sessions', so this is the
+        # number open without having to look at each one.
+        if hasattr(source, "get_sessions"):
+            sessions = stats.accepts - stats.closes
+        else:
+            sessions = int(source.get_state() not in (None, "closed"))
+
+        namespace = {
+            "source": source,
+            "event": event,
+            "state": source.get_state(),
+            "sessions": sessions,
+            "accepts": stats.accepts,
+            "closes": stats.closes,
+            "bytes": stats.clientRecvBytes + stats.serverRecvBytes,
+            "packets": stats.clientRecvPackets + stats.serverRecvPackets,
+            "client_recv_bytes": stats.clientRecvBytes,
+            "client_recv_packets": stats.clientRecvPackets,
+            "server_recv_bytes": stats.serverRecvBytes,
+            "server_recv_packets": stats.serverRecvPackets,
+            "payload": self._payload}
+        try:
+            value = eval(self._code, namespace)
+        except Exception as e:
+            return e
+
+        # Don't keep a view of a buffer that's about to be reused.
+        if isinstance(value, memoryview):
+            value = bytes(value)
+        return value
+
+    def check(self, event):
+        """Re-evaluate after 'event', and return True if the value has
+        changed."""
+
+        old = self._value
+        value = self._evaluate(event)
+        self._value = value
+
+        if isinstance(value, Exception) or isinstance(old, Exception):
+            return repr(value) != repr(old)
+        try:
+            return bool(value != old)
+        except Exception:
+            return True
+
+    def get_value(self):
+        """Return the most recent value of the expression."""
+        return self._value
+
+    def get_name(self):
+        """Return the index number for this watchpoint."""
+        return self._name
+
+    def get_source(self):
+        """Return the source for this watchpoint."""
+        return self._source
+
+    def get_expression(self):
+        """Return the expression watched."""
+        return self._expression
+
+    def get_events(self):
+        """Return the set of event types that can change the value."""
+        return self._events
+
+    def clear(self):
+        """Clear this watchpoint."""
+        return self._dispatcher.clear_watchpoint(self)
+
+    __help__ = """Help for watchpoint.
+
+    clear()
+        Deletes this watchpoint.
+
+    get_name()
+        Returns the index number in the global watchpoints table for
+        this watchpoint.
+
+    get_source()
+        Returns the event source whose state is watched.
+
+    get_expression()
+        Returns the watched expression.  It can refer to 'source',
+        'event', 'state', 'sessions', 'accepts', 'closes', 'bytes',
+        'packets', 'client_recv_bytes', 'client_recv_packets',
+        'server_recv_bytes', 'server_recv_packets' and 'payload'
+        (the last payload the source received, as bytes).
+
+    get_value()
+        Returns the expression's most recent value (or the exception
+        raised evaluating it).
+
+    get_events()
+        Returns the event types after which the expression is
+        evaluated."""
+
+
+class DispatchHooks:
+    """Base class for Dispatcher instrumentation (see add_hooks())."""
+
+    def on_poll(self, ready, pollTime, ioTime):
+        """Called after each poll.
+
+        'ready' is the number of ready sockets, 'pollTime' the seconds
+        spent waiting for them, and 'ioTime' the seconds spent in the
+        sources' callbacks."""
+        return
+
+    def pre_dispatch(self, event):
+        """Called before 'event' is dispatched."""
+        return
+
+    def post_dispatch(self, event, matchTime, captureTime, actionTime):
+        """Called after 'event' is dispatched, with the seconds spent
+        checking breakpoints, capturing and performing its action."""
+        return
 
 
 class Listener:
@@ -103,14 +662,128 @@ class Listener:
         return
 
 
+class SourceStats:
+    """Traffic and dispatch counters for an event source.
+
+    Counters are plain attributes, updated in place as traffic flows,
+    and nothing is derived from them until they're read (see
+    get_values()), so keeping them costs a few additions per packet.
+
+    A session's counters can have a parent (its listener's), which is
+    updated too, so the listener's totals include closed sessions."""
+
+    __slots__ = ("serverRecvBytes", "serverRecvPackets",
+                 "clientRecvBytes", "clientRecvPackets",
+                 "accepts", "closes", "events", "dispatchTime",
+                 "_parent", "_created", "_readTime", "_readEvents")
+
+    def __init__(self, parent=None):
+        self.serverRecvBytes = 0
+        self.serverRecvPackets = 0
+        self.clientRecvBytes = 0
+        self.clientRecvPackets = 0
+        self.accepts = 0
+        self.closes = 0
+        self.events = 0
+        self.dispatchTime = 0.0
+
+        self._parent = parent
+
+        # Time and event count when last read, for the event rate.
+        self._created = time.time()
+        self._readTime = self._created
+        self._readEvents = 0
+        return
+
+    def get_parent(self):
+        """Return the parent counters, or None."""
+        return self._parent
+
+    def set_parent(self, parent):
+        """Set the counters to update along with these."""
+        self._parent = parent
+        return
+
+    def add_recv(self, fromClient, n):
+        """Count 'n' bytes received from the client or the server."""
+
+        stats = self
+        while stats:
+            if fromClient:
+                stats.serverRecvBytes += n
+                stats.serverRecvPackets += 1
+            else:
+                stats.clientRecvBytes += n
+                stats.clientRecvPackets += 1
+            stats = stats._parent
+        return
+
+    def add_accept(self):
+        """Count an accepted connection."""
+        self.accepts += 1
+        return
+
+    def add_close(self):
+        """Count a closed connection."""
+
+        stats = self
+        while stats:
+            stats.closes += 1
+            stats = stats._parent
+        return
+
+    def add(self, other):
+        """Add the counters from 'other' to these."""
+
+        for name in ("serverRecvBytes", "serverRecvPackets",
+                     "clientRecvBytes", "clientRecvPackets",
+                     "accepts", "closes", "events", "dispatchTime"):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        return
+
+    def get_values(self):
+        """Return the counters as a dictionary.
+
+        "events_per_s" is the rate since the previous call."""
+
+        now = time.time()
+        elapsed = now - self._readTime
+        rate = (self.events - self._readEvents) / elapsed if elapsed else 0.0
+        self._readTime = now
+        self._readEvents = self.events
+
+        return {"server_recv_bytes": self.serverRecvBytes,
+                "server_recv_packets": self.serverRecvPackets,
+                "client_recv_bytes": self.clientRecvBytes,
+                "client_recv_packets": self.clientRecvPackets,
+                "accepts": self.accepts,
+                "closes": self.closes,
+                "events": self.events,
+                "events_per_s": rate,
+                "dispatch_time": self.dispatchTime,
+                "uptime": now - self._created}
+
+
 class EventSource:
     """Base class for event sources."""
 
     def __init__(self):
         self._name = None
         self._state = None
+        self._stats = SourceStats()
+
+        # Source this one belongs to (a session's listener), if any.
+        self._parent = None
         return
 
+    def get_parent(self):
+        """Return the source this one belongs to, or None."""
+        return self._parent
+
+    def get_stats(self):
+        """Return this source's SourceStats."""
+        return self._stats
+
     def get_sockets(self):
         return []
 
@@ -120,6 +793,16 @@ class EventSource:
     def on_writeable(self, socket):
         return
 
+    def generate(self):
+        """Queue events that don't come from a socket.
+
+        Called by the Dispatcher, for sources added with
+        add_generator(), whenever it needs more events.  Returns the
+        number of seconds until more events will be ready (zero if
+        they're ready now), or None if it has nothing more to
+        generate."""
+        return None
+
     def get_state(self):
         return self._state
 
@@ -137,89 +820,649 @@ class EventSource:
     __help__ = """Help for event source."""
 
 
+class BufferPool:
+    """Pool of reusable receive buffers.
+
+    Sources recv_into() a buffer from the pool rather than allocating
+    a new bytes object for every read, and put() it back once the data
+    has been forwarded."""
+
+    def __init__(self, size=8192, limit=256):
+        # Size of each buffer, in bytes.
+        self._size = size
+
+        # Maximum number of free buffers to keep.
+        self._limit = limit
+
+        # Free buffers.
+        self._free = []
+        return
+
+    def get_size(self):
+        """Return the size of the pool's buffers."""
+        return self._size
+
+    def get(self):
+        """Return a free buffer, allocating one if necessary."""
+
+        if self._free:
+            return self._free.pop()
+        return bytearray(self._size)
+
+    def put(self, buf):
+        """Return a buffer to the pool."""
+
+        if len(self._free) < self._limit:
+            self._free.append(buf)
+        return
+
+
+# Translation table for dump() previews: printable ASCII is unchanged,
+# everything else is shown as a dot.
+_PREVIEW = bytes(b if 32 <= b < 127 else ord(".") for b in range(256))
+
+
 class Packet:
-    """A network packet."""
+    """A network packet.
+
+    The payload may be a memoryview onto a pooled receive buffer.  In
+    that case, 'release' is a callable which returns the buffer to its
+    pool: the Dispatcher calls release() once the packet's event has
+    been processed, after which the payload is no longer valid.  To
+    keep the payload beyond that point, call retain() first."""
 
-    def __init__(self, bytes, connection):
+    def __init__(self, bytes, connection, release=None):
         self._bytes = bytes
         self._connection = connection
+        self._release = release
+
+        # Offset of the payload in its session's stream, if known.
+        self._offset = None
         return
 
     def get_connection(self):
         """Return reference to the Connection that delivered this Packet."""
         return self._connection
 
+    def get_offset(self):
+        """Return the stream offset of the payload's first byte, or None
+        if the session isn't keeping streams."""
+        return self._offset
+
+    def set_offset(self, offset):
+        self._offset = offset
+        return
+
     def get_payload(self):
-        """Get the content of this packet."""
+        """Get the content of this packet.
+
+        This is a bytes-like object: either bytes, or a memoryview
+        that can be sliced without copying."""
         return self._bytes
 
-    def dump(self):
-        """Return a formatted dump of the packet's content.
+    def retain(self):
+        """Copy the payload out of its pooled buffer, if it's in one."""
+
+        if self._release:
+            data = bytes(self._bytes)
+            self.release()
+            self._bytes = data
+        return
+
+    def release(self):
+        """Return the payload's buffer to its pool."""
+
+        if self._release:
+            release = self._release
+            self._release = None
+
+            # Invalidate the view, so stale references can't see the
+            # buffer's next contents.
+            if isinstance(self._bytes, memoryview):
+                try:
+                    self._bytes.release()
+                except BufferError:
+                    pass
+            release()
+        return
+
+    def dump(self, offset=0, length=None):
+        """Return a formatted dump of the packet's content.
+
+        Print 16 bytes per line, in two groups of 8, showing hex
+        values of each byte.  Follow this by a character-oriented
+        view, with non-printable characters replaced by a dot.
+
+        'offset' and 'length' select part of the payload; by default
+        the whole packet is dumped. """
+
+        return "".join(self.dump_lines(offset, length))
+
+    def dump_lines(self, offset=0, length=None):
+        """Return an iterator over the lines of dump().
+
+        Lines are formatted as they're consumed, so a large payload can
+        be paged through without formatting all of it."""
+
+        l = len(self._bytes)
+        end = l if length is None else min(l, offset + length)
+
+        for i in range(offset, end, 16):
+            row = bytes(self._bytes[i:min(i + 16, end)])
+
+            # Offset, hex bytes in two groups of eight, and preview.
+            # Short rows are padded so the preview stays aligned.
+            yield "%04x   %-23s   %-23s   |%-16s|\n" % (
+                i,
+                row[:8].hex(" "),
+                row[8:].hex(" "),
+                row.translate(_PREVIEW).decode("ascii"))
+        return
+
+    __help__ = """Help for packet.
+
+    get_payload()
+        Returns the content of the packet.
+
+    get_connection()
+        Returns the Connection that delivered this packet.
+
+    get_offset()
+        Returns the offset of the packet's first byte in its session's
+        stream, or None if the session isn't keeping streams.
+
+    dump([offset[, length]])
+        Returns a hex dump of the packet's content, or the part of it
+        starting at 'offset' and extending for 'length' bytes.
+
+    dump_lines([offset[, length]])
+        Returns an iterator over the lines of a hex dump, for paging
+        through a large packet.  For example
+
+        for line in e.get_packet().dump_lines(0x1000, 256):
+            print(line, end="")"""
+
+
+class Connection:
+    def __init__(self):
+        self._listener = None
+        self._src = None
+        self._dst = None
+        self._proto = None
+
+        # Recorded traffic: deque of Segments, oldest first.  Managed
+        # by the Dispatcher's TrafficHistory, if recording is enabled.
+        self._history = collections.deque()
+
+        # Segments of this connection's history that may still be held
+        # in memory (spilled ones are skipped), and their total size.
+        self._historyMemory = collections.deque()
+        self._historyBytes = 0
+        return
+
+    def get_history(self, eventType=None):
+        """Return the recorded Segments for this connection.
+
+        'eventType' selects one direction ("client_recv" or
+        "server_recv"); by default, both are returned, oldest first."""
+
+        return [seg for seg in self._history
+                if not seg.is_lost() and
+                (eventType is None or seg.get_type() == eventType)]
+
+    __help__ = """Help for connection.
+
+    get_history([event])
+        Returns a list of the traffic segments recorded for this
+        connection, optionally for one direction only (client_recv or
+        server_recv).  See record()."""
+
+
+class Segment:
+    """A chunk of recorded traffic.
+
+    Its data is held in memory until it's spilled to the history's
+    disk file, and is lost once it's overwritten there."""
+
+    __slots__ = ("_connection", "_type", "_time", "_data",
+                 "_history", "_offset", "_length")
+
+    def __init__(self, history, connection, eventType, data):
+        self._history = history
+        self._connection = connection
+        self._type = eventType
+        self._time = time.time()
+        self._data = data
+        self._offset = None
+        self._length = len(data)
+        return
+
+    def get_type(self):
+        """Return the event type that delivered this segment."""
+        return self._type
+
+    def get_time(self):
+        """Return the time this segment was received."""
+        return self._time
+
+    def get_length(self):
+        """Return the length of this segment's data."""
+        return self._length
+
+    def is_spilled(self):
+        """Return True if this segment's data is held on disk."""
+        return self._data is None and self._offset is not None
+
+    def is_lost(self):
+        """Return True if this segment's data is no longer available."""
+        return self._data is None and self._offset is None
+
+    def get_payload(self):
+        """Return this segment's data, reading it from disk if spilled."""
+
+        if self._data is not None:
+            return self._data
+        if self._offset is None:
+            return None
+        return self._history.read(self._offset, self._length)
+
+    def get_packet(self):
+        """Return this segment's data as a Packet."""
+        return Packet(self.get_payload(), self._connection)
+
+    def __repr__(self):
+        return "<Segment: %s, %u bytes%s>" % (
+            self._type, self._length,
+            ", spilled" if self.is_spilled() else
+            ", lost" if self.is_lost() else "")
+
+
+class TrafficHistory:
+    """Bounded store of recorded traffic for all connections.
+
+    Each connection's history is a ring of Segments.  Recent segments
+    are kept in memory, subject to a per-connection budget and a total
+    budget across all connections.  When either is exceeded, the oldest
+    segments are spilled to a memory-mapped temporary file, which is
+    itself a fixed-size ring: once it's full, the oldest spilled
+    segments are overwritten and lost."""
+
+    def __init__(self, memory=64 * 1024 * 1024,
+                 perConnection=8 * 1024 * 1024,
+                 disk=1024 * 1024 * 1024):
+        # Budgets, in bytes.
+        self._memory = memory
+        self._perConnection = perConnection
+        self._disk = disk
+
+        # Bytes held in memory, across all connections.
+        self._memoryBytes = 0
+
+        # In-memory segments, oldest first, and how many of them are
+        # still in memory.  Segments spilled by their connection's
+        # budget are skipped when they reach the front, or removed
+        # when the deque is compacted.
+        self._inMemory = collections.deque()
+        self._inMemoryCount = 0
+
+        # Spilled segments, in file order.
+        self._onDisk = collections.deque()
+
+        # Spill file, its mapping, and the next write position.
+        self._file = None
+        self._map = None
+        self._position = 0
+        return
+
+    def get_memory_bytes(self):
+        """Return the number of bytes of history held in memory."""
+        return self._memoryBytes
+
+    def record(self, connection, eventType, data):
+        """Record a copy of 'data', received on 'connection'."""
+
+        seg = Segment(self, connection, eventType, bytes(data))
+        connection._history.append(seg)
+        connection._historyMemory.append(seg)
+        connection._historyBytes += seg._length
+        self._inMemory.append(seg)
+        self._inMemoryCount += 1
+        self._memoryBytes += seg._length
+
+        # Enforce the connection's budget, oldest segments first.
+        while connection._historyBytes > self._perConnection:
+            old = connection._historyMemory.popleft()
+            if old._data is not None:
+                self._spill(old)
+
+        # Enforce the total budget.
+        while self._memoryBytes > self._memory and self._inMemory:
+            old = self._inMemory.popleft()
+            if old._data is not None:
+                self._spill(old)
+
+        if len(self._inMemory) > 2 * self._inMemoryCount + 64:
+            self._inMemory = collections.deque(
+                seg for seg in self._inMemory if seg._data is not None)
+        return
+
+    def forget(self, connection):
+        """Discard all recorded history for 'connection'."""
+
+        for seg in connection._history:
+            if seg._data is not None:
+                self._memoryBytes -= seg._length
+                self._inMemoryCount -= 1
+            seg._data = None
+            seg._offset = None
+        connection._history.clear()
+        connection._historyMemory.clear()
+        connection._historyBytes = 0
+        return
+
+    def read(self, offset, length):
+        """Return 'length' bytes of spilled data from 'offset'."""
+        return self._map[offset:offset + length]
+
+    def _spill(self, seg):
+        """Move a segment's data from memory to the spill file."""
+
+        n = seg._length
+        self._memoryBytes -= n
+        self._inMemoryCount -= 1
+        seg._connection._historyBytes -= n
+
+        # Drop spilled segments from the front of the connection's
+        # in-memory ring.
+        inMemory = seg._connection._historyMemory
+        while inMemory and (inMemory[0] is seg or inMemory[0]._data is None):
+            inMemory.popleft()
+
+        if n > self._disk:
+            # Too big to ever fit: just lose it.
+            seg._data = None
+            self._trim(seg._connection)
+            return
+
+        if self._map is None:
+            self._file = tempfile.TemporaryFile(prefix="monjon-")
+            self._file.truncate(self._disk)
+            self._map = mmap.mmap(self._file.fileno(), self._disk)
+
+        # Wrap to the start of the file if it won't fit at the end.
+        # Anything left in the tail is older than what's at the start,
+        # so it is lost too.
+        if self._position + n > self._disk:
+            while self._onDisk and (self._onDisk[0]._offset is None or
+                                    self._onDisk[0]._offset >= self._position):
+                old = self._onDisk.popleft()
+                old._offset = None
+                self._trim(old._connection)
+            self._position = 0
+
+        # Lose any spilled segments in the region to be overwritten.
+        start, end = self._position, self._position + n
+        while self._onDisk:
+            old = self._onDisk[0]
+            if old._offset is not None and \
+               old._offset < end and old._offset + old._length > start:
+                old._offset = None
+                self._onDisk.popleft()
+                self._trim(old._connection)
+            elif old._offset is None:
+                self._onDisk.popleft()
+            else:
+                break
+
+        self._map[start:end] = seg._data
+        seg._data = None
+        seg._offset = start
+        self._position = end
+        self._onDisk.append(seg)
+        return
+
+    @staticmethod
+    def _trim(connection):
+        """Remove lost segments from the front of a connection's ring."""
+
+        history = connection._history
+        while history and history[0].is_lost():
+            history.popleft()
+        return
+
+    def close(self):
+        """Release the spill file.
+
+        Spilled segments are lost; those still in memory are kept."""
+
+        while self._onDisk:
+            seg = self._onDisk.popleft()
+            if seg._offset is not None:
+                seg._offset = None
+                self._trim(seg._connection)
+
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = None
+            self._file = None
+        return
+
+
+class ByteStream:
+    """The bytes sent in one direction of a session, as a stream.
+
+    Data is appended as it's received, and addressed by its absolute
+    offset from the start of the stream, however it was split into
+    packets.  Slicing returns a memoryview of the stored data, without
+    copying, unless the slice spans two of the stream's blocks; for
+    example
+
+      stream[1000:2000]
+      stream[-100:]
+
+    Only the most recent 'retention' bytes are guaranteed to be kept
+    (all of them, if 'retention' is None).  Once a reader such as a
+    decoder calls consume(), data it hasn't consumed is kept too.
+    Older data is discarded a block at a time, and slicing it raises
+    IndexError.
+
+    Data is stored in blocks of up to BLOCK bytes, each extended in
+    place.  A block can't grow while a view of it exists, so a new
+    block is started instead: views stay valid as long as they're
+    held."""
+
+    BLOCK = 64 * 1024
+
+    def __init__(self, retention=None):
+        self._retention = retention
+
+        # Blocks, and the stream offset at which each starts.
+        self._blocks = []
+        self._starts = []
+
+        # Offset of the first byte kept, and just after the last.
+        self._start = 0
+        self._end = 0
+
+        # Offset up to which a reader has consumed the stream, if any
+        # reader has.
+        self._consumed = None
+        return
+
+    def append(self, data):
+        """Add 'data' to the end of the stream."""
+
+        n = len(data)
+        if not n:
+            return
+
+        blocks = self._blocks
+        if blocks and len(blocks[-1]) + n <= self.BLOCK:
+            try:
+                blocks[-1] += data
+                self._end += n
+                self._trim()
+                return
+            except BufferError:
+                pass
+
+        blocks.append(bytearray(data))
+        self._starts.append(self._end)
+        self._end += n
+        self._trim()
+        return
+
+    def _trim(self):
+        """Discard blocks no longer needed."""
+
+        if self._retention is None:
+            return
 
-        Print 16 bytes per line, in two groups of 8, showing hex
-        values of each byte.  Follow this by a character-oriented
-        view, with non-printable characters replaced by a dot. """
+        keep = self._end - self._retention
+        if self._consumed is not None and self._consumed < keep:
+            keep = self._consumed
 
-        # Result string.
-        s = ""
+        while len(self._blocks) > 1 and \
+              self._starts[0] + len(self._blocks[0]) <= keep:
+            self._blocks.pop(0)
+            self._starts.pop(0)
+        if self._starts:
+            self._start = self._starts[0]
+        return
 
-        # String-oriented "preview" assembled and appended to each line.
-        p = "|"
+    def consume(self, offset):
+        """Note that a reader no longer needs data before 'offset'."""
 
-        # Index into packet's byte array.
-        i = 0
+        if self._consumed is None or offset > self._consumed:
+            self._consumed = min(offset, self._end)
+        self._trim()
+        return
 
-        # Length of packet.
-        l = len(self._bytes)
+    def get_consumed(self):
+        """Return the offset up to which the stream was consumed, or
+        None if no reader has used consume()."""
+        return self._consumed
 
-        while i < l:
-            if i % 16 == 0:
-                # Print offset into packet at start of each line of 16 bytes. 
-                s += "%04x   " % i
+    def get_start(self):
+        """Return the offset of the oldest byte kept."""
+        return self._start
 
-            b = self._bytes[i]
-            s += "%02x " % b
-            p += chr(b) if b >= 32 and b < 127 else "."
+    def get_end(self):
+        """Return the offset just after the newest byte."""
+        return self._end
 
-            if i % 16 == 15:
-                # At the end of each row, print the string preview,
-                # and then reset it ready for the next line.
-                s += "  %s|\n" % p
-                p = "|"
+    def get_retention(self):
+        """Return the number of bytes kept, or None if unlimited."""
+        return self._retention
 
-            elif i % 8 == 7:
-                # Insert an extra gap between the groups of eight bytes.
-                s += "  "
+    def set_retention(self, retention):
+        """Set the number of bytes kept, or None for unlimited."""
 
-            i += 1
+        self._retention = retention
+        self._trim()
+        return
 
-        # At the end of the packet, if it's not an exact multiple of
-        # 16 bytes in length, pad out the hex bytes display with
-        # spaces, and then append the string preview aligned with the
-        # other rows.
-        if l % 16 != 0:
-            for i in range(16 - (l % 16)):
-                s += "   "
-                p += " "
+    def __len__(self):
+        return self._end
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step not in (None, 1):
+                raise ValueError("Streams cannot be sliced with a step")
+            start, stop = index.start, index.stop
+            if start is None:
+                start = self._start
+            elif start < 0:
+                start += self._end
+            if stop is None:
+                stop = self._end
+            elif stop < 0:
+                stop += self._end
+            return self.get_view(start, min(stop, self._end))
+
+        if index < 0:
+            index += self._end
+        if not self._start <= index < self._end:
+            raise IndexError("Stream offset %u is not available" % index)
+        return self.get_view(index, index + 1)[0]
+
+    def get_view(self, start, stop):
+        """Return the bytes from offset 'start' up to 'stop'.
+
+        This is a memoryview if they're in a single block, or a copy
+        otherwise.  Raises IndexError if they've been discarded."""
+
+        if start < self._start:
+            raise IndexError("Stream offset %u has been discarded "
+                             "(oldest is %u)" % (start, self._start))
+        if stop <= start:
+            return memoryview(b"")
+
+        i = bisect.bisect_right(self._starts, start) - 1
+        blockStart = self._starts[i]
+        block = self._blocks[i]
+        if stop <= blockStart + len(block):
+            return memoryview(block)[start - blockStart:stop - blockStart]
+
+        parts = []
+        while start < stop:
+            block = self._blocks[i]
+            blockStart = self._starts[i]
+            end = min(stop, blockStart + len(block))
+            parts.append(block[start - blockStart:end - blockStart])
+            start = end
+            i += 1
+        return memoryview(b"".join(parts))
+
+    def find(self, sub, start=None, stop=None):
+        """Return the offset of the first 'sub' in the stream between
+        'start' and 'stop', or -1."""
+
+        start = self._start if start is None else max(start, self._start)
+        stop = self._end if stop is None else min(stop, self._end)
+        n = len(sub)
+
+        i = max(0, bisect.bisect_right(self._starts, start) - 1)
+        while i < len(self._blocks) and self._starts[i] < stop:
+            blockStart = self._starts[i]
+            blockEnd = blockStart + len(self._blocks[i])
+
+            # Search within this block, and then across the boundary
+            # with the next.
+            found = self._blocks[i].find(sub, max(start - blockStart, 0),
+                                         min(stop, blockEnd) - blockStart)
+            if found >= 0:
+                return blockStart + found
+
+            if blockEnd < stop and n > 1:
+                lo = max(start, blockEnd - n + 1)
+                found = bytes(self.get_view(lo, min(stop, blockEnd + n - 1)))
+                found = found.find(sub)
+                if found >= 0:
+                    return lo + found
+            i += 1
+        return -1
 
-            s += "  %s|\n" % p
+    __help__ = """Help for byte stream.
 
-        return s
+    stream[start:stop]
+        Returns the bytes between absolute stream offsets 'start' and
+        'stop', as a memoryview.  Negative offsets count back from the
+        end.
 
-    __help__ = """A packet."""
+    get_start()
+        Returns the offset of the oldest byte still kept.
 
+    get_end(), len(stream)
+        Returns the number of bytes sent so far.
 
-class Connection:
-    def __init__(self):
-        self._listener = None
-        self._src = None
-        self._dst = None
-        self._proto = None
-        self._from_c = []
-        self._to_c = []
+    find(sub[, start[, stop]])
+        Returns the offset of the first occurrence of 'sub', or -1.
 
-        
-        return
+    get_retention(), set_retention(n)
+        Get or set the number of most recent bytes kept (None keeps
+        everything)."""
 
 
 class Event:
@@ -240,6 +1483,7 @@ class Event:
 
         self._source = source
         self._type = eventType
+        self._time = time.time()
         self._buffer = None
         self._action = None
         self._context = None
@@ -259,6 +1503,27 @@ class Event:
         """Return the source for this event."""
         return self._source
 
+    def get_time(self):
+        """Return the time this event was created."""
+        return self._time
+
+    def set_time(self, t):
+        """Set the time of this event (for example, when replayed)."""
+        self._time = t
+        return
+
+    def get_packet(self):
+        """Return the Packet carried by this event, if any."""
+        return None
+
+    def get_connection(self):
+        """Return the Connection this event relates to, if any."""
+        return None
+
+    def get_message(self):
+        """Return the decoded Message carried by this event, if any."""
+        return None
+
     def set_type(self, eventType):
         """Set the type of this event.
 
@@ -286,6 +1551,26 @@ class Event:
         self._action(self)
         return
 
+    def retain(self):
+        """Keep this event's packet valid after it has been dispatched.
+
+        Called for events that are kept by the user (for example, at a
+        breakpoint), so that their payload is copied out of the
+        receive buffer pool."""
+
+        packet = self.get_packet()
+        if packet:
+            packet.retain()
+        return
+
+    def release(self):
+        """Release resources held by this event's packet."""
+
+        packet = self.get_packet()
+        if packet:
+            packet.release()
+        return
+
     def set_context(self, context):
         """Set a context associated with this event.
 
@@ -318,6 +1603,9 @@ class ClientReceiveEvent(Event):
         """Get the received packet."""
         return self._packet
 
+    def get_connection(self):
+        return self._packet.get_connection() if self._packet else None
+
     __help__ = """Help for client receive event."""
     
 class ServerReceiveEvent(Event):
@@ -338,6 +1626,9 @@ class ServerReceiveEvent(Event):
         """Get the received packet."""
         return self._packet
 
+    def get_connection(self):
+        return self._packet.get_connection() if self._packet else None
+
     __help__ = """Help for server receive event."""
 
 class AcceptEvent(Event):
@@ -353,26 +1644,346 @@ class AcceptEvent(Event):
     __help__ = """Help for accept event."""
 
 
+class ConnectEvent(Event):
+    def __init__(self, source):
+        super().__init__(source, "connect")
+        self._connection = None
+        return
+
+    def get_description(self):
+        return "connected to %s:%u" % self._connection._dst[:2]
+
+    def get_connection(self):
+        """Get the Connection that was connected."""
+        return self._connection
+
+    __help__ = """Help for connect event."""
+
+
+class ConnectFailedEvent(Event):
+    def __init__(self, source, error):
+        super().__init__(source, "connect_failed")
+        self._connection = None
+        self._error = error
+        return
+
+    def get_description(self):
+        return "connect to %s:%u failed: %s" % (self._connection._dst[:2] +
+                                                (self._error,))
+
+    def get_connection(self):
+        """Get the Connection that failed to connect."""
+        return self._connection
+
+    def get_error(self):
+        """Get the OSError describing the failure."""
+        return self._error
+
+    __help__ = """Help for connect failed event."""
+
+
 class CloseEvent(Event):
-    def __init__(self):
-        super().__init__(self, source, "close")
+    def __init__(self, source):
+        super().__init__(source, "close")
+        self._connection = None
         return
 
+    def get_connection(self):
+        """Get the Connection closed by this event."""
+        return self._connection
+
     __help__ = """Help for close event."""
 
 
+class MessageEvent(Event):
+    """A message decoded from a session's stream (see monjon.decode).
+
+    The event's packet holds the message's bytes, so conditions can
+    use "payload" and "offset" as for received data."""
+
+    def __init__(self, source, eventType, message, connection):
+        super().__init__(source, eventType)
+        self._message = message
+        self._packet = Packet(message.get_bytes(), connection)
+        self._packet.set_offset(message.get_start())
+        return
+
+    def get_description(self):
+        return "%s, %u bytes at stream offset %u" % (
+            self._type, len(self._message), self._message.get_start())
+
+    def get_message(self):
+        """Get the decoded message."""
+        return self._message
+
+    def get_packet(self):
+        """Get a packet holding the message's bytes."""
+        return self._packet
+
+    def get_connection(self):
+        return self._packet.get_connection()
+
+    __help__ = """Help for message event.
+
+    get_message()
+        Returns the decoded message: see help() for its fields."""
+
+
+class EventQueue:
+    """Queue of events waiting to be dispatched.
+
+    Each source has its own FIFO lane, and get() takes one event from
+    each non-empty lane in turn.  Events from a single source are
+    returned in the order they were queued, but a busy source cannot
+    starve the others: a small interactive session waits for at most
+    one event from each other active source.
+
+    Both put() and get() are O(1)."""
+
+    def __init__(self):
+        # Table of {source: deque of events}, for non-empty lanes only.
+        self._lanes = {}
+
+        # Round-robin order of sources with queued events.
+        self._ready = collections.deque()
+
+        # Total number of queued events.
+        self._length = 0
+        return
+
+    def __len__(self):
+        return self._length
+
+    def put(self, event):
+        """Append an event to its source's lane."""
+
+        source = event.get_source()
+        lane = self._lanes.get(source)
+        if lane is None:
+            lane = collections.deque()
+            self._lanes[source] = lane
+            self._ready.append(source)
+
+        lane.append(event)
+        self._length += 1
+        return
+
+    def get(self):
+        """Remove and return the next event, in round-robin order."""
+
+        source = self._ready.popleft()
+        lane = self._lanes[source]
+        event = lane.popleft()
+        self._length -= 1
+
+        if lane:
+            self._ready.append(source)
+        else:
+            del self._lanes[source]
+        return event
+
+    def get_depth(self, source=None):
+        """Return the number of events queued for 'source', or in total."""
+
+        if source is None:
+            return self._length
+
+        lane = self._lanes.get(source)
+        return len(lane) if lane else 0
+
+    def get_depths(self):
+        """Return a table of {source: queued event count}."""
+        return dict((source, len(lane)) for source, lane in self._lanes.items())
+
+
+class Timer:
+    """A callback scheduled on a TimerWheel."""
+
+    __slots__ = ("_expires", "_callback", "_args", "_cancelled")
+
+    def __init__(self, expires, callback, args):
+        self._expires = expires
+        self._callback = callback
+        self._args = args
+        self._cancelled = False
+        return
+
+    def cancel(self):
+        """Stop the callback from being called."""
+        self._cancelled = True
+        return
+
+    def cancelled(self):
+        """Return True if the timer has been cancelled."""
+        return self._cancelled
+
+
+class TimerWheel:
+    """Hierarchical timing wheel, for scheduling many callbacks cheaply.
+
+    Time is counted in ticks of 'tick' seconds.  The wheel has LEVELS
+    levels of SLOTS slots: a timer due within SLOTS ticks goes in the
+    slot for its tick on the first level, one due within SLOTS**2
+    ticks in a slot of the second level, covering SLOTS ticks, and so
+    on.  As time reaches a slot of a higher level, its timers are
+    moved down to the level below.  Scheduling and cancelling are
+    O(1), and each timer is moved at most LEVELS - 1 times.
+
+    Timers due further ahead than the wheel covers (about 4.6 hours
+    with 1 ms ticks) wait in the last slot reached, and are moved down
+    again each time it comes round."""
+
+    BITS = 6
+    SLOTS = 1 << BITS
+    LEVELS = 4
+
+    def __init__(self, tick=0.001):
+        self._tick = tick
+        self._current = int(time.monotonic() / tick)
+        self._wheels = [[[] for i in range(self.SLOTS)]
+                        for level in range(self.LEVELS)]
+
+        # Timers scheduled (including any cancelled, until they're
+        # removed).
+        self._count = 0
+        return
+
+    def __len__(self):
+        return self._count
+
+    def get_tick(self):
+        """Return the length of a tick, in seconds."""
+        return self._tick
+
+    def schedule(self, delay, callback, *args):
+        """Call 'callback(*args)' after 'delay' seconds.
+
+        The delay is rounded up to a whole tick.  Returns a Timer,
+        which can be cancelled."""
+
+        expires = -int(-(time.monotonic() + delay) // self._tick)
+        if expires <= self._current:
+            expires = self._current + 1
+        timer = Timer(expires, callback, args)
+        self._add(timer)
+        self._count += 1
+        return timer
+
+    def _add(self, timer):
+        """Put 'timer' in the slot for its expiry time."""
+
+        ticks = timer._expires - self._current
+        expires = timer._expires
+        for level in range(self.LEVELS):
+            if ticks < self.SLOTS << (self.BITS * level):
+                break
+        else:
+            # Beyond the wheel: the furthest slot from now.
+            expires = self._current + (1 << (self.BITS * self.LEVELS)) - 1
+
+        slot = (expires >> (self.BITS * level)) & (self.SLOTS - 1)
+        self._wheels[level][slot].append(timer)
+        return
+
+    def _cascade(self, level):
+        """Move the timers in the current slot of 'level' down."""
+
+        slot = (self._current >> (self.BITS * level)) & (self.SLOTS - 1)
+        timers = self._wheels[level][slot]
+        self._wheels[level][slot] = []
+        for timer in timers:
+            if timer._cancelled:
+                self._count -= 1
+            else:
+                self._add(timer)
+        return slot
+
+    def advance(self):
+        """Call the callbacks of timers that have expired."""
+
+        target = int(time.monotonic() / self._tick)
+        if not self._count:
+            self._current = max(self._current, target)
+            return
+
+        mask = self.SLOTS - 1
+        wheel = self._wheels[0]
+        while self._current < target and self._count:
+            self._current += 1
+            slot = self._current & mask
+
+            # Starting a new round of the first level: move timers down
+            # from the levels above.
+            if slot == 0:
+                for level in range(1, self.LEVELS):
+                    if self._cascade(level) != 0:
+                        break
+
+            timers = wheel[slot]
+            if not timers:
+                continue
+            wheel[slot] = []
+            for timer in timers:
+                self._count -= 1
+                if not timer._cancelled:
+                    timer._callback(*timer._args)
+
+        self._current = max(self._current, target)
+        return
+
+    def get_timeout(self):
+        """Return the seconds until advance() next has work to do, or
+        None if there are no timers."""
+
+        if not self._count:
+            return None
+
+        # The next occupied slot in this round of the first level, or
+        # else the start of the next round, when timers are moved down.
+        mask = self.SLOTS - 1
+        wheel = self._wheels[0]
+        tick = self._current + 1
+        while tick & mask and not wheel[tick & mask]:
+            tick += 1
+        return max(0.0, tick * self._tick - time.monotonic())
+
+
 class Dispatcher:
     """Processor for debugger events.
 
     The Dispatcher is the heart of monjon.  It works basically as a
     main loop, in two phases: in the first phase, it creates a set of
-    Events by calling select() (or similar); in the second phase,
-    these Events are processed.
+    Events by polling its sources' sockets; in the second phase, these
+    Events are processed.
+
+    Sockets are registered with the Poller once, when their source is
+    registered, rather than being collected on every pass.
     """
 
-    def __init__(self):
+    def __init__(self, poller=None):
+        # Socket readiness poller.
+        self._poller = poller if poller else create_poller()
+
+        # Receive buffers, shared by all sources.
+        self._bufferPool = BufferPool()
+
+        # Recorded traffic, if enabled.
+        self._history = None
+
+        # Capture sinks: each is given every event as it's dispatched.
+        self._captures = []
+
+        # Sources which generate events without sockets.
+        self._generators = []
+
+        # Poll timeout, in seconds (None blocks until ready).
+        self._timeout = None
+
+        # Callbacks scheduled with call_later().
+        self._timers = TimerWheel()
+
         # Queue of events to be processed
-        self._queue = []
+        self._queue = EventQueue()
 
         # Source identifiers
         self._nextSource = 0
@@ -383,6 +1994,9 @@ class Dispatcher:
         # Table of {socket: source}
         self._sourceSockets = {}
 
+        # Table of {socket: poller interest mask}
+        self._interest = {}
+
         # Breakpoint identifiers
         self._nextBreakpoint = 0
 
@@ -392,14 +2006,43 @@ class Dispatcher:
         # Table of {id: breakpoint}
         self._breakpointIds = {}
 
-        # Watchpoint
+        # Watchpoint identifiers
+        self._nextWatchpoint = 0
+
+        # Table of {id: watchpoint}
         self._watchpoints = {}
 
+        # Table of {(source, event_type): [watchpoint, ...]}, and set
+        # of (source, event_type) pairs whose sessions' events are
+        # watched.
+        self._watches = {}
+        self._childWatches = set()
+
         # Listener
         self._listener = None
 
-        # Loop control.
+        # Set of (source, event_type) pairs with a breakpoint, and set
+        # of event types with a global breakpoint.  Sources consult
+        # these (via wants_event()) to decide whether they need to
+        # create and queue an Event at all.
+        self._interesting = set()
+        self._interestingTypes = set()
+
+        # Loop control.  stop() also sets _stopping, so that a _step()
+        # waiting for events (from a timer, say) returns.
         self._run = False
+        self._stopping = False
+
+        # True while single-stepping, when every event is wanted.
+        self._stepping = False
+
+        # Counters for all dispatched events.
+        self._stats = SourceStats()
+
+        # DispatchHooks (None, rather than empty, when there are none),
+        # and what the Dispatcher is doing, while there are any.
+        self._hooks = None
+        self._phase = None
         return
 
     def register_source(self, source):
@@ -413,40 +2056,126 @@ class Dispatcher:
         source.set_name(self._nextSource)
         self._nextSource += 1
 
-        # Associate its sockets with the source.
+        # Associate its sockets with the source, and start polling them.
         for s in source.get_sockets():
             self._sourceSockets[s] = source
+            self._interest[s] = POLL_READ
+            self._poller.register(s, POLL_READ)
+        return
+
+    def add_generator(self, source):
+        """Add a source whose generate() method is called for events.
+
+        This is for sources (such as capture replays) whose events
+        don't come from sockets."""
+
+        self._generators.append(source)
+        return
+
+    def remove_generator(self, source):
+        """Stop calling a source's generate() method."""
+
+        if source in self._generators:
+            self._generators.remove(source)
         return
 
     def deregister_source(self, source):
         """Remove a source from the dispatcher."""
 
-        # Remove sockets from table.
+        # Remove sockets from table and poller.
         for s in source.get_sockets():
             if s in self._sourceSockets.keys():
                 del self._sourceSockets[s]
+                del self._interest[s]
+                self._poller.unregister(s)
 
         # Remove from sources table.
         name = source.get_name()
         del self._sources[name]
         return
 
+    def set_interest(self, sock, events):
+        """Set the poller interest mask for a registered source's socket.
+
+        'events' is a combination of POLL_READ and POLL_WRITE.  Sources
+        should only ask for POLL_WRITE while they have data waiting to
+        be sent, otherwise the poller will report them as ready on
+        every pass."""
+
+        if self._interest.get(sock, events) != events:
+            self._interest[sock] = events
+            self._poller.modify(sock, events)
+        return
+
+    def get_buffer_pool(self):
+        """Return the BufferPool for sources' receive buffers."""
+        return self._bufferPool
+
+    def set_history(self, history):
+        """Set the TrafficHistory used to record traffic, or None."""
+
+        if self._history and self._history is not history:
+            self._history.close()
+        self._history = history
+        return
+
+    def get_history(self):
+        """Return the TrafficHistory, or None if not recording."""
+        return self._history
+
+    def add_capture(self, capture):
+        """Add a capture sink.
+
+        'capture' must have an on_event(event) method, which is called
+        for every dispatched event before its action is performed.
+        While any capture is attached, all events are queued rather
+        than taking the fast path."""
+
+        self._captures.append(capture)
+        return
+
+    def remove_capture(self, capture):
+        """Remove a capture sink."""
+
+        if capture in self._captures:
+            self._captures.remove(capture)
+        return
+
+    def get_captures(self):
+        """Return the list of attached capture sinks."""
+        return list(self._captures)
+
     def get_sources(self):
         """Return a reference to the sources table."""
 
         # FIXME: make read-only
         return self._sources
 
-    def set_breakpoint(self, source, event, condition):
-        """Set a breakpoint for an event on a source matching a condition."""
+    def set_breakpoint(self, source, event, condition, match=None):
+        """Set a breakpoint for an event on a source matching a condition.
+
+        If 'match' is a list of patterns (see monjon.match), the
+        breakpoint only matches payloads in which one of them is
+        found, including across the boundaries between payloads.
+
+        Raises SyntaxError if the condition cannot be compiled, and
+        TypeError or ValueError for an invalid pattern."""
+
+        bp = Breakpoint(self, self._nextBreakpoint, source, event,
+                        condition, match)
 
         if source not in self._breakpoints.keys():
             self._breakpoints[source] = {}
 
-        bp = Breakpoint(self, self._nextBreakpoint, source, event, condition)
+        # Replace any existing breakpoint for this source and event.
+        old = self._breakpoints[source].get(event)
+        if old:
+            del self._breakpointIds[old.get_name()]
+
         self._breakpoints[source][event] = bp
         self._breakpointIds[self._nextBreakpoint] = bp
         self._nextBreakpoint += 1
+        self._update_interesting()
 
         if self._listener:
             self._listener.on_set_breakpoint(bp)
@@ -460,15 +2189,93 @@ class Dispatcher:
 
         del self._breakpointIds[breakpoint.get_name()]
         del self._breakpoints[breakpoint.get_source()][breakpoint.get_event()]
+        self._update_interesting()
         return
 
+    def _update_interesting(self):
+        """Recalculate the tables consulted by wants_event()."""
+
+        self._interesting = set()
+        self._interestingTypes = set()
+        for source, table in self._breakpoints.items():
+            for eventType in table.keys():
+                if source is None:
+                    self._interestingTypes.add(str(eventType))
+                else:
+                    self._interesting.add((source, str(eventType)))
+        self._interesting.update(self._watches.keys())
+        return
+
+    def wants_event(self, source, eventType):
+        """Return True if 'source' must queue an event of 'eventType'.
+
+        If not, nothing could break on it, and the source is free to
+        perform the event's action immediately, without creating an
+        Event.  Events are always wanted while single-stepping or
+        capturing, and while the source has earlier events still
+        queued (so that its actions stay in order)."""
+
+        return (self._stepping or
+                bool(self._captures) or
+                eventType in self._interestingTypes or
+                (source, eventType) in self._interesting or
+                (self._childWatches and
+                 (source._parent, eventType) in self._childWatches) or
+                self._queue.get_depth(source) > 0)
+
     def get_breakpoints(self):
         """Return a reference to the breakpoints table."""
 
         # FIXME: make read-only
         return self._breakpointIds
 
-    def set_watchpoint(self, source, condition, value):
+    def set_watchpoint(self, source, expression):
+        """Watch the value of an expression over a source's state.
+
+        Returns the new Watchpoint.  Raises SyntaxError if the
+        expression cannot be compiled."""
+
+        if source is None:
+            raise ValueError("A watchpoint needs a source")
+
+        wp = Watchpoint(self, self._nextWatchpoint, source, expression)
+        self._watchpoints[self._nextWatchpoint] = wp
+        self._nextWatchpoint += 1
+        self._update_watches()
+        return wp
+
+    def clear_watchpoint(self, watchpoint):
+        """Remove a watchpoint from the dispatcher."""
+
+        del self._watchpoints[watchpoint.get_name()]
+        self._update_watches()
+        return
+
+    def get_watchpoints(self):
+        """Return a reference to the watchpoints table."""
+        return self._watchpoints
+
+    def _update_watches(self):
+        """Recalculate the tables of watched events."""
+
+        self._watches = {}
+        for wp in self._watchpoints.values():
+            for eventType in wp.get_events():
+                key = (wp.get_source(), eventType)
+                self._watches.setdefault(key, []).append(wp)
+        self._childWatches = set(self._watches.keys())
+        self._update_interesting()
+        return
+
+    def _check_watchpoints(self, event):
+        """Re-evaluate the watchpoints 'event' could affect."""
+
+        source = event.get_source()
+        eventType = str(event.get_type())
+        for key in ((source, eventType), (source._parent, eventType)):
+            for wp in self._watches.get(key, ()):
+                if wp.check(event) and self._listener:
+                    self._listener.on_watch(wp, wp.get_value(), event)
         return
 
     def set_listener(self, listener):
@@ -478,18 +2285,44 @@ class Dispatcher:
         self._listener = listener
         return
 
+    def call_later(self, delay, callback, *args):
+        """Call 'callback(*args)' after 'delay' seconds.
+
+        Timers are kept in a TimerWheel, with a resolution of 1 ms, and
+        called while the Dispatcher is waiting for events, so they can
+        queue events or perform actions.  Returns a Timer, which can be
+        cancelled."""
+        return self._timers.schedule(delay, callback, *args)
+
+    def get_timer_count(self):
+        """Return the number of timers waiting."""
+        return len(self._timers)
+
     def queue_event(self, event):
         """Queue an event for processing."""
-        self._queue.append(event)
+        self._queue.put(event)
+        return
+
+    def queue_events(self, events):
+        """Queue a batch of events for processing, in order."""
+
+        put = self._queue.put
+        for event in events:
+            put(event)
         return
 
+    def get_queue_depth(self, source=None):
+        """Return the number of queued events for 'source', or in total."""
+        return self._queue.get_depth(source)
+
     def run(self):
         """Gather and process events until breakpoint or C-c"""
 
         self._run = True
-        
+        self._stopping = False
+
         try:
-            while self._run and self.step():
+            while self._run and self._step():
                 pass
         except KeyboardInterrupt:
             pass
@@ -498,26 +2331,76 @@ class Dispatcher:
 
     def stop(self):
         self._run = False
+        self._stopping = True
         return
 
     def step(self):
-        """Process one event, first gathering more if required."""
+        """Process one event, first gathering more if required.
 
-        try:
-            while len(self._queue) < 1:
-                #FIXME: this should be plugged in from cli/gui/robot/etc
-                l = self._sourceSockets.keys()
-                r, w, x = select.select(l, l, [], 0)
+        While stepping, sources queue every event, rather than using
+        the breakpoint-free fast path."""
 
-                for sock in r:
-                    source = self._sourceSockets.get(sock)
-                    if source:
-                        source.on_readable(sock)
+        self._stepping = True
+        self._stopping = False
+        try:
+            return self._step()
+        finally:
+            self._stepping = False
+
+    def _generate(self):
+        """Ask generators for events, and return the poll timeout.
+
+        Expired timers (see call_later()) are called first.  The
+        timeout is no longer than the generators and timers need, and
+        zero if they've queued events."""
+
+        timeout = self._timeout
+
+        # Expired timers, and when the next is due.
+        if self._timers:
+            self._timers.advance()
+            delay = self._timers.get_timeout()
+            if delay is not None and (timeout is None or delay < timeout):
+                timeout = delay
+
+        for source in list(self._generators):
+            delay = source.generate()
+            if delay is None:
+                continue
+            if timeout is None or delay < timeout:
+                timeout = delay
+
+        if len(self._queue) > 0:
+            timeout = 0
+        return timeout
+
+    def _handle_ready(self, ready):
+        """Call sources back for a list of ready sockets."""
+
+        for sock, readable, writeable in ready:
+            # Look up the source each time: an earlier callback in this
+            # batch may have deregistered it.
+            if readable:
+                source = self._sourceSockets.get(sock)
+                if source:
+                    source.on_readable(sock)
+
+            if writeable:
+                source = self._sourceSockets.get(sock)
+                if source:
+                    source.on_writeable(sock)
+        return
 
-                for sock in w:
-                    source = self._sourceSockets.get(sock)
-                    if source:
-                        source.on_writeable(sock)
+    def _step(self):
+        try:
+            while len(self._queue) < 1:
+                if self._stopping:
+                    self._stopping = False
+                    return False
+                if self._hooks is not None:
+                    self._poll_hooked()
+                    continue
+                self._handle_ready(self._poller.poll(self._generate()))
 
         except KeyboardInterrupt:
             # We got a C-c during select: just return to the command
@@ -525,34 +2408,257 @@ class Dispatcher:
             return False
 
         # Process first waiting event
-        event = self._queue.pop(0)
+        event = self._queue.get()
         self.dispatch(event)
         return True
 
     def dispatch(self, event):
-        # Check for breakpoints
+        if self._hooks is not None:
+            return self._dispatch_hooked(event)
+
+        start = time.perf_counter()
+        self._check_breakpoints(event)
+
+        for capture in self._captures:
+            capture.on_event(event)
+
+        event.perform_action()
+        if self._watches:
+            self._check_watchpoints(event)
+        event.release()
+
+        self._count(event.get_source(), time.perf_counter() - start)
+        return
+
+    def _check_breakpoints(self, event):
+        """Break if a breakpoint matches 'event'."""
+
         source = event.get_source()
         eventType = event.get_type()
         
-        if source in self._breakpoints.keys():
-            if eventType in self._breakpoints[source].keys():
-                if True: # FIXME: evaluate conditional
-                    self.do_break(self._breakpoints[source][eventType], event)
+        # Source-specific breakpoints take precedence over global ones.
+        bp = self._breakpoints.get(source, {}).get(eventType)
+        if bp and bp.matches(event):
+            # The global breakpoint doesn't get to break, but its
+            # patterns' stream must still see the payload.
+            other = self._breakpoints.get(None, {}).get(eventType)
+            if other and other._matcher is not None:
+                other.scan(event)
+            self.do_break(bp, event)
+            return
+
+        bp = self._breakpoints.get(None, {}).get(eventType)
+        if bp and bp.matches(event):
+            self.do_break(bp, event)
+        return
+
+    def _count(self, source, elapsed):
+        """Count a dispatched event, and the time it took."""
+
+        stats = self._stats
+        stats.events += 1
+        stats.dispatchTime += elapsed
+        stats = getattr(source, "_stats", None)
+        if stats:
+            stats.events += 1
+            stats.dispatchTime += elapsed
+        return
+
+    def add_hooks(self, hooks):
+        """Add DispatchHooks, called around each poll and dispatch.
+
+        While there are none, checking for them costs one attribute
+        test per poll and per dispatch."""
+
+        if self._hooks is None:
+            self._hooks = []
+        self._hooks.append(hooks)
+        return
+
+    def remove_hooks(self, hooks):
+        """Remove DispatchHooks added with add_hooks()."""
+
+        if self._hooks and hooks in self._hooks:
+            self._hooks.remove(hooks)
+        if not self._hooks:
+            self._hooks = None
+        return
+
+    def get_phase(self):
+        """Return what the Dispatcher is doing, while hooks are added.
+
+        One of "poll" (waiting for sockets), "io" (sources handling
+        ready sockets, including fast-path forwarding), "match"
+        (checking breakpoints), "capture", "action", or None."""
+        return self._phase
+
+    def _poll_hooked(self):
+        """Poll and handle ready sockets, timing each part."""
+
+        hooks = self._hooks
+        timeout = self._generate()
+        self._phase = "poll"
+        t0 = time.perf_counter()
+        ready = self._poller.poll(timeout)
+        t1 = time.perf_counter()
+        self._phase = "io"
+        self._handle_ready(ready)
+        t2 = time.perf_counter()
+        self._phase = None
+
+        for h in hooks:
+            h.on_poll(len(ready), t1 - t0, t2 - t1)
+        return
+
+    def _dispatch_hooked(self, event):
+        """Dispatch 'event', timing each phase for the hooks."""
+
+        hooks = self._hooks
+        for h in hooks:
+            h.pre_dispatch(event)
 
-        elif None in self._breakpoints.keys():
-            if eventType in self._breakpoints[None].keys():
-                if True:  # FIXME: evaluate conditional
-                    self.do_break(self._breakpoints[None][eventType], event)
+        self._phase = "match"
+        t0 = time.perf_counter()
+        self._check_breakpoints(event)
+        t1 = time.perf_counter()
 
+        self._phase = "capture"
+        for capture in self._captures:
+            capture.on_event(event)
+        t2 = time.perf_counter()
+
+        self._phase = "action"
         event.perform_action()
+        t3 = time.perf_counter()
+
+        # Watchpoints are counted as matching.
+        self._phase = "match"
+        if self._watches:
+            self._check_watchpoints(event)
+        t4 = time.perf_counter()
+        self._phase = None
+
+        self._count(event.get_source(), t4 - t0)
+
+        # Release only after the hooks have seen the event.
+        for h in hooks:
+            h.post_dispatch(event, t1 - t0 + t4 - t3, t2 - t1, t3 - t2)
+        event.release()
         return
 
-    def do_break(self, breakpoint, event):
-        # Run watchpoints
-        for wp in self._watchpoints:
-            self._listener.on_watch(wp, event)
+    def get_stats(self, source=None):
+        """Return a dictionary of counters for 'source', or in total.
+
+        A source's counters include the number of events queued for it,
+        and for a listener, its open sessions.  The totals are for the
+        Dispatcher's events, and the traffic of every source that's not
+        part of another (so closed sessions are counted in their
+        listener)."""
+
+        if source is not None:
+            values = source.get_stats().get_values()
+            values["queued"] = self.get_queue_depth(source)
+            if hasattr(source, "get_sessions"):
+                values["sessions"] = len([s for s in source.get_sessions()
+                                          if s.get_state() != "closed"])
+            return values
+
+        total = SourceStats()
+        for s in self._sources.values():
+            stats = getattr(s, "_stats", None)
+            if stats and stats.get_parent() is None:
+                total.add(stats)
+        total.events = self._stats.events
+        total.dispatchTime = self._stats.dispatchTime
+
+        values = total.get_values()
+        stats = self._stats
+        values["events_per_s"] = stats.get_values()["events_per_s"]
+        values["uptime"] = time.time() - stats._created
+        values["queued"] = self.get_queue_depth()
+        values["sources"] = len(self._sources)
+        return values
 
-        # Run breakpoint
+    def do_break(self, breakpoint, event):
         self._listener.on_break(breakpoint, event)
         return
-        
+
+
+class AsyncioDispatcher(Dispatcher):
+    """Dispatcher driven by an asyncio event loop.
+
+    This behaves exactly like Dispatcher: step() and run() drive the
+    loop until events are available, and then process them.  Because
+    sockets are watched by the loop, timers (see call_later()) and
+    other tasks on the same loop run while the Dispatcher waits.
+
+    If the loop is already running (for example, in another asyncio
+    application), use the serve() coroutine instead of run().
+
+    'loop' is the event loop to use; by default a new one is created,
+    using uvloop if 'uvloop' is True."""
+
+    # Events to process in serve() before yielding to other tasks.
+    SERVE_BATCH = 64
+
+    def __init__(self, loop=None, uvloop=False):
+        if loop is None:
+            if uvloop:
+                import uvloop as _uvloop
+                loop = _uvloop.new_event_loop()
+            else:
+                loop = asyncio.new_event_loop()
+
+        super().__init__(AsyncioPoller(loop))
+        self._loop = loop
+        return
+
+    def get_loop(self):
+        """Return the asyncio event loop."""
+        return self._loop
+
+    def call_later(self, delay, callback, *args):
+        """Call 'callback' after 'delay' seconds, from the event loop.
+
+        Returns an asyncio.TimerHandle, which can be cancelled.  Any
+        events the callback queues are processed as usual."""
+
+        def fire():
+            callback(*args)
+            self._poller.wake()
+            return
+
+        return self._loop.call_later(delay, fire)
+
+    def stop(self):
+        super().stop()
+        self._poller.wake()
+        return
+
+    async def serve(self):
+        """Coroutine which processes events until stop() is called.
+
+        Yields to other tasks while waiting for events, and after every
+        SERVE_BATCH events."""
+
+        self._run = True
+        self._stopping = False
+        n = 0
+        while self._run:
+            while self._run and len(self._queue) < 1:
+                self._handle_ready(await self._poller.wait(self._generate()))
+
+            if len(self._queue) < 1:
+                break
+            self.dispatch(self._queue.get())
+            n += 1
+            if n % self.SERVE_BATCH == 0:
+                await asyncio.sleep(0)
+        return
+
+    def close(self):
+        """Close the event loop."""
+
+        self._poller.close()
+        self._loop.close()
+        return
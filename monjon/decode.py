@@ -0,0 +1,581 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import re
+
+
+class Message:
+    """A message framed from a stream by a Decoder.
+
+    The message's bytes are a view of the stream, taken when it's
+    framed, so they stay valid however the stream is trimmed later.
+    Fields are decoded from them only when asked for, and then kept:
+    a message nobody looks at costs only its framing."""
+
+    def __init__(self, stream, start, end):
+        self._start = start
+        self._end = end
+        self._bytes = stream.get_view(start, end)
+
+        # Description of a framing error, if the message is malformed.
+        self._error = None
+        return
+
+    def get_start(self):
+        """Return the stream offset of the message's first byte."""
+        return self._start
+
+    def get_end(self):
+        """Return the stream offset just after the message."""
+        return self._end
+
+    def get_bytes(self):
+        """Return the whole message, as a memoryview."""
+        return self._bytes
+
+    def get_error(self):
+        """Return a description of the message's framing error, or
+        None if it was framed correctly."""
+        return self._error
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __repr__(self):
+        return "<%s: %u bytes at %u>" % (self.__class__.__name__,
+                                         len(self), self._start)
+
+    __help__ = """Help for message.
+
+    get_bytes()
+        Returns the message's bytes, as a memoryview.
+
+    get_start(), get_end()
+        Return the stream offsets of the start and end of the
+        message.
+
+    get_error()
+        Returns a description of the error which stopped the message
+        being framed correctly, or None."""
+
+
+class Decoder:
+    """Base class for protocol decoders.
+
+    A decoder frames a session's streams into messages, which are
+    queued as events of its event types, so breakpoints can be set
+    on them and their conditions can refer to the message's fields.
+    Decoders are attached with set_decoder() on a TCP listener or
+    session.
+
+    The same decoder is used for every session of a listener, so any
+    state needed to frame a stream is kept in an object created by
+    new_state(), one for each direction.  Framing is incremental:
+    frame() is called as data arrives, and should use its state to
+    avoid scanning data it has already looked at.  Fields are only
+    decoded by the Message when asked for.
+
+    'direction' is "server" for data received for the server (from
+    the client), or "client" for data received for the client."""
+
+    # Event type of messages in each direction.
+    EVENTS = {"server": "message", "client": "message"}
+
+    def get_event_type(self, direction):
+        """Return the event type for messages in 'direction'."""
+        return self.EVENTS[direction]
+
+    def new_state(self, direction):
+        """Return the framing state for a new stream."""
+        return None
+
+    def frame(self, stream, start, state):
+        """Find the end of the message starting at offset 'start'.
+
+        Returns the offset just after the message, or None if it's
+        not complete yet, in which case frame() is called again with
+        the same 'start' when more data arrives.  Once a message is
+        framed, 'state' should be ready for the next one."""
+        return None
+
+    def finish(self, stream, start, state):
+        """Return the end of a message ended by the stream closing, or
+        None."""
+        return None
+
+    def get_message(self, stream, start, end, state):
+        """Return the Message framed between 'start' and 'end', or None
+        if the data isn't a message (and no event is queued for it)."""
+        return Message(stream, start, end)
+
+    __help__ = """Help for decoder.
+
+    A decoder frames the data of a session into messages.  To decode
+    another protocol, subclass Decoder and define
+
+    EVENTS
+        A dictionary of the event type for messages received for the
+        "server" and for the "client".
+
+    new_state(direction)
+        Returns an object to keep the framing state of one stream.
+
+    frame(stream, start, state)
+        Returns the offset of the end of the message starting at
+        'start', or None if more data is needed.  Use 'state' to
+        avoid scanning the same data again.
+
+    finish(stream, start, state)
+        Returns the end of a message ended by the stream closing.
+
+    get_message(stream, start, end, state)
+        Returns a Message subclass, whose methods decode its fields
+        when they're asked for, or None to skip the data."""
+
+
+########################################################################
+# Line-based protocols
+
+class Line(Message):
+    """A line of text, without its delimiter."""
+
+    def __init__(self, stream, start, end, delimiter):
+        super().__init__(stream, start, end)
+        self._delimiter = delimiter
+        return
+
+    def get_line(self):
+        """Return the line, without the delimiter, as a memoryview."""
+        return self._bytes[:len(self._bytes) - len(self._delimiter)]
+
+    def get_text(self, encoding="utf-8"):
+        """Return the line, without the delimiter, as a string."""
+        return bytes(self.get_line()).decode(encoding, "replace")
+
+    __help__ = Message.__help__ + """
+
+    get_line()
+        Returns the line, without its delimiter, as a memoryview.
+
+    get_text([encoding])
+        Returns the line as a string."""
+
+
+class LineDecoder(Decoder):
+    """Frames a stream into lines, ending with 'delimiter'."""
+
+    EVENTS = {"server": "line", "client": "line"}
+
+    def __init__(self, delimiter=b"\n"):
+        self._delimiter = delimiter
+        return
+
+    def new_state(self, direction):
+        # Offset to resume searching from.
+        return [0]
+
+    def frame(self, stream, start, state):
+        n = len(self._delimiter)
+        i = stream.find(self._delimiter, max(start, state[0] - n + 1))
+        if i < 0:
+            state[0] = stream.get_end()
+            return None
+        state[0] = i + n
+        return i + n
+
+    def get_message(self, stream, start, end, state):
+        return Line(stream, start, end, self._delimiter)
+
+
+########################################################################
+# Length-prefixed protocols
+
+class Frame(Message):
+    """A message with a length field."""
+
+    def __init__(self, stream, start, end, length, header):
+        super().__init__(stream, start, end)
+        self._length = length
+        self._header = header
+        return
+
+    def get_length(self):
+        """Return the value of the length field."""
+        return self._length
+
+    def get_header(self):
+        """Return the bytes up to the end of the length field."""
+        return self._bytes[:self._header]
+
+    def get_body(self):
+        """Return the bytes after the length field."""
+        return self._bytes[self._header:]
+
+    __help__ = Message.__help__ + """
+
+    get_length()
+        Returns the value of the length field.
+
+    get_header(), get_body()
+        Return the bytes up to, and after, the end of the length
+        field."""
+
+
+class LengthPrefixDecoder(Decoder):
+    """Frames a stream into messages with a length field.
+
+    The length field is 'size' bytes, in 'byteorder', at 'offset'
+    from the start of each message.  The message continues for the
+    field's value plus 'adjust' bytes after the end of the field: if
+    the value counts the header too, use a negative 'adjust'."""
+
+    EVENTS = {"server": "frame", "client": "frame"}
+
+    def __init__(self, size=4, byteorder="big", offset=0, adjust=0):
+        self._size = size
+        self._byteorder = byteorder
+        self._offset = offset
+        self._adjust = adjust
+        return
+
+    def frame(self, stream, start, state):
+        header = self._offset + self._size
+        if stream.get_end() < start + header:
+            return None
+
+        length = int.from_bytes(stream.get_view(start + self._offset,
+                                                start + header),
+                                self._byteorder)
+        end = start + header + max(0, length + self._adjust)
+        if stream.get_end() < end:
+            return None
+        return end
+
+    def get_message(self, stream, start, end, state):
+        header = self._offset + self._size
+        length = int.from_bytes(stream.get_view(start + self._offset,
+                                                start + header),
+                                self._byteorder)
+        return Frame(stream, start, end, length, header)
+
+
+########################################################################
+# HTTP/1.1
+
+class HttpMessage(Message):
+    """An HTTP/1.1 request or response.
+
+    The start line and headers are only parsed when one of them is
+    asked for.  The body is as sent: if the message uses chunked
+    transfer coding, get_body() includes the chunk sizes."""
+
+    def __init__(self, stream, start, end, headerEnd):
+        super().__init__(stream, start, end)
+        self._headerEnd = headerEnd - start
+        self._startLine = None
+        self._headers = None
+        return
+
+    def _parse(self):
+        """Parse the start line and headers."""
+
+        head = bytes(self._bytes[:self._headerEnd - 4]).decode("latin-1")
+        lines = head.split("\r\n")
+        self._startLine = lines[0].split(" ", 2)
+        self._headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            self._headers.append((name.strip(), value.strip()))
+        return
+
+    def get_start_line(self):
+        """Return the fields of the first line, as a list of strings."""
+
+        if self._startLine is None:
+            self._parse()
+        return self._startLine
+
+    def get_headers(self):
+        """Return the headers, as a list of (name, value) pairs."""
+
+        if self._headers is None:
+            self._parse()
+        return self._headers
+
+    def get_header(self, name, default=None):
+        """Return the value of the first header called 'name' (ignoring
+        case), or 'default'."""
+
+        name = name.lower()
+        for n, value in self.get_headers():
+            if n.lower() == name:
+                return value
+        return default
+
+    def get_body(self):
+        """Return the body, as a memoryview."""
+        return self._bytes[self._headerEnd:]
+
+    __help__ = Message.__help__ + """
+
+    get_headers()
+        Returns the headers, as a list of (name, value) pairs.
+
+    get_header(name[, default])
+        Returns the value of a header.
+
+    get_body()
+        Returns the body, as a memoryview."""
+
+
+class HttpRequest(HttpMessage):
+
+    def get_method(self):
+        """Return the request method, such as "GET"."""
+        return self.get_start_line()[0]
+
+    def get_target(self):
+        """Return the request target, such as "/index.html"."""
+
+        line = self.get_start_line()
+        return line[1] if len(line) > 1 else ""
+
+    def get_version(self):
+        """Return the HTTP version, such as "HTTP/1.1"."""
+
+        line = self.get_start_line()
+        return line[2] if len(line) > 2 else ""
+
+    __help__ = HttpMessage.__help__ + """
+
+    get_method(), get_target(), get_version()
+        Return the fields of the request line."""
+
+
+class HttpResponse(HttpMessage):
+
+    def get_version(self):
+        """Return the HTTP version, such as "HTTP/1.1"."""
+        return self.get_start_line()[0]
+
+    def get_status(self):
+        """Return the status code, as an integer."""
+
+        try:
+            return int(self.get_start_line()[1])
+        except (IndexError, ValueError):
+            return 0
+
+    def get_reason(self):
+        """Return the reason phrase, such as "OK"."""
+
+        line = self.get_start_line()
+        return line[2] if len(line) > 2 else ""
+
+    __help__ = HttpMessage.__help__ + """
+
+    get_version(), get_status(), get_reason()
+        Return the fields of the status line."""
+
+
+class HttpState:
+    """Framing state for one direction of an HTTP/1.1 connection."""
+
+    def __init__(self, direction):
+        self.direction = direction
+
+        # Header end of the message most recently framed, or None if
+        # it isn't a message.
+        self.framed = None
+
+        # Description of the framing error, once the stream can no
+        # longer be framed.
+        self.error = None
+        self.reset()
+        return
+
+    def reset(self):
+        # Offset to resume searching for the end of the headers, and
+        # the offset of their end once found.
+        self.scan = 0
+        self.headerEnd = None
+
+        # Body framing: "length", "chunked" or "close", the offset of
+        # the end of the body (for "length"), and of the next chunk
+        # (for "chunked").
+        self.body = None
+        self.bodyEnd = None
+        self.chunk = None
+        return
+
+
+class HttpDecoder(Decoder):
+    """Frames HTTP/1.1 requests and responses.
+
+    Requests are received for the server, and responses for the
+    client.  Bodies are framed by Content-Length or chunked transfer
+    coding, and otherwise a response's body continues until the
+    connection closes.  Responses to HEAD requests are not paired
+    with their request, so should not have a Content-Length.
+
+    If a chunk size can't be parsed, the message ends with the data
+    received so far, and its get_error() describes the problem.  The
+    end of the message is unknown, so the rest of the stream is not
+    decoded, rather than misframing the messages that follow."""
+
+    EVENTS = {"server": "http_request", "client": "http_response"}
+
+    _CONTENT_LENGTH = re.compile(rb"\r\ncontent-length[ \t]*:[ \t]*(\d+)",
+                                 re.IGNORECASE)
+    _CHUNKED = re.compile(rb"\r\ntransfer-encoding[ \t]*:[^\r]*chunked",
+                          re.IGNORECASE)
+    _CHUNK_SIZE = re.compile(rb"[ \t]*([0-9A-Fa-f]+)[ \t]*(;|$)")
+
+    def new_state(self, direction):
+        return HttpState(direction)
+
+    def frame(self, stream, start, state):
+        if state.error is not None:
+            # Framing has been lost: skip the rest of the stream.
+            state.framed = None
+            return stream.get_end() if stream.get_end() > start else None
+
+        if state.headerEnd is None:
+            i = stream.find(b"\r\n\r\n", max(start, state.scan - 3))
+            if i < 0:
+                state.scan = stream.get_end()
+                return None
+            state.headerEnd = i + 4
+            self._frame_body(bytes(stream.get_view(start, i + 2)), state)
+
+        if state.body == "length":
+            end = state.bodyEnd
+            if stream.get_end() < end:
+                return None
+
+        elif state.body == "chunked":
+            end = self._frame_chunks(stream, state)
+            if end is None:
+                return None
+
+        elif state.body == "close":
+            return None
+
+        else:
+            end = state.headerEnd
+
+        state.framed = state.headerEnd
+        state.reset()
+        return end
+
+    def _frame_body(self, head, state):
+        """Work out how the body is framed, from the headers."""
+
+        if state.direction == "client":
+            status = head[9:12]
+            if status[:1] == b"1" or status in (b"204", b"304"):
+                return
+
+        if self._CHUNKED.search(head):
+            state.body = "chunked"
+            state.chunk = state.headerEnd
+            return
+
+        m = self._CONTENT_LENGTH.search(head)
+        if m:
+            state.body = "length"
+            state.bodyEnd = state.headerEnd + int(m.group(1))
+        elif state.direction == "client":
+            state.body = "close"
+        return
+
+    def _frame_chunks(self, stream, state):
+        """Skip complete chunks, and return the end of the body once the
+        last chunk and trailers have arrived."""
+
+        while True:
+            i = stream.find(b"\r\n", state.chunk)
+            if i < 0:
+                return None
+
+            line = bytes(stream.get_view(state.chunk, i))
+            m = self._CHUNK_SIZE.match(line)
+            if m is None:
+                state.error = "invalid chunk size %r at offset %u" % (
+                    line[:32], state.chunk)
+                return stream.get_end()
+
+            size = int(m.group(1), 16)
+            if size == 0:
+                # Trailers, if any, end with an empty line.
+                j = stream.find(b"\r\n\r\n", i)
+                return None if j < 0 else j + 4
+
+            end = i + 2 + size + 2
+            if stream.get_end() < end:
+                return None
+            state.chunk = end
+
+    def finish(self, stream, start, state):
+        if state.error is not None:
+            return self.frame(stream, start, state)
+
+        if state.body == "close":
+            state.framed = state.headerEnd
+            state.reset()
+            return stream.get_end()
+        return None
+
+    def get_message(self, stream, start, end, state):
+        if state.framed is None:
+            return None
+
+        if state.direction == "server":
+            message = HttpRequest(stream, start, end, state.framed)
+        else:
+            message = HttpResponse(stream, start, end, state.framed)
+        message._error = state.error
+        return message
+
+
+########################################################################
+
+# Table of {name: Decoder class}, for the CLI's decode() command.
+DECODERS = {"http": HttpDecoder,
+            "line": LineDecoder,
+            "length": LengthPrefixDecoder}
+
+
+def register_decoder(name, decoderClass):
+    """Make a Decoder class available by name."""
+
+    DECODERS[name] = decoderClass
+    return
+
+
+def get_decoder(name, *args, **kwargs):
+    """Return a new instance of the decoder called 'name'.
+
+    Raises KeyError if there's no such decoder."""
+
+    return DECODERS[name](*args, **kwargs)
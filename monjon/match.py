@@ -0,0 +1,213 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import re
+
+
+class LiteralMatcher:
+    """Aho-Corasick automaton for finding byte strings in a stream.
+
+    The automaton is built once, as a table of transitions for each
+    state, and scanning a chunk carries on from the state reached at
+    the end of the previous one, so matches spanning chunks are found
+    without looking at any byte twice.
+
+    While in the initial state (no partial match), the scan skips to
+    the next byte that could begin a pattern using a regular
+    expression, so the Python loop only runs over candidate
+    matches."""
+
+    def __init__(self, literals):
+        self._literals = list(literals)
+
+        # Trie of {byte: state}, and patterns ending at each state.
+        goto = [{}]
+        out = [[]]
+        for index, literal in enumerate(self._literals):
+            if not literal:
+                raise ValueError("Cannot match an empty string")
+            state = 0
+            for c in literal:
+                if c not in goto[state]:
+                    goto.append({})
+                    out.append([])
+                    goto[state][c] = len(goto) - 1
+                state = goto[state][c]
+            out[state].append(index)
+
+        # Failure links, found breadth-first, and folded into the
+        # transition tables so that each byte is a single lookup.
+        # Bytes with no transition go back to the initial state.
+        fail = [0] * len(goto)
+        delta = [dict(goto[0])]
+        delta.extend({} for i in range(len(goto) - 1))
+        queue = list(goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            delta[state] = dict(delta[fail[state]])
+            for c, child in goto[state].items():
+                delta[state][c] = child
+                if state:
+                    fail[child] = delta[fail[state]].get(c, 0)
+                out[child] = out[child] + out[fail[child]]
+                queue.append(child)
+
+        self._delta = delta
+        self._out = out
+        self._first = re.compile(b"[" + b"".join(
+            re.escape(bytes([c])) for c in goto[0].keys()) + b"]")
+        return
+
+    def get_patterns(self):
+        """Return the list of literals."""
+        return self._literals
+
+    def scan(self, state, data, offset):
+        """Scan 'data', starting in automaton 'state'.
+
+        'offset' is the stream offset of the start of 'data'.  Returns
+        the state at the end of 'data', and a list of (index, end)
+        pairs: the index of each literal found, and the stream offset
+        just after it."""
+
+        delta = self._delta
+        out = self._out
+        first = self._first
+        found = []
+
+        i = 0
+        n = len(data)
+        while i < n:
+            if state == 0:
+                m = first.search(data, i)
+                if m is None:
+                    break
+                i = m.start()
+
+            state = delta[state].get(data[i], 0)
+            if out[state]:
+                for index in out[state]:
+                    found.append((index, offset + i + 1))
+            i += 1
+        return state, found
+
+
+class RegexMatcher:
+    """Finds a compiled regular expression in a stream.
+
+    Python's regular expression engine can't suspend a match at the
+    end of a chunk and resume it with the next one, so the last
+    'window' bytes scanned are carried over, and searched again with
+    the next chunk.  Matches are found across chunk boundaries as
+    long as they're no longer than the window, and each is reported
+    once."""
+
+    def __init__(self, pattern, window):
+        self._pattern = pattern
+        self._window = window
+        return
+
+    def get_pattern(self):
+        """Return the compiled pattern."""
+        return self._pattern
+
+    def scan(self, carry, data, offset):
+        """Scan 'data', following the 'carry' bytes from the previous
+        chunk.
+
+        Returns the bytes to carry into the next scan, and a list of
+        the stream offsets just after each match."""
+
+        buf = carry + data if carry else data
+        start = len(carry)
+        found = [offset - start + m.end()
+                 for m in self._pattern.finditer(buf)
+                 if m.end() > start]
+        return bytes(buf[-self._window:]), found
+
+
+class StreamMatcher:
+    """Matches a set of patterns in a byte stream, chunk by chunk.
+
+    'patterns' is a list of bytes literals, found with one
+    Aho-Corasick automaton, and regular expressions (compiled, or as
+    strings), searched with a window of 'window' bytes across chunk
+    boundaries.  The matcher itself has no state: each stream has its
+    own, created by new_stream(), and passed to scan() with each
+    chunk."""
+
+    def __init__(self, patterns, window=1024):
+        literals = []
+        self._regexes = []
+        self._patterns = []
+        for pattern in patterns:
+            if isinstance(pattern, (bytes, bytearray)):
+                literals.append(bytes(pattern))
+            elif isinstance(pattern, str):
+                self._regexes.append(RegexMatcher(
+                    re.compile(pattern.encode("utf-8")), window))
+            elif isinstance(pattern, re.Pattern) and \
+                 isinstance(pattern.pattern, bytes):
+                self._regexes.append(RegexMatcher(pattern, window))
+            else:
+                raise TypeError("Cannot match %r: expecting bytes, or a "
+                                "bytes regular expression" % (pattern,))
+            self._patterns.append(pattern)
+
+        self._literals = LiteralMatcher(literals) if literals else None
+        return
+
+    def get_patterns(self):
+        """Return the list of patterns."""
+        return self._patterns
+
+    def new_stream(self):
+        """Return the state for a new stream."""
+        return [0, 0, [b""] * len(self._regexes)]
+
+    def scan(self, stream, data, offset=None):
+        """Scan the next chunk of a stream.
+
+        Returns a list of (pattern, end) pairs, for each match ending
+        in 'data', where 'end' is the stream offset just after the
+        match, ordered by offset.  'offset' is the stream offset of
+        'data', if known: by default, it follows the previous chunk."""
+
+        if offset is None:
+            offset = stream[1]
+        found = []
+        if self._literals:
+            stream[0], matches = self._literals.scan(stream[0], data,
+                                                     offset)
+            literals = self._literals.get_patterns()
+            found.extend((literals[index], end) for index, end in matches)
+
+        carries = stream[2]
+        for i, regex in enumerate(self._regexes):
+            carries[i], ends = regex.scan(carries[i], data, offset)
+            found.extend((regex.get_pattern(), end) for end in ends)
+
+        stream[1] = offset + len(data)
+        if len(found) > 1:
+            found.sort(key=lambda x: x[1])
+        return found
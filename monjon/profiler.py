@@ -0,0 +1,288 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import collections, os, sys, threading, time
+import monjon.core
+
+
+class Histogram:
+    """Latency histogram with logarithmic buckets, in the style of HDR.
+
+    Values are recorded in nanoseconds.  Below 2**SUB_BITS each value
+    has its own bucket; above that, every power of two is divided into
+    2**SUB_BITS linear sub-buckets, so any recorded value is known to
+    within about 6%, whatever its size.  Recording is a few integer
+    operations and a list index, and merging two histograms is cheap,
+    so one can be kept per phase and per event type."""
+
+    SUB_BITS = 4
+
+    def __init__(self):
+        sub = 1 << self.SUB_BITS
+
+        # Bucket counts; enough for any 64-bit value.
+        self._counts = [0] * ((64 - self.SUB_BITS + 1) * sub)
+        self._count = 0
+        self._total = 0
+        self._max = 0
+        return
+
+    def _index(self, value):
+        """Return the bucket index for 'value'."""
+        
+        shift = value.bit_length() - self.SUB_BITS - 1
+        if shift < 0:
+            return value
+        return ((shift + 1) << self.SUB_BITS) + \
+               (value >> shift) - (1 << self.SUB_BITS)
+
+    def _upper(self, index):
+        """Return the largest value counted in bucket 'index'."""
+        
+        sub = 1 << self.SUB_BITS
+        if index < sub:
+            return index
+        shift = (index >> self.SUB_BITS) - 1
+        return (((index & (sub - 1)) + sub + 1) << shift) - 1
+
+    def record(self, seconds):
+        """Record a duration, given in seconds."""
+
+        value = int(seconds * 1e9)
+        if value < 0:
+            value = 0
+        self._counts[self._index(value)] += 1
+        self._count += 1
+        self._total += value
+        if value > self._max:
+            self._max = value
+        return
+
+    def merge(self, other):
+        """Add the counts of another Histogram into this one."""
+
+        counts = self._counts
+        for i, n in enumerate(other._counts):
+            if n:
+                counts[i] += n
+        self._count += other._count
+        self._total += other._total
+        self._max = max(self._max, other._max)
+        return
+
+    def get_count(self):
+        """Return the number of recorded values."""
+        return self._count
+
+    def get_total(self):
+        """Return the sum of recorded values, in seconds."""
+        return self._total / 1e9
+
+    def get_mean(self):
+        """Return the mean of recorded values, in seconds."""
+        
+        if not self._count:
+            return 0.0
+        return self._total / self._count / 1e9
+
+    def get_max(self):
+        """Return the largest recorded value, in seconds."""
+        return self._max / 1e9
+
+    def get_percentile(self, percent):
+        """Return the value below which 'percent' of values fall.
+
+        The result is the upper bound of the bucket holding that
+        value (or the maximum, if smaller), in seconds."""
+
+        if not self._count:
+            return 0.0
+
+        target = max(1, int(self._count * percent / 100.0 + 0.5))
+        seen = 0
+        for i, n in enumerate(self._counts):
+            seen += n
+            if seen >= target:
+                return min(self._upper(i), self._max) / 1e9
+        return self._max / 1e9
+
+    def get_values(self):
+        """Return a dictionary summarising the histogram, in seconds."""
+        
+        return {"count": self._count,
+                "total": self.get_total(),
+                "mean": self.get_mean(),
+                "p50": self.get_percentile(50),
+                "p90": self.get_percentile(90),
+                "p99": self.get_percentile(99),
+                "p99.9": self.get_percentile(99.9),
+                "max": self.get_max()}
+
+
+class Profiler(monjon.core.DispatchHooks):
+    """Profiles a Dispatcher, using its instrumentation hooks.
+
+    Time is attributed to the Dispatcher's phases: waiting in "poll",
+    sources handling ready sockets ("io", which includes fast-path
+    forwarding that never becomes an event), checking breakpoints
+    ("match"), "capture" and performing each event's "action".  Each
+    phase has a Histogram, as does the whole dispatch of each type of
+    event.
+
+    If 'sample' is non-zero, a thread also samples the Dispatcher's
+    Python stack every 'sample' seconds, counting the phase and the
+    innermost function it's running.  This finds where time goes
+    within a phase, at the cost of some contention for the GIL.
+
+    The Profiler must be started from the thread running the
+    Dispatcher."""
+
+    PHASES = ("poll", "io", "match", "capture", "action")
+
+    # Number of functions to report from sampling.
+    TOP_FUNCTIONS = 20
+
+    def __init__(self, dispatcher, sample=0):
+        self._dispatcher = dispatcher
+        self._sample = sample
+        self._thread = None
+        self._running = False
+        self.reset()
+        return
+
+    def reset(self):
+        """Discard everything profiled so far."""
+
+        self._phases = {}
+        for phase in self.PHASES:
+            self._phases[phase] = Histogram()
+        self._events = {}
+        self._samples = 0
+        self._phaseSamples = collections.Counter()
+        self._functions = collections.Counter()
+        self._start = time.perf_counter()
+        self._elapsed = 0.0
+        return
+
+    def start(self):
+        """Add the hooks to the Dispatcher, and start sampling."""
+
+        if self._running:
+            return
+
+        self._running = True
+        self._start = time.perf_counter()
+        self._dispatcher.add_hooks(self)
+
+        if self._sample > 0:
+            self._thread = threading.Thread(target=self._run_sampler,
+                                            args=(threading.get_ident(),),
+                                            name="monjon profiler")
+            self._thread.daemon = True
+            self._thread.start()
+        return
+
+    def stop(self):
+        """Remove the hooks from the Dispatcher, and stop sampling."""
+
+        if not self._running:
+            return
+
+        self._running = False
+        self._dispatcher.remove_hooks(self)
+        self._elapsed += time.perf_counter() - self._start
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        return
+
+    def is_running(self):
+        """Return True if the Profiler is started."""
+        return self._running
+
+    def on_poll(self, ready, pollTime, ioTime):
+        self._phases["poll"].record(pollTime)
+        if ready:
+            self._phases["io"].record(ioTime)
+        return
+
+    def post_dispatch(self, event, matchTime, captureTime, actionTime):
+        phases = self._phases
+        phases["match"].record(matchTime)
+        phases["capture"].record(captureTime)
+        phases["action"].record(actionTime)
+
+        eventType = event.get_type()
+        histogram = self._events.get(eventType)
+        if histogram is None:
+            histogram = self._events[eventType] = Histogram()
+        histogram.record(matchTime + captureTime + actionTime)
+        return
+
+    def _run_sampler(self, ident):
+        """Sample the stack of thread 'ident' until stopped."""
+
+        while self._running:
+            time.sleep(self._sample)
+
+            frame = sys._current_frames().get(ident)
+            if frame is None:
+                continue
+
+            code = frame.f_code
+            self._samples += 1
+            self._phaseSamples[self._dispatcher.get_phase()] += 1
+            self._functions["%s (%s:%u)" % (
+                code.co_name, os.path.basename(code.co_filename),
+                code.co_firstlineno)] += 1
+        return
+
+    def get_report(self):
+        """Return a dictionary of everything profiled so far.
+
+        "phases" and "events" map names to Histogram values (see
+        Histogram.get_values()); "samples" has the total number of
+        stack samples, the number in each phase, and the functions
+        most often seen running, as [name, count] pairs."""
+
+        elapsed = self._elapsed
+        if self._running:
+            elapsed += time.perf_counter() - self._start
+
+        phaseSamples = {}
+        for phase, n in self._phaseSamples.items():
+            phaseSamples[phase or "other"] = n
+
+        report = {"elapsed": elapsed,
+                  "phases": {},
+                  "events": {},
+                  "samples": {"total": self._samples,
+                              "phases": phaseSamples,
+                              "functions": [list(x) for x in
+                                            self._functions.most_common(
+                                                self.TOP_FUNCTIONS)]}}
+        for phase, histogram in self._phases.items():
+            report["phases"][phase] = histogram.get_values()
+        for eventType, histogram in self._events.items():
+            report["events"][str(eventType)] = histogram.get_values()
+        return report
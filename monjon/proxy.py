@@ -20,27 +20,104 @@
 #HEADER_END
 ########################################################################
 
-import socket
+import collections, errno, os, random, socket, time
 import monjon.core
 
 
+# True if the kernel can relay data between sockets using splice(2).
+RELAY_SUPPORTED = hasattr(os, "splice")
+
+
+class Shaping:
+    """Network conditions to apply to a session's data.
+
+    Each chunk of data is delivered 'delay' seconds after it's
+    received, give or take up to 'jitter' seconds.  If 'rate' is set,
+    data is sent no faster than 'rate' bytes per second, queueing
+    behind earlier data as on a slow link.
+
+    TCP data can't be dropped without corrupting the stream, so a
+    chunk is "lost" with probability 'loss' by delaying it a further
+    'retransmit' seconds, as if resent by the sender.  Data is always
+    delivered in the order received, so jitter and loss hold back
+    the data behind them too.
+
+    A Shaping can be shared by many sessions: each keeps its own state
+    for each direction, created by new_state()."""
+
+    def __init__(self, delay=0.0, jitter=0.0, rate=None, loss=0.0,
+                 retransmit=0.2):
+        self._delay = delay
+        self._jitter = jitter
+        self._rate = rate
+        self._loss = loss
+        self._retransmit = retransmit
+        return
+
+    def new_state(self):
+        """Return the state for one direction of a session."""
+
+        # Time the link is busy until, and time the last chunk is
+        # delivered.
+        return [0.0, 0.0]
+
+    def get_delay(self, state, n):
+        """Return the seconds to hold 'n' bytes for, updating 'state'."""
+
+        now = time.monotonic()
+        sent = max(now, state[0])
+        if self._rate:
+            sent += n / self._rate
+        state[0] = sent
+
+        deliver = sent + self._delay
+        if self._jitter:
+            deliver += random.uniform(-self._jitter, self._jitter)
+        if self._loss and random.random() < self._loss:
+            deliver += self._retransmit
+
+        # Keep the stream in order.
+        deliver = max(deliver, state[1], sent)
+        state[1] = deliver
+        return deliver - now
+
+    def __repr__(self):
+        return "<Shaping: delay %gs, jitter %gs, rate %s, loss %g>" % (
+            self._delay, self._jitter,
+            "%g B/s" % self._rate if self._rate else "unlimited",
+            self._loss)
+
+
 class Listener(monjon.core.EventSource):
     """Listens for connection attempts, and creates a Session for them."""
     pass
 
 class TCPListener(Listener):
 
-    def __init__(self, dispatcher, localPort, remoteHost, remotePort):
+    # Most connections to accept for each readable notification.
+    ACCEPT_BUDGET = 64
+
+    # Seconds to stop accepting for when out of descriptors.
+    ACCEPT_RETRY = 0.1
+
+    def __init__(self, dispatcher, localPort, remoteHost, remotePort,
+                 backlog=128, reusePort=False):
+        super().__init__()
         self.dispatcher = dispatcher
 
         # Local port.
         self.localPort = localPort
 
-        # Create, bind and listen on socket.
+        # Create, bind and listen on socket.  With 'reusePort', several
+        # processes can listen on the same port, and the kernel shares
+        # incoming connections between them.
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.socket.bind(("0.0.0.0", self.localPort))
-        self.socket.listen(5)
+        self.socket.listen(backlog)
+        self.socket.setblocking(False)
 
         # Get actual local port number (in case 'localPort' was zero).
         host, port = self.socket.getsockname()
@@ -66,8 +143,97 @@ class TCPListener(Listener):
 
         # List of sessions accepted from the listener.
         self._sessions = []
+
+        # Whether new sessions use kernel relay mode.
+        self._relay = False
+
+        # Stream retention for new sessions, if they keep streams.
+        self._streams = None
+
+        # Protocol decoder for new sessions, if any.
+        self._decoder = None
+
+        # Table of {direction: Shaping} for new sessions.
+        self._shaping = {}
+
+        # Time to resume accepting, while paused for lack of descriptors.
+        self._resumeAccept = None
+        return
+
+    def set_relay(self, enabled):
+        """Enable or disable kernel relay mode for all sessions.
+
+        See TcpSession.set_relay().  The setting applies to current
+        sessions, and is inherited by sessions accepted later.  Raises
+        OSError if splice() is not available."""
+
+        if enabled and not RELAY_SUPPORTED:
+            raise OSError(errno.ENOSYS, "splice() is not available")
+
+        for session in self._sessions:
+            session.set_relay(enabled)
+        self._relay = enabled
+        return
+
+    def get_relay(self):
+        """Return True if kernel relay mode is enabled."""
+        return self._relay
+
+    def set_streams(self, enabled, retention=None):
+        """Keep (or stop keeping) each session's data as streams.
+
+        See TcpSession.set_streams().  The setting applies to current
+        sessions, and is inherited by sessions accepted later."""
+
+        if retention is None:
+            retention = TcpSession.STREAM_RETENTION
+        for session in self._sessions:
+            session.set_streams(enabled, retention)
+        self._streams = retention if enabled else None
+        return
+
+    def get_streams(self):
+        """Return the stream retention for sessions, or None if they
+        don't keep streams."""
+        return self._streams
+
+    def set_decoder(self, decoder):
+        """Decode sessions' streams into messages with 'decoder'.
+
+        See TcpSession.set_decoder().  The decoder applies to current
+        sessions, and is used by sessions accepted later."""
+
+        for session in self._sessions:
+            if session.get_state() != "closed":
+                session.set_decoder(decoder)
+        self._decoder = decoder
+        return
+
+    def get_decoder(self):
+        """Return the protocol decoder for sessions, or None."""
+        return self._decoder
+
+    def set_shaping(self, shaping, direction=None):
+        """Apply network conditions to sessions' data.
+
+        See TcpSession.set_shaping().  The setting applies to current
+        sessions, and is inherited by sessions accepted later."""
+
+        for session in self._sessions:
+            if session.get_state() != "closed":
+                session.set_shaping(shaping, direction)
+        for d in ((direction,) if direction else ("client", "server")):
+            if shaping is None:
+                self._shaping.pop(d, None)
+            else:
+                self._shaping[d] = shaping
         return
 
+    def get_shaping(self, direction):
+        """Return the Shaping for sessions' data in 'direction', or
+        None."""
+        return self._shaping.get(direction)
+
     def get_sockets(self):
         """Get the sockets for this listener."""
         return [self.socket]
@@ -81,7 +247,7 @@ class TCPListener(Listener):
 
         assert sock == self.socket
 
-        # Accept connection.
+        # Accept connections.
         #
         # We have to do this here, because otherwise this socket
         # continues to show up as readable, which means we continue to
@@ -89,38 +255,104 @@ class TCPListener(Listener):
         # it from the select() set, but that's harder, so for now we
         # just accept() here, and pass the socket through to the event
         # action.
-        s, a = self.socket.accept()
+        #
+        # Accept until the backlog is empty, or the budget is used up
+        # (so other sources get a turn during a connection storm).
+        events = []
+        for i in range(self.ACCEPT_BUDGET):
+            try:
+                s, a = self.socket.accept()
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError as e:
+                # Out of descriptors, or the connection was aborted
+                # while queued: try again on the next notification.
+                if e.errno in (errno.EMFILE, errno.ENFILE, errno.ENOBUFS,
+                               errno.ENOMEM):
+                    self._pause_accept()
+                    break
+                continue
 
-        # Create Connecction object for this connection.
-        connection = monjon.core.Connection()
-        connection._src = s.getpeername()
-        connection._dst = (self.remoteHost, self.remotePort)
+            self._stats.add_accept()
+
+            # Create Connecction object for this connection.
+            connection = monjon.core.Connection()
+            connection._listener = self
+            connection._src = a
+            connection._dst = (self.remoteHost, self.remotePort)
+            connection._proto = "tcp"
+
+            # Fast path: nothing can break on this accept, so skip the
+            # event.
+            if not events and not self.dispatcher.wants_event(self, "accept"):
+                self._start_session(s, connection)
+                continue
 
-        # Create and queue event
-        e = monjon.core.AcceptEvent(self)
-        e._connection = connection
-        e.set_action(self.do_accept)
-        e.set_context((s, a))
+            # Create event
+            e = monjon.core.AcceptEvent(self)
+            e._connection = connection
+            e.set_action(self.do_accept)
+            e.set_context((s, a))
+            events.append(e)
 
-        self.dispatcher.queue_event(e)
+        # Queue the batch of events
+        if events:
+            self.dispatcher.queue_events(events)
         return
 
+    def _pause_accept(self):
+        """Stop polling for connections for a while.
+
+        The pending connection stays readable, so otherwise the poller
+        would report it on every pass until a descriptor is freed."""
+
+        self.dispatcher.set_interest(self.socket, 0)
+        self._resumeAccept = time.time() + self.ACCEPT_RETRY
+        self.dispatcher.add_generator(self)
+        return
+
+    def generate(self):
+        """Resume accepting once the retry delay has passed."""
+
+        if self._resumeAccept is None:
+            return None
+
+        now = time.time()
+        if now < self._resumeAccept:
+            return self._resumeAccept - now
+
+        self._resumeAccept = None
+        self.dispatcher.remove_generator(self)
+        self.dispatcher.set_interest(self.socket, monjon.core.POLL_READ)
+        return None
+
     def do_accept(self, event):
         # Retrieve the newly accept()ed socket
         s, a = event.get_context()
+        self._start_session(s, event.get_connection())
+        return
 
+    def _start_session(self, s, connection):
         # Create TCP session object.
         session = TcpSession(self.dispatcher,
                              s,
                              self.remoteHost,
-                             self.remotePort)
+                             self.remotePort,
+                             connection)
+        if self._relay:
+            session.set_relay(True)
+        if self._streams is not None:
+            session.set_streams(True, self._streams)
+        if self._decoder is not None:
+            session.set_decoder(self._decoder)
+        for direction, shaping in self._shaping.items():
+            session.set_shaping(shaping, direction)
 
         # Save in list of proxies.
         self._sessions.append(session)
         return
 
     def on_writeable(self, sock):
-        print("on_writeable")
         return
 
     def __repr__(self):
@@ -130,9 +362,33 @@ class TCPListener(Listener):
 
 
 class TcpSession(monjon.core.EventSource):
-    """ """
+    """A proxied TCP connection, between a client and the server.
+
+    Data received from one side is queued as an event, and when that
+    event's action is performed, appended to an outbound buffer for the
+    other side.  Buffers are drained as their socket becomes writeable,
+    and write interest is only registered while data is pending.
 
-    def __init__(self, dispatcher, sock, remoteHost, remotePort):
+    If a buffer grows past HIGH_WATER bytes, reading from the side that
+    is filling it is paused until the buffer drains below LOW_WATER.
+
+    In relay mode (see set_relay()), data that nothing could break on
+    is moved between the sockets by the kernel using splice(2), via a
+    pipe for each direction, without being copied into Python."""
+
+    # Outbound buffer limits, in bytes.
+    HIGH_WATER = 256 * 1024
+    LOW_WATER = 64 * 1024
+
+    # Largest splice() transfer, in bytes.
+    RELAY_CHUNK = 1024 * 1024
+
+    # Default bytes of each stream to keep (see set_streams()).
+    STREAM_RETENTION = 1024 * 1024
+
+    def __init__(self, dispatcher, sock, remoteHost, remotePort,
+                 connection=None):
+        super().__init__()
         self._dispatcher = dispatcher
         self._client = sock
         self._remoteHost = remoteHost
@@ -140,76 +396,642 @@ class TcpSession(monjon.core.EventSource):
 
         self._sourceHost, self._sourcePort = self._client.getpeername()
 
+        # Connection details, and recorded traffic.
+        if connection is None:
+            connection = monjon.core.Connection()
+            connection._src = (self._sourceHost, self._sourcePort)
+            connection._dst = (self._remoteHost, self._remotePort)
+            connection._proto = "tcp"
+        self._connection = connection
+
+        # Traffic is counted in the listener's totals too.
+        self._parent = connection._listener
+        if connection._listener:
+            self._stats.set_parent(connection._listener.get_stats())
+
         # Not yet connected to server.
         self._server = None
 
-        # Connect to remote target.
-        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self._server.connect((self._remoteHost, self._remotePort))
+        # Outbound data not yet accepted by the kernel.
+        self._toClient = bytearray()
+        self._toServer = bytearray()
+
+        # Reading is paused on a side while the buffer it fills is over
+        # the high-water mark, until it drains below the low-water mark.
+        self._clientPaused = False
+        self._serverPaused = False
+
+        # Set once either side has closed: no further data is read.
+        self._eof = False
+
+        # Set once the close event has been processed: remaining
+        # buffered data is flushed, then both sockets are closed.
+        self._closing = False
+
+        # Error to report for a connect that failed immediately.
+        self._connectError = None
+
+        # Relay mode, and table of {destination socket: [pipe read fd,
+        # pipe write fd, bytes in pipe]} once enabled.
+        self._relay = False
+        self._pipes = {}
+
+        # Streams of the data received for the client and for the
+        # server, if kept (see set_streams()).
+        self.client_stream = None
+        self.server_stream = None
+
+        # Protocol decoder, if any (see set_decoder()), and the framing
+        # {direction: [offset of the next message, decoder state]}.
+        self._decoder = None
+        self._framing = {}
+
+        # Table of {direction: [Shaping, state]} for shaped directions
+        # (None if neither is), and the bytes held back in each.
+        self._shaping = None
+        self._held = {"client": 0, "server": 0}
+
+        # Start connecting to remote target.  Data is forwarded as it
+        # arrives, so don't let Nagle's algorithm hold back the tail of
+        # each write waiting for an ACK.
+        self._client.setblocking(False)
+        self._client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connect_to_server(self._remoteHost, self._remotePort)
 
         # Add to event loop.
         self._dispatcher.register_source(self)
+        self._update_interest()
         return
 
     def connect_to_server(self, host, port):
+        """Start a non-blocking connection to the server.
+
+        The session stays in the "connecting" state until the server
+        socket becomes writeable, and data from the client is buffered
+        meanwhile.  Note that if 'host' is a name rather than an
+        address, resolving it still blocks."""
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._server.setblocking(False)
+        self.set_state("connecting")
+
+        # Any immediate failure is reported once the socket is polled.
+        try:
+            err = self._server.connect_ex((host, port))
+        except OSError as e:
+            self._connectError = e
+            return
+
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._connectError = OSError(err, os.strerror(err))
+        return
+
+    def _on_connect(self):
+        """Called when the server socket is writeable while connecting."""
+
+        err = self._connectError
+        self._connectError = None
+        if not err:
+            n = self._server.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if n:
+                err = OSError(n, os.strerror(n))
+
+        if err:
+            self.set_state("failed")
+            self._eof = True
+            self._update_interest()
+
+            if self._dispatcher.wants_event(self, "connect_failed"):
+                e = monjon.core.ConnectFailedEvent(self, err)
+                e._connection = self._connection
+                e.set_action(self.connect_failed)
+                self._dispatcher.queue_event(e)
+            else:
+                self._do_close()
+            return
+
+        # Record the server's actual address, rather than its name.
+        self.set_state("connected")
+        self._connection._dst = self._server.getpeername()
+
+        if self._dispatcher.wants_event(self, "connect"):
+            e = monjon.core.ConnectEvent(self)
+            e._connection = self._connection
+            e.set_action(self.connected)
+            self._dispatcher.queue_event(e)
+
+        # Send anything received from the client while connecting.
+        self._flush(self._server, self._toServer)
+        return
+
+    def connected(self, event):
+        """Action for a connect event."""
+        return
+
+    def connect_failed(self, event):
+        """Action for a failed connect event: close the client."""
+        self._do_close()
+        return
+
+    def get_connection(self):
+        """Return the Connection for this session."""
+        return self._connection
+
+    def set_relay(self, enabled):
+        """Enable or disable kernel relay mode.
+
+        While enabled, data in a direction with no breakpoints is moved
+        by splice(2) and never seen by Python.  As soon as a breakpoint
+        applies (or while single-stepping) data is received and queued
+        as events as usual.  Raises OSError if splice() is not
+        available."""
+
+        if enabled and not RELAY_SUPPORTED:
+            raise OSError(errno.ENOSYS, "splice() is not available")
+
+        if enabled and not self._pipes and self._client:
+            for sock in (self._client, self._server):
+                r, w = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+                self._pipes[sock] = [r, w, 0]
+
+        self._relay = enabled
+        return
+
+    def get_relay(self):
+        """Return True if kernel relay mode is enabled."""
+        return self._relay
+
+    def set_streams(self, enabled, retention=None):
+        """Keep (or stop keeping) the data in each direction as a stream.
+
+        While enabled, 'client_stream' holds the data received for
+        the client, and 'server_stream' the data received for the
+        server, as monjon.core.ByteStreams addressed by offset from
+        the start of the session (or from when streams were enabled).
+        Each keeps at least the most recent 'retention' bytes, or
+        STREAM_RETENTION by default.  Keeping streams stops kernel
+        relay mode from being used."""
+
+        if not enabled:
+            self.client_stream = None
+            self.server_stream = None
+            self.set_decoder(None)
+            return
+
+        if retention is None:
+            retention = self.STREAM_RETENTION
+        for name in ("client_stream", "server_stream"):
+            stream = getattr(self, name)
+            if stream is None:
+                setattr(self, name, monjon.core.ByteStream(retention))
+            else:
+                stream.set_retention(retention)
+        return
+
+    def set_decoder(self, decoder):
+        """Decode the session's streams into messages with 'decoder'.
+
+        'decoder' is a monjon.decode.Decoder, or None to stop decoding.
+        Messages are framed as data arrives, starting from the next
+        data received, and queued as events of the decoder's types
+        if something could break on them.  Decoding keeps streams,
+        if they aren't already kept, and data is trimmed from them
+        only once it has been framed."""
+
+        self._decoder = decoder
+        self._framing = {}
+        if decoder is None:
+            return
+
+        if self.client_stream is None:
+            self.set_streams(True)
+        for direction, stream in (("server", self.server_stream),
+                                  ("client", self.client_stream)):
+            self._framing[direction] = [stream.get_end(),
+                                        decoder.new_state(direction)]
+        return
+
+    def get_decoder(self):
+        """Return the protocol decoder, or None."""
+        return self._decoder
+
+    def _decode(self, direction, final=False):
+        """Frame new messages in the stream for 'direction', and queue
+        events for those something could break on.
+
+        If 'final', the stream has ended."""
+
+        decoder = self._decoder
+        stream = self.server_stream if direction == "server" \
+                 else self.client_stream
+        framing = self._framing[direction]
+        eventType = decoder.get_event_type(direction)
+
+        while True:
+            start = framing[0]
+            if final:
+                end = decoder.finish(stream, start, framing[1])
+            else:
+                end = decoder.frame(stream, start, framing[1])
+            if end is None or end <= start:
+                break
+
+            if self._dispatcher.wants_event(self, eventType):
+                message = decoder.get_message(stream, start, end, framing[1])
+                if message is not None:
+                    e = monjon.core.MessageEvent(self, eventType, message,
+                                                 self._connection)
+                    e.set_action(self._decoded)
+                    self._dispatcher.queue_event(e)
+
+            framing[0] = end
+            stream.consume(end)
+        return
+
+    def _decoded(self, event):
+        """Action for message events: the data is forwarded by its own
+        events."""
+        return
+
+    def set_shaping(self, shaping, direction=None):
+        """Apply network conditions to data sent by this session.
+
+        'shaping' is a Shaping, or None to remove it.  'direction' is
+        "client" for data sent to the client, "server" for data sent
+        to the server, or None (the default) for both.  Data already
+        held back is still delivered as scheduled."""
+
+        table = dict(self._shaping or {})
+        for d in ((direction,) if direction else ("client", "server")):
+            if shaping is None:
+                table.pop(d, None)
+            else:
+                table[d] = [shaping, shaping.new_state()]
+        self._shaping = table or None
         return
 
+    def get_shaping(self, direction):
+        """Return the Shaping for 'direction', or None."""
+
+        if self._shaping and direction in self._shaping:
+            return self._shaping[direction][0]
+        return None
+
     def send_to_client(self, event):
-        buf = event.get_packet().get_payload()
-        self._client.send(buf)
+        self._send_to_client(event.get_packet().get_payload())
         return
 
     def send_to_server(self, event):
-        buf = event.get_packet().get_payload()
-        self._server.send(buf)
+        self._send_to_server(event.get_packet().get_payload())
+        return
+
+    def _send_to_client(self, buf):
+        if self._shaping and "client" in self._shaping:
+            self._hold("client", buf)
+        elif self._client:
+            self._send(self._client, self._toClient, buf)
+        return
+
+    def _send_to_server(self, buf):
+        if self._shaping and "server" in self._shaping:
+            self._hold("server", buf)
+        elif self._server:
+            self._send(self._server, self._toServer, buf)
+        return
+
+    def _hold(self, direction, buf):
+        """Schedule 'buf' to be sent as its direction's Shaping says.
+
+        The data is copied, since it's usually in a pooled buffer."""
+
+        shaping, state = self._shaping[direction]
+        n = len(buf)
+        self._held[direction] += n
+        self._dispatcher.call_later(shaping.get_delay(state, n),
+                                    self._deliver, direction, bytes(buf))
+
+        # Stop reading while too much is held back.
+        self._update_interest()
+        return
+
+    def _deliver(self, direction, data):
+        """Send data held back by _hold()."""
+
+        self._held[direction] -= len(data)
+        if direction == "client":
+            if self._client:
+                self._send(self._client, self._toClient, data)
+        elif self._server:
+            self._send(self._server, self._toServer, data)
+
+        self._update_interest()
+        if self._closing and self._drained():
+            self._do_close()
+        return
+
+    def _send(self, sock, out, buf):
+        """Send 'buf' to 'sock', buffering in 'out' whatever won't fit.
+
+        If nothing is already waiting, 'buf' is sent directly, so the
+        common case doesn't copy it into the outbound buffer."""
+
+        if not self._pending(sock) and \
+           not (sock == self._server and self.get_state() == "connecting"):
+            try:
+                n = sock.send(buf)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError:
+                self._queue_close()
+                return
+
+            if n == len(buf):
+                return
+            buf = buf[n:]
+
+        out += buf
+        self._flush(sock, out)
+        return
+
+    def _pending(self, sock):
+        """Return the number of bytes waiting to be sent to 'sock'."""
+
+        pipe = self._pipes.get(sock)
+        n = pipe[2] if pipe else 0
+        return n + len(self._toClient if sock == self._client
+                       else self._toServer)
+
+    def _drained(self):
+        """Return True if no data is waiting to be sent either way."""
+
+        return not (self._pending(self._client) or
+                    self._pending(self._server) or
+                    self._held["client"] or self._held["server"])
+
+    def _flush(self, sock, buf):
+        """Send as much of 'buf' to 'sock' as the kernel will take.
+
+        Any relayed data in the pipe for 'sock' was received earlier
+        than 'buf', so it is sent first."""
+
+        # Nothing can be sent to the server until it's connected.
+        if sock == self._server and self.get_state() == "connecting":
+            self._update_interest()
+            return
+
+        pipe = self._pipes.get(sock)
+        if pipe and pipe[2]:
+            self._drain_pipe(sock, pipe)
+            if pipe[2]:
+                self._update_interest()
+                return
+
+        while buf:
+            try:
+                n = sock.send(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # Peer has gone away: discard what's left and close.
+                del buf[:]
+                self._queue_close()
+                return
+            del buf[:n]
+
+        self._update_interest()
+        if self._closing and self._drained():
+            self._do_close()
+        return
+
+    def _drain_pipe(self, sock, pipe):
+        """Splice relayed data from its pipe to 'sock'."""
+
+        while pipe[2]:
+            try:
+                n = os.splice(pipe[0], sock.fileno(), pipe[2],
+                              flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Peer has gone away: data in the pipe is lost.
+                pipe[2] = 0
+                self._queue_close()
+                return
+            pipe[2] -= n
+        return
+
+    def _relay_from(self, sock, dest):
+        """Splice data received on 'sock' into the pipe for 'dest'."""
+
+        pipe = self._pipes[dest]
+        try:
+            n = os.splice(sock.fileno(), pipe[1], self.RELAY_CHUNK,
+                          flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            n = 0
+
+        if n == 0:
+            # End of stream or error, so one side has closed session
+            self._queue_close()
+            return
+
+        pipe[2] += n
+        self._stats.add_recv(sock == self._client, n)
+        self._flush(dest, self._toServer if dest == self._server
+                    else self._toClient)
+        return
+
+    def _update_interest(self):
+        """Recalculate poller interest for both sockets."""
+
+        if not self._client:
+            return
+
+        # Don't read from a side whose output is going to the other
+        # side's full buffer (including data held back by shaping), or
+        # is stuck in a relay pipe.
+        n = len(self._toServer)
+        held = n + self._held["server"]
+        self._clientPaused = held >= self.HIGH_WATER or \
+                             (self._clientPaused and held > self.LOW_WATER) or \
+                             self._pending(self._server) > n
+        n = len(self._toClient)
+        held = n + self._held["client"]
+        self._serverPaused = held >= self.HIGH_WATER or \
+                             (self._serverPaused and held > self.LOW_WATER) or \
+                             self._pending(self._client) > n
+
+        events = monjon.core.POLL_WRITE if self._pending(self._client) else 0
+        if not self._eof and not self._clientPaused:
+            events |= monjon.core.POLL_READ
+        self._dispatcher.set_interest(self._client, events)
+
+        # While connecting, wait for the server socket to be writeable.
+        if self.get_state() == "connecting":
+            events = monjon.core.POLL_WRITE
+        else:
+            events = monjon.core.POLL_WRITE if self._pending(self._server) else 0
+            if not self._eof and not self._serverPaused:
+                events |= monjon.core.POLL_READ
+        self._dispatcher.set_interest(self._server, events)
+        return
+
+    def _queue_close(self):
+        """Queue a CloseEvent for this session."""
+
+        if not self._eof:
+            self._eof = True
+            self._update_interest()
+
+            # Messages ended by the connection closing.
+            if self._decoder is not None:
+                self._decode("server", True)
+                self._decode("client", True)
+
+            e = monjon.core.CloseEvent(self)
+            e._connection = self._connection
+            e.set_action(self.close)
+            self._dispatcher.queue_event(e)
         return
 
     def close(self, event):
+        self._eof = True
+        self._closing = True
+        if not self._drained():
+            # Wait for pending data to drain before closing.
+            self._update_interest()
+        else:
+            self._do_close()
+        return
+
+    def _do_close(self):
+        if not self._client:
+            return
+
         # Remove from event loop
         self._dispatcher.deregister_source(self)
 
-        # Close both sockets
+        # Close both sockets, and any relay pipes
         self._client.close()
         self._client = None
         
         self._server.close()
         self._server = None
+        self.set_state("closed")
+        self._stats.add_close()
 
-        print("closed")
+        for r, w, n in self._pipes.values():
+            os.close(r)
+            os.close(w)
+        self._pipes = {}
         return
 
     def get_sockets(self):
         return [self._client, self._server]
 
     def on_readable(self, sock):
+        # A hangup or error while connecting is a failed connect.
+        if sock == self._server and self.get_state() == "connecting":
+            self._on_connect()
+            return
+
         if sock == self._client:
-            buf = self._client.recv(8192)
-            if buf:
-                e = monjon.core.ServerReceiveEvent(self)
-                e._packet = monjon.core.Packet(buf, None) # FIXME
-                e.set_action(self.send_to_server)
-            else:
-                # Zero-length read, so client has closed session
-                e = monjon.core.CloseEvent(self)
-                e.set_action(self.close)
+            dest, eventType = self._server, "server_recv"
         else:
-            buf = self._server.recv(8192)
-            if buf:
-                e = monjon.core.ClientReceiveEvent(self)
-                e._packet = monjon.core.Packet(buf, None) # FIXME
-                e.set_action(self.send_to_client)
+            dest, eventType = self._client, "client_recv"
+
+        # Relay mode: if nothing could break on this data, it's not
+        # being recorded, and there's no earlier data buffered for the
+        # destination, let the kernel move it.
+        direction = "server" if sock == self._client else "client"
+        wanted = self._dispatcher.wants_event(self, eventType)
+
+        # Data is queued if its messages are, so that a message's event
+        # comes before that of the data completing it.
+        if not wanted and self._decoder is not None:
+            wanted = self._dispatcher.wants_event(
+                self, self._decoder.get_event_type(direction))
+
+        if self._relay and not wanted and self._pipes and \
+           self.client_stream is None and self._shaping is None and \
+           not self._dispatcher.get_history() and \
+           not (self._toServer if dest == self._server else self._toClient):
+            self._relay_from(sock, dest)
+            return
+
+        # Receive into a pooled buffer.
+        pool = self._dispatcher.get_buffer_pool()
+        buf = pool.get()
+        try:
+            n = sock.recv_into(buf)
+        except (BlockingIOError, InterruptedError):
+            pool.put(buf)
+            return
+        except OSError:
+            n = 0
+
+        if not n:
+            # Zero-length read or error, so one side has closed session
+            pool.put(buf)
+            self._queue_close()
+            return
+
+        view = memoryview(buf)[:n]
+        self._stats.add_recv(sock == self._client, n)
+
+        # Append to the stream, if keeping them, and decode it.
+        stream = self.server_stream if sock == self._client \
+                 else self.client_stream
+        if stream is not None:
+            offset = stream.get_end()
+            stream.append(view)
+            if self._decoder is not None:
+                self._decode(direction)
+
+        # Record a copy, if keeping history.
+        history = self._dispatcher.get_history()
+        if history:
+            history.record(self._connection, eventType, view)
+
+        # Fast path: forward directly if nothing could break on it.
+        if not wanted:
+            if sock == self._client:
+                self._send_to_server(view)
             else:
-                # Zero-length read, so server has closed session
-                e = monjon.core.CloseEvent(self)
-                e.set_action(self.close)
+                self._send_to_client(view)
+            view.release()
+            pool.put(buf)
+            return
+
+        # The buffer is returned to the pool once the event has been
+        # dispatched.
+        packet = monjon.core.Packet(view, self._connection,
+                                    lambda: pool.put(buf))
+        if stream is not None:
+            packet.set_offset(offset)
+        if sock == self._client:
+            e = monjon.core.ServerReceiveEvent(self)
+            e.set_action(self.send_to_server)
+        else:
+            e = monjon.core.ClientReceiveEvent(self)
+            e.set_action(self.send_to_client)
+        e.set_packet(packet)
 
         # Queue event for dispatch
         self._dispatcher.queue_event(e)
         return
 
     def on_writeable(self, sock):
-        #print("TcpSession::on_writeable()")
+        if sock == self._server and self.get_state() == "connecting":
+            self._on_connect()
+        elif sock == self._client:
+            self._flush(self._client, self._toClient)
+        elif sock == self._server:
+            self._flush(self._server, self._toServer)
         return
 
     def __repr__(self):
@@ -227,6 +1049,349 @@ class UDPListener(Listener):
     to act as the outbound endoint.
 
     In this way, any return traffic to the outbound endpoint can be
-    forwarded back to the correct originator."""
-    pass
+    forwarded back to the correct originator.
+
+    Sessions are kept in a table keyed by source address, in the order
+    they were last active: a datagram in either direction moves its
+    session to the newest end.  A session with no datagrams for
+    'idleTimeout' seconds is evicted: the table is checked from the
+    oldest end, so each check stops at the first session that hasn't
+    expired."""
+
+    # Most datagrams to receive for each readable notification.
+    RECV_BUDGET = 64
+
+    # Largest datagram.
+    MAX_DATAGRAM = 65536
+
+    def __init__(self, dispatcher, localPort, remoteHost, remotePort,
+                 idleTimeout=60.0):
+        super().__init__()
+        self.dispatcher = dispatcher
+
+        # Check that at least one of remote host and port are
+        # specified, since otherwise we try to send to
+        # localhost:localport.
+        if remotePort == 0 and remoteHost == None:
+            print("Cannot use default remote host and default remote port")
+            raise AttributeError
+
+        # Create and bind socket.
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(("0.0.0.0", localPort))
+        self.socket.setblocking(False)
+        self.localPort = self.socket.getsockname()[1]
+
+        self.remoteHost = remoteHost if remoteHost else "localhost"
+        self.remotePort = remotePort if remotePort else self.localPort
+
+        # Resolve the server's address once, rather than per session.
+        self._remoteAddress = socket.getaddrinfo(self.remoteHost,
+                                                 self.remotePort,
+                                                 socket.AF_INET,
+                                                 socket.SOCK_DGRAM)[0][4]
+
+        # Table of {source address: UdpSession}, least recently active
+        # first.
+        self._sessions = collections.OrderedDict()
+
+        # Time of the next check for idle sessions.
+        self._idleTimeout = idleTimeout
+        self._nextExpiry = None
+
+        # Receive buffer, reused for datagrams that are forwarded
+        # without being queued as events.
+        self._buffer = bytearray(self.MAX_DATAGRAM)
+
+        # Check for idle sessions from the event loop.
+        self.dispatcher.add_generator(self)
+        return
+
+    def get_sockets(self):
+        """Get the sockets for this listener."""
+        return [self.socket]
+
+    def get_sessions(self):
+        """Get the active sessions for this listener."""
+        return list(self._sessions.values())
+
+    def get_idle_timeout(self):
+        """Return the idle timeout for sessions, in seconds."""
+        return self._idleTimeout
+
+    def set_idle_timeout(self, idleTimeout):
+        """Set the idle timeout for sessions, in seconds."""
+        self._idleTimeout = idleTimeout
+        self._nextExpiry = None
+        return
+
+    def on_readable(self, sock):
+        """Callback when socket is readable.
+
+        Receives datagrams until none are waiting, or the budget is used
+        up (so other sources get a turn)."""
+
+        buf = self._buffer
+        now = time.time()
+        for i in range(self.RECV_BUDGET):
+            try:
+                n, address = self.socket.recvfrom_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP errors from earlier sends are reported here.
+                continue
+
+            session = self._sessions.get(address)
+            if session is None:
+                session = self._start_session(address)
+                if session is None:
+                    continue
+            session._lastActive = now
+            self._sessions.move_to_end(address)
+            session.on_datagram(memoryview(buf)[:n])
+        return
+
+    def _start_session(self, address):
+        """Create a session for datagrams from 'address'."""
 
+        connection = monjon.core.Connection()
+        connection._listener = self
+        connection._src = address
+        connection._dst = self._remoteAddress
+        connection._proto = "udp"
+
+        try:
+            session = UdpSession(self.dispatcher, self, address,
+                                 self._remoteAddress, connection)
+        except OSError:
+            # Out of descriptors: drop the datagram.
+            return None
+        self._sessions[address] = session
+        self._stats.add_accept()
+
+        if self._nextExpiry is None:
+            self._nextExpiry = time.time() + self._idleTimeout
+
+        # There's nothing to accept, so the event's action does nothing,
+        # but it can be broken on like a TCP accept.
+        if self.dispatcher.wants_event(self, "accept"):
+            e = monjon.core.AcceptEvent(self)
+            e._connection = connection
+            e.set_action(lambda event: None)
+            e.set_context((None, address))
+            self.dispatcher.queue_event(e)
+        return session
+
+    def generate(self):
+        """Evict idle sessions, and return the delay until the next check."""
+
+        if self._nextExpiry is None:
+            return None
+
+        now = time.time()
+        if now < self._nextExpiry:
+            return self._nextExpiry - now
+
+        # Sessions are in order of activity, so evict from the head
+        # until one is found that has been active too recently.
+        limit = now - self._idleTimeout
+        sessions = self._sessions
+        while sessions:
+            address, session = next(iter(sessions.items()))
+            if session._lastActive > limit:
+                break
+            del sessions[address]
+            session.expire()
+
+        # Next check is when the session at the head could expire.
+        if sessions:
+            session = next(iter(sessions.values()))
+            self._nextExpiry = session._lastActive + self._idleTimeout
+            return self._nextExpiry - now
+
+        self._nextExpiry = None
+        return None
+
+    def send_to_client(self, address, buf):
+        """Send a datagram to the client at 'address'.
+
+        If the socket's send buffer is full, the datagram is dropped,
+        as it would be by a congested network."""
+
+        try:
+            self.socket.sendto(buf, address)
+        except OSError:
+            pass
+        return
+
+    def on_writeable(self, sock):
+        return
+
+    def __repr__(self):
+        return "<UDP Listener: %u -> %s:%u>" % (self.localPort,
+                                                self.remoteHost,
+                                                self.remotePort)
+
+
+class UdpSession(monjon.core.EventSource):
+    """A proxied UDP flow, between one client address and the server.
+
+    Datagrams from the client arrive through the UDPListener, and are
+    sent to the server from this session's own (connected) socket, so
+    the server's replies arrive here and can be sent back from the
+    listener's socket to the client.
+
+    As with TCP, a datagram is only queued as an event if something
+    could break on it: otherwise it's forwarded immediately."""
+
+    def __init__(self, dispatcher, listener, address, remoteAddress,
+                 connection):
+        super().__init__()
+        self._dispatcher = dispatcher
+        self._listener = listener
+        self._parent = listener
+        self._address = address
+        self._remoteAddress = remoteAddress
+        self._connection = connection
+
+        # Time of the last datagram in either direction.
+        self._lastActive = time.time()
+
+        self._stats.set_parent(listener.get_stats())
+
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._server.setblocking(False)
+        self._server.connect(remoteAddress)
+        self.set_state("connected")
+
+        self._dispatcher.register_source(self)
+        return
+
+    def get_connection(self):
+        """Return the Connection for this session."""
+        return self._connection
+
+    def get_sockets(self):
+        return [self._server]
+
+    def on_datagram(self, view):
+        """Handle a datagram from the client, passed by the listener.
+
+        'view' is only valid until this returns."""
+
+        self._stats.add_recv(True, len(view))
+        history = self._dispatcher.get_history()
+        if history:
+            history.record(self._connection, "server_recv", view)
+
+        if not self._dispatcher.wants_event(self, "server_recv"):
+            self._send_to_server(view)
+            return
+
+        e = monjon.core.ServerReceiveEvent(self)
+        e.set_packet(monjon.core.Packet(bytes(view), self._connection))
+        e.set_action(self.send_to_server)
+        self._dispatcher.queue_event(e)
+        return
+
+    def on_readable(self, sock):
+        """Receive a batch of datagrams from the server."""
+
+        buf = self._listener._buffer
+        history = self._dispatcher.get_history()
+        wanted = self._dispatcher.wants_event(self, "client_recv")
+        events = []
+
+        # Traffic from the server keeps the session alive too (for
+        # feeds where the client only subscribes).
+        self._lastActive = time.time()
+        sessions = self._listener._sessions
+        if sessions.get(self._address) is self:
+            sessions.move_to_end(self._address)
+        for i in range(UDPListener.RECV_BUDGET):
+            try:
+                n = self._server.recv_into(buf)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # ICMP port unreachable, etc.
+                continue
+
+            view = memoryview(buf)[:n]
+            self._stats.add_recv(False, n)
+            if history:
+                history.record(self._connection, "client_recv", view)
+
+            if not wanted and not events:
+                self._listener.send_to_client(self._address, view)
+                continue
+
+            e = monjon.core.ClientReceiveEvent(self)
+            e.set_packet(monjon.core.Packet(bytes(view), self._connection))
+            e.set_action(self.send_to_client)
+            events.append(e)
+
+        if events:
+            self._dispatcher.queue_events(events)
+        return
+
+    def on_writeable(self, sock):
+        return
+
+    def send_to_client(self, event):
+        self._listener.send_to_client(self._address,
+                                      event.get_packet().get_payload())
+        return
+
+    def send_to_server(self, event):
+        self._send_to_server(event.get_packet().get_payload())
+        return
+
+    def _send_to_server(self, buf):
+        if not self._server:
+            return
+        try:
+            self._server.send(buf)
+        except OSError:
+            # Dropped, as by a congested network.
+            pass
+        return
+
+    def expire(self):
+        """Called by the listener when this session has been idle."""
+
+        if self._dispatcher.wants_event(self, "close"):
+            e = monjon.core.CloseEvent(self)
+            e._connection = self._connection
+            e.set_action(self.close)
+            self._dispatcher.queue_event(e)
+        else:
+            self._do_close()
+        return
+
+    def close(self, event):
+        self._do_close()
+        return
+
+    def _do_close(self):
+        if not self._server:
+            return
+
+        self._dispatcher.deregister_source(self)
+        self._server.close()
+        self._server = None
+        self.set_state("closed")
+        self._stats.add_close()
+
+        # Forget the session, if it's still the one for its address.
+        if self._listener._sessions.get(self._address) is self:
+            del self._listener._sessions[self._address]
+        return
+
+    def __repr__(self):
+        return "<UDP Session: %s:%hu -> %s:%hu>" % (self._address[0],
+                                                    self._address[1],
+                                                    self._remoteAddress[0],
+                                                    self._remoteAddress[1])
@@ -0,0 +1,497 @@
+# -*- python -*-
+########################################################################
+#HEADER_BEGIN
+# Copyright 2013, David Arnold.
+#
+# This file is part of Monjon.
+#
+# Monjon is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Monjon is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Monjon.  If not, see <http://www.gnu.org/licenses/>.
+#HEADER_END
+########################################################################
+
+
+import json, multiprocessing, socket, time
+import monjon.core
+import monjon.proxy
+
+
+class Channel(monjon.core.EventSource):
+    """A message channel over a stream socket.
+
+    Messages are JSON objects, one per line.  The channel is registered
+    with a Dispatcher, and calls 'handler(channel, message)' for each
+    message received, and 'handler(channel, None)' when the other end
+    closes it.
+
+    The socket is non-blocking, so sending never waits for the other
+    end to read: whatever the kernel won't take is buffered, and sent
+    as the socket becomes writeable.  If 'limit' is set and more than
+    'limit' bytes are waiting, the other end is assumed to be stuck,
+    and the channel is closed as if it had closed it."""
+
+    def __init__(self, dispatcher, sock, handler, limit=None):
+        super().__init__()
+        self._dispatcher = dispatcher
+        self._socket = sock
+        self._handler = handler
+        self._limit = limit
+
+        # Partial line received so far.
+        self._buffer = b""
+
+        # Outbound data not yet accepted by the kernel.
+        self._out = bytearray()
+
+        # False while the owner doesn't want messages handled.
+        self._reading = True
+
+        self._socket.setblocking(False)
+        self._dispatcher.register_source(self)
+        return
+
+    def get_sockets(self):
+        return [self._socket]
+
+    def get_pending(self):
+        """Return the number of bytes waiting to be sent."""
+        return len(self._out)
+
+    def send(self, message):
+        """Send a message to the other end."""
+
+        if not self._socket:
+            return
+
+        data = json.dumps(message).encode() + b"\n"
+        if not self._out:
+            try:
+                n = self._socket.send(data)
+            except (BlockingIOError, InterruptedError):
+                n = 0
+            except OSError:
+                self._disconnect()
+                return
+            if n == len(data):
+                return
+            data = data[n:]
+
+        if self._limit is not None and \
+           len(self._out) + len(data) > self._limit:
+            self._disconnect()
+            return
+
+        self._out += data
+        self.update_interest()
+        return
+
+    def set_reading(self, reading):
+        """Stop (or restart) reading messages.
+
+        Buffered data is still sent meanwhile."""
+
+        self._reading = reading
+        self.update_interest()
+        return
+
+    def update_interest(self):
+        """Poll for writeability only while data is waiting."""
+
+        if self._socket:
+            events = monjon.core.POLL_READ if self._reading else 0
+            if self._out:
+                events |= monjon.core.POLL_WRITE
+            self._dispatcher.set_interest(self._socket, events)
+        return
+
+    def on_readable(self, sock):
+        try:
+            buf = self._socket.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            buf = b""
+
+        if not buf:
+            self._disconnect()
+            return
+
+        lines = (self._buffer + buf).split(b"\n")
+        self._buffer = lines.pop()
+        for line in lines:
+            if line.strip():
+                self._handler(self, json.loads(line.decode()))
+        return
+
+    def on_writeable(self, sock):
+        while self._out:
+            try:
+                n = self._socket.send(self._out)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                self._disconnect()
+                return
+            del self._out[:n]
+
+        self.update_interest()
+        return
+
+    def close(self):
+        if self._socket:
+            self._dispatcher.deregister_source(self)
+            self._socket.close()
+            self._socket = None
+            self._out = bytearray()
+        return
+
+    def _disconnect(self):
+        """Close the channel, and tell the handler."""
+
+        if self._socket:
+            self.close()
+            self._handler(self, None)
+        return
+
+    def __repr__(self):
+        return "<Channel: %s>" % (self._socket.fileno() if self._socket
+                                  else "closed")
+
+
+class Worker(monjon.core.Listener, monjon.core.EventSource):
+    """Proxy worker, running in a child process.
+
+    Listens and sets breakpoints as told by its Controller, and sends
+    it break notifications and periodic statistics.  Breakpoints don't
+    stop a worker (there's nobody to resume it): they're reported, and
+    traffic continues."""
+
+    # Seconds between statistics reports.
+    STATS_INTERVAL = 1.0
+
+    def __init__(self, dispatcher, index, sock):
+        monjon.core.EventSource.__init__(self)
+        self._dispatcher = dispatcher
+        self._index = index
+
+        # Listeners, in the order the Controller created them.
+        self._listeners = []
+
+        # Table of {controller breakpoint id: Breakpoint}, and the id
+        # for the breakpoint being set.
+        self._breakpoints = {}
+        self._breakpointId = None
+
+        # Number of breakpoints hit.
+        self._breaks = 0
+
+        self._nextStats = time.time()
+
+        self._dispatcher.set_listener(self)
+        self._channel = Channel(dispatcher, sock, self.on_message)
+        self._dispatcher.register_source(self)
+        self._dispatcher.add_generator(self)
+        return
+
+    def generate(self):
+        """Send statistics when they're due."""
+
+        now = time.time()
+        if now >= self._nextStats:
+            self._channel.send(self.get_stats())
+            self._nextStats = now + self.STATS_INTERVAL
+        return self._nextStats - now
+
+    def get_stats(self):
+        """Return a statistics message."""
+
+        sessions = 0
+        listeners = [l for l in self._listeners if l is not None]
+        for listener in listeners:
+            for session in listener.get_sessions():
+                if session.get_state() != "closed":
+                    sessions += 1
+
+        stats = self._dispatcher.get_stats()
+        return {"type": "stats",
+                "worker": self._index,
+                "listeners": len(listeners),
+                "sessions": sessions,
+                "breaks": self._breaks,
+                "queued": stats["queued"],
+                "server_recv_bytes": stats["server_recv_bytes"],
+                "client_recv_bytes": stats["client_recv_bytes"],
+                "accepts": stats["accepts"],
+                "closes": stats["closes"],
+                "events": stats["events"],
+                "events_per_s": stats["events_per_s"],
+                "dispatch_time": stats["dispatch_time"]}
+
+    def on_message(self, channel, message):
+        """Handle a message from the Controller."""
+
+        if message is None or message["cmd"] == "stop":
+            # Stop once any queued events have been processed.
+            e = monjon.core.Event(self, "stop")
+            e.set_action(lambda event: self._dispatcher.stop())
+            self._dispatcher.queue_event(e)
+
+        elif message["cmd"] == "listen":
+            try:
+                listener = monjon.proxy.TCPListener(self._dispatcher,
+                                                    message["localPort"],
+                                                    message["remoteHost"],
+                                                    message["remotePort"],
+                                                    message["backlog"],
+                                                    reusePort=True)
+            except OSError as e:
+                # Keep the listener indices in step with the Controller.
+                self._listeners.append(None)
+                channel.send({"type": "error", "worker": self._index,
+                              "message": "listen on port %u: %s" %
+                                         (message["localPort"], e)})
+                return
+            self._dispatcher.register_source(listener)
+            self._listeners.append(listener)
+
+        elif message["cmd"] == "breakpoint":
+            index = message["listener"]
+            source = self._listeners[index] if index is not None else None
+            if index is not None and source is None:
+                # Its listen failed, and was reported then.
+                return
+            self._breakpointId = message["id"]
+            try:
+                self._dispatcher.set_breakpoint(source, message["event"],
+                                                message["condition"])
+            except SyntaxError as e:
+                channel.send({"type": "error", "worker": self._index,
+                              "message": str(e)})
+
+        elif message["cmd"] == "clear":
+            bp = self._breakpoints.get(message["breakpoint"])
+            if bp:
+                bp.clear()
+        return
+
+    def on_set_breakpoint(self, breakpoint):
+        # File it under the Controller's identifier.  A new breakpoint
+        # replaces any for the same source and event.
+        for name, bp in list(self._breakpoints.items()):
+            if (bp.get_source() is breakpoint.get_source() and
+                bp.get_event() == breakpoint.get_event()):
+                del self._breakpoints[name]
+        self._breakpoints[self._breakpointId] = breakpoint
+        return
+
+    def on_clear_breakpoint(self, breakpoint):
+        self._breakpoints.pop(self._get_breakpoint_id(breakpoint), None)
+        return
+
+    def _get_breakpoint_id(self, breakpoint):
+        """Return the Controller's identifier for 'breakpoint'."""
+
+        for name, bp in self._breakpoints.items():
+            if bp is breakpoint:
+                return name
+        return None
+
+    def on_break(self, breakpoint, event):
+        self._breaks += 1
+        self._channel.send({"type": "break",
+                            "worker": self._index,
+                            "breakpoint": self._get_breakpoint_id(breakpoint),
+                            "event": event.get_type(),
+                            "description": event.get_description()})
+        return
+
+    def __repr__(self):
+        return "<Worker %u>" % self._index
+
+
+def run_worker(index, sock, inherited=()):
+    """Entry point for a worker process.
+
+    'inherited' are the Controller's ends of the channels, which a
+    forked worker must close so that it sees the Controller exit."""
+
+    for s in inherited:
+        s.close()
+
+    dispatcher = monjon.core.Dispatcher()
+    Worker(dispatcher, index, sock)
+    dispatcher.run()
+    return
+
+
+class Controller:
+    """Runs proxy workers in several processes.
+
+    Each worker is a separate process with its own Dispatcher, and
+    each listens on the same ports using SO_REUSEPORT, so the kernel
+    spreads connections (and so the forwarding load) across them.
+
+    The Controller pushes listeners and breakpoints to every worker,
+    and collects their break notifications and statistics over a Unix
+    socket pair per worker.  Its channels are sources in the parent
+    process's 'dispatcher'."""
+
+    def __init__(self, dispatcher, workers=None):
+        self._dispatcher = dispatcher
+        self._count = workers if workers else multiprocessing.cpu_count()
+
+        # Table of {worker index: (Process, Channel)}
+        self._workers = {}
+
+        # Table of {worker index: latest stats message}
+        self._stats = {}
+
+        # Messages sent to every worker so far, replayed to workers
+        # that are (re)started later.
+        self._config = []
+
+        # Sockets reserving each listener's port, and their ports.
+        self._reservations = []
+
+        # Next breakpoint identifier, used by every worker.
+        self._nextBreakpoint = 0
+
+        # Callback for break notifications and errors.
+        self._onMessage = None
+        return
+
+    def set_callback(self, callback):
+        """Set a function to call with break and error messages."""
+        self._onMessage = callback
+        return
+
+    def start(self):
+        """Start the worker processes."""
+
+        for index in range(self._count):
+            parent, child = socket.socketpair()
+            inherited = [c._socket for p, c in self._workers.values()]
+            inherited.append(parent)
+            process = multiprocessing.Process(target=run_worker,
+                                              args=(index, child, inherited),
+                                              name="monjon worker %u" % index)
+            process.daemon = True
+            process.start()
+            child.close()
+
+            channel = Channel(self._dispatcher, parent, self._on_message)
+            self._workers[index] = (process, channel)
+            for message in self._config:
+                channel.send(message)
+        return
+
+    def stop(self):
+        """Stop the worker processes, and wait for them to exit."""
+
+        self._broadcast({"cmd": "stop"}, False)
+        for process, channel in self._workers.values():
+            process.join(5)
+            channel.close()
+        self._workers = {}
+
+        for sock in self._reservations:
+            sock.close()
+        self._reservations = []
+        return
+
+    def listen(self, localPort, remoteHost, remotePort, backlog=128):
+        """Listen on 'localPort' in every worker.
+
+        Returns the listener's index, for use with set_breakpoint(), and
+        its port (which is chosen here if 'localPort' is zero)."""
+
+        if remotePort == 0 and remoteHost is None:
+            raise AttributeError("Cannot use default remote host and "
+                                 "default remote port")
+
+        # Bind (but don't listen on) a socket in this process, to pick
+        # the port and keep it reserved for the workers.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(("0.0.0.0", localPort))
+        localPort = sock.getsockname()[1]
+        self._reservations.append(sock)
+
+        self._broadcast({"cmd": "listen",
+                         "localPort": localPort,
+                         "remoteHost": remoteHost if remoteHost
+                                       else "localhost",
+                         "remotePort": remotePort if remotePort
+                                       else localPort,
+                         "backlog": backlog})
+        return len(self._reservations) - 1, localPort
+
+    def set_breakpoint(self, listener, event, condition="True"):
+        """Set a breakpoint in every worker.
+
+        'listener' is a listener index from listen(), or None for all
+        sources.  Returns the breakpoint's identifier.  Raises
+        SyntaxError here if the condition cannot be compiled."""
+
+        compile(condition.strip(), "<breakpoint>", "eval")
+
+        self._broadcast({"cmd": "breakpoint",
+                         "id": self._nextBreakpoint,
+                         "listener": listener,
+                         "event": str(event),
+                         "condition": condition})
+        self._nextBreakpoint += 1
+        return self._nextBreakpoint - 1
+
+    def clear_breakpoint(self, breakpoint):
+        """Clear a breakpoint in every worker."""
+
+        self._broadcast({"cmd": "clear", "breakpoint": breakpoint})
+        return
+
+    def get_stats(self):
+        """Return statistics summed over all workers."""
+
+        total = {"workers": len(self._stats),
+                 "listeners": len(self._reservations)}
+        for stats in self._stats.values():
+            for key, value in stats.items():
+                if key not in ("type", "worker", "listeners"):
+                    total[key] = total.get(key, 0) + value
+        return total
+
+    def get_worker_stats(self):
+        """Return a table of {worker index: statistics}."""
+        return dict(self._stats)
+
+    def _broadcast(self, message, keep=True):
+        if keep:
+            self._config.append(message)
+        for process, channel in self._workers.values():
+            channel.send(message)
+        return
+
+    def _on_message(self, channel, message):
+        if message is None:
+            # Worker has exited.
+            for index, (process, c) in list(self._workers.items()):
+                if c is channel:
+                    self._stats.pop(index, None)
+            return
+
+        if message["type"] == "stats":
+            self._stats[message["worker"]] = message
+        elif self._onMessage:
+            self._onMessage(message)
+        return
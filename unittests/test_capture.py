@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import errno, os, struct, tempfile, time
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.capture
+import monjon.core
+
+
+class EventLog:
+    """Capture sink which keeps a list of dispatched events."""
+
+    def __init__(self, events):
+        self.events = events
+        return
+
+    def on_event(self, event):
+        self.events.append(event)
+        return
+
+
+class TestCapture(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix=".pcapng")
+        os.close(fd)
+        return
+
+    def tearDown(self):
+        os.unlink(self.filename)
+        return
+
+    def write_capture(self):
+        connection = monjon.core.Connection()
+        connection._src = ("10.0.0.1", 40000)
+        connection._dst = ("10.0.0.2", 80)
+
+        source = monjon.core.EventSource()
+        writer = monjon.capture.PcapngWriter(self.filename)
+        for event, payload in ((monjon.core.ServerReceiveEvent, b"GET /"),
+                               (monjon.core.ClientReceiveEvent, b"200 OK"),
+                               (monjon.core.CloseEvent, None)):
+            e = event(source)
+            if payload:
+                e.set_packet(monjon.core.Packet(payload, connection))
+            else:
+                e._connection = connection
+            writer.on_event(e)
+        writer.close()
+
+        # Handshake, two data packets, and two FINs.
+        self.assertEqual(writer.get_count(), 7)
+        return
+
+    def testWriter(self):
+        self.write_capture()
+
+        # Parse the blocks directly, independently of CaptureReader.
+        with open(self.filename, "rb") as f:
+            data = f.read()
+        blocks = []
+        offset = 0
+        while offset < len(data):
+            blockType, length = struct.unpack_from("<II", data, offset)
+            self.assertEqual(length % 4, 0)
+            self.assertEqual(struct.unpack_from("<I", data,
+                                                offset + length - 4)[0],
+                             length)
+            blocks.append((blockType, data[offset:offset + length]))
+            offset += length
+
+        self.assertEqual([t for t, b in blocks],
+                         [monjon.capture.SECTION_HEADER,
+                          monjon.capture.INTERFACE_DESCRIPTION] +
+                         [monjon.capture.ENHANCED_PACKET] * 7)
+
+        # Packets 4 and 5 carry the payloads, after IPv4 and TCP headers.
+        for block, payload in ((blocks[5][1], b"GET /"),
+                               (blocks[6][1], b"200 OK")):
+            captured = struct.unpack_from("<I", block, 20)[0]
+            packet = block[28:28 + captured]
+            self.assertEqual(packet[0] >> 4, 4)
+            self.assertEqual(packet[40:], payload)
+        return
+
+    def make_event(self, payload=b"GET /"):
+        connection = monjon.core.Connection()
+        connection._src = ("10.0.0.1", 40000)
+        connection._dst = ("10.0.0.2", 80)
+        e = monjon.core.ServerReceiveEvent(monjon.core.EventSource())
+        e.set_packet(monjon.core.Packet(payload, connection))
+        return e
+
+    def testAgeFlush(self):
+        dispatcher = monjon.core.Dispatcher()
+        writer = monjon.capture.PcapngWriter(self.filename, dispatcher)
+        writer.BATCH_AGE = 0.02
+        writer.on_event(self.make_event())
+        self.assertEqual(dispatcher.get_timer_count(), 1)
+
+        # With no more events, the timer hands the batch over.
+        deadline = time.time() + 2
+        while os.path.getsize(self.filename) == 0 and time.time() < deadline:
+            dispatcher._generate()
+        self.assertTrue(os.path.getsize(self.filename) > 0)
+        self.assertEqual(writer._batch, [])
+        writer.close()
+        self.assertEqual(dispatcher.get_timer_count(), 0)
+
+    def testWriteError(self):
+        writer = monjon.capture.PcapngWriter(self.filename)
+
+        class Full:
+            def write(self, data):
+                raise OSError(errno.ENOSPC, "No space left on device")
+
+            def close(self):
+                return
+
+        f, writer._file = writer._file, Full()
+        try:
+            writer.on_event(self.make_event())
+            writer.flush()
+
+            # The writer thread's error is raised by the next flush().
+            deadline = time.time() + 2
+            while writer._error is None and time.time() < deadline:
+                time.sleep(0.001)
+            self.assertRaises(OSError, writer.flush)
+
+            # Nothing more is captured, and close() reports the error.
+            writer.on_event(self.make_event())
+            self.assertEqual(writer._batch, [])
+            self.assertRaises(OSError, writer.close)
+        finally:
+            f.close()
+
+    def testRoundTrip(self):
+        self.write_capture()
+
+        dispatcher = monjon.core.Dispatcher()
+        replay = monjon.capture.CaptureReplay(dispatcher, self.filename)
+        events = []
+        dispatcher.add_capture(EventLog(events))
+
+        more = True
+        while more:
+            more = replay.generate() is not None
+            while dispatcher.get_queue_depth():
+                dispatcher.step()
+
+        self.assertEqual(replay.get_count(), 7)
+        self.assertEqual([e.get_type() for e in events],
+                         ["accept", "server_recv", "client_recv", "close"])
+        self.assertEqual(bytes(events[1].get_packet().get_payload()),
+                         b"GET /")
+
+        connection = events[0].get_connection()
+        self.assertEqual(connection._src, ("10.0.0.1", 40000))
+        self.assertEqual(connection._dst, ("10.0.0.2", 80))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,169 @@
+#! /usr/bin/env python
+
+import os, socket, stat, tempfile, threading, time
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.control
+import monjon.core
+
+
+class TestControl(unittest.TestCase):
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "control.sock")
+        self.dispatcher = monjon.core.Dispatcher()
+        self.server = monjon.control.ControlServer(self.dispatcher,
+                                                   self.path)
+        self.thread = threading.Thread(target=self.server.serve)
+        self.thread.start()
+        self.client = monjon.control.ControlClient(self.path)
+
+        self.upstream = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.upstream.bind(("127.0.0.1", 0))
+        self.upstream.listen(1)
+        self.upstream.settimeout(2)
+        return
+
+    def tearDown(self):
+        self.client.stop()
+        self.thread.join(2)
+        self.client.close()
+        self.server.close()
+        self.upstream.close()
+        os.rmdir(os.path.dirname(self.path))
+        return
+
+    def testSession(self):
+        c = self.client
+        result = c.listen(0, "127.0.0.1", self.upstream.getsockname()[1])
+        sock = socket.create_connection(("127.0.0.1", result["localPort"]))
+        server, address = self.upstream.accept()
+        server.settimeout(2)
+
+        # Traffic flows with nobody at a prompt.
+        sock.sendall(b"hello")
+        self.assertEqual(server.recv(100), b"hello")
+
+        # A stopping breakpoint pauses forwarding.
+        bp = c.breakpoint(None, "server_recv", "True")
+        sock.sendall(b"x")
+        notifications = c.get_notifications(2)
+        self.assertEqual(notifications[0]["breakpoint"], bp)
+        self.assertTrue(notifications[0]["paused"])
+        self.assertEqual(server.recv(100), b"x")
+
+        sock.sendall(b"y")
+        server.settimeout(0.2)
+        self.assertRaises(socket.timeout, server.recv, 100)
+
+        # Step through it, then carry on without the breakpoint.
+        events = c.step()
+        self.assertEqual(events[0]["event"], "server_recv")
+        server.settimeout(2)
+        self.assertEqual(server.recv(100), b"y")
+
+        state = c.inspect()
+        self.assertTrue(state["paused"])
+        self.assertEqual(len(state["sources"]), 2)
+        self.assertEqual(state["breakpoints"][0]["breakpoint"], bp)
+
+        stats = c.stats(result["source"])["stats"]
+        self.assertEqual(stats["server_recv_bytes"], 7)
+        self.assertEqual(c.stats()["total"]["accepts"], 1)
+
+        c.clear(bp)
+        c.resume()
+        sock.sendall(b"z")
+        self.assertEqual(server.recv(100), b"z")
+
+        session = c.inspect(result["source"])["source"]["sessions"][0]
+        self.assertEqual(c.inspect(session)["source"]["state"], "connected")
+
+        sock.close()
+        server.close()
+        return
+
+    def testProfile(self):
+        c = self.client
+        c.profile()
+        result = c.listen(0, "127.0.0.1", self.upstream.getsockname()[1])
+        sock = socket.create_connection(("127.0.0.1", result["localPort"]))
+        server, address = self.upstream.accept()
+        server.settimeout(2)
+        sock.sendall(b"hello")
+        self.assertEqual(server.recv(100), b"hello")
+
+        report = c.profile(False)["profile"]
+        self.assertTrue(report["phases"]["poll"]["count"] > 0)
+        self.assertTrue(report["phases"]["io"]["count"] > 0)
+        self.assertRaises(monjon.control.ControlError, c.profile, False)
+
+        sock.close()
+        server.close()
+        return
+
+    def testPermissions(self):
+        mode = os.stat(self.path).st_mode
+        self.assertTrue(stat.S_ISSOCK(mode))
+        self.assertEqual(stat.S_IMODE(mode), 0o600)
+        return
+
+    def testStuckClient(self):
+        c = self.client
+        self.server.CLIENT_LIMIT = 16 * 1024
+
+        # A client that never reads its notifications.
+        stuck = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stuck.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        stuck.connect(self.path)
+        deadline = time.time() + 2
+        while len(self.server.get_clients()) < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(self.server.get_clients()), 2)
+
+        result = c.listen(0, "127.0.0.1", self.upstream.getsockname()[1])
+        sock = socket.create_connection(("127.0.0.1", result["localPort"]))
+        server, address = self.upstream.accept()
+        server.settimeout(2)
+        c.breakpoint(None, "server_recv", "True", stop=False)
+
+        # Forwarding carries on, and the stuck client is dropped once
+        # too much is waiting for it.
+        deadline = time.time() + 5
+        while len(self.server.get_clients()) > 1 and time.time() < deadline:
+            sock.sendall(b"x" * 100)
+            data = b""
+            while len(data) < 100:
+                data += server.recv(100 - len(data))
+            c.get_notifications()
+        self.assertEqual(len(self.server.get_clients()), 1)
+
+        # Its buffered notifications are followed by the end of stream.
+        stuck.settimeout(2)
+        while stuck.recv(65536):
+            pass
+        stuck.close()
+
+        # Other clients are unaffected.
+        self.assertFalse(c.inspect()["paused"])
+        sock.close()
+        server.close()
+        return
+
+    def testErrors(self):
+        self.assertRaises(monjon.control.ControlError,
+                          self.client.breakpoint, None, "accept", "1 +")
+        self.assertRaises(monjon.control.ControlError,
+                          self.client.inspect, 99)
+        self.assertRaises(monjon.control.ControlError,
+                          self.client.request, "bogus")
+        return
+
+
+if __name__ == "__main__":
+    unittest.main()
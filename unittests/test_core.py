@@ -0,0 +1,406 @@
+#! /usr/bin/env python
+
+import socket
+import time
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.core
+
+
+class TestPoller(unittest.TestCase):
+
+    def check_poller(self, poller):
+        a, b = socket.socketpair()
+        try:
+            poller.register(a, monjon.core.POLL_READ)
+            self.assertEqual(poller.poll(0), [])
+
+            b.send(b"x")
+            self.assertEqual(poller.poll(1), [(a, True, False)])
+
+            poller.modify(a, monjon.core.POLL_READ | monjon.core.POLL_WRITE)
+            self.assertEqual(poller.poll(1), [(a, True, True)])
+
+            poller.unregister(a)
+            self.assertEqual(poller.poll(0), [])
+        finally:
+            poller.close()
+            a.close()
+            b.close()
+
+    def testSelectorPoller(self):
+        self.check_poller(monjon.core.SelectorPoller())
+
+    def testAsyncioPoller(self):
+        loop = monjon.core.asyncio.new_event_loop()
+        try:
+            self.check_poller(monjon.core.AsyncioPoller(loop))
+        finally:
+            loop.close()
+
+    def testEpollPoller(self):
+        if not hasattr(monjon.core.select, "epoll"):
+            raise unittest.SkipTest("epoll not available")
+        self.check_poller(monjon.core.EpollPoller())
+
+
+class TestEventQueue(unittest.TestCase):
+
+    def testRoundRobin(self):
+        a = monjon.core.EventSource()
+        b = monjon.core.EventSource()
+        q = monjon.core.EventQueue()
+
+        events = [monjon.core.Event(a, "a%u" % i) for i in range(3)]
+        events.append(monjon.core.Event(b, "b0"))
+        for e in events:
+            q.put(e)
+
+        self.assertEqual(len(q), 4)
+        self.assertEqual(q.get_depth(a), 3)
+        self.assertEqual(q.get_depth(b), 1)
+
+        order = [q.get().get_type() for i in range(4)]
+        self.assertEqual(order, ["a0", "b0", "a1", "a2"])
+        self.assertEqual(len(q), 0)
+        self.assertEqual(q.get_depths(), {})
+
+
+class TestBufferPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = monjon.core.BufferPool(size=64, limit=2)
+        self.sockets = socket.socketpair()
+        return
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        return
+
+    def receive(self, data):
+        """Send 'data' over the socket pair, and receive it into a
+        Packet using a pooled buffer."""
+
+        self.sockets[0].sendall(data)
+        buf = self.pool.get()
+        n = self.sockets[1].recv_into(buf)
+        return buf, monjon.core.Packet(memoryview(buf)[:n], None,
+                                       lambda: self.pool.put(buf))
+
+    def testRecycle(self):
+        buf, packet = self.receive(b"GET /first")
+        packet.retain()
+
+        # The buffer went back to the pool, and is reused and refilled.
+        buf2, packet2 = self.receive(b"PUT /again")
+        self.assertTrue(buf2 is buf)
+        self.assertEqual(bytes(packet2.get_payload()), b"PUT /again")
+
+        # The retained payload is unchanged.
+        self.assertEqual(packet.get_payload(), b"GET /first")
+
+        # Released buffers come back from the pool, and the stale view
+        # can't be used.
+        payload = packet2.get_payload()
+        packet2.release()
+        self.assertRaises(ValueError, bytes, payload)
+        self.assertTrue(self.pool.get() is buf)
+
+    def testLimit(self):
+        buffers = [self.pool.get() for i in range(3)]
+        self.assertEqual(len(set(map(id, buffers))), 3)
+        for buf in buffers:
+            self.pool.put(buf)
+
+        # Only 'limit' free buffers are kept.
+        self.assertTrue(self.pool.get() is buffers[1])
+        self.assertTrue(self.pool.get() is buffers[0])
+        self.assertEqual(len(self.pool.get()), 64)
+
+
+class TestPacket(unittest.TestCase):
+
+    def testDump(self):
+        p = monjon.core.Packet(memoryview(b"0123456789abcdefGET /\r\n"), None)
+        self.assertEqual(p.dump(),
+                         "0000   30 31 32 33 34 35 36 37   "
+                         "38 39 61 62 63 64 65 66   |0123456789abcdef|\n"
+                         "0010   47 45 54 20 2f 0d 0a                 "
+                         "               |GET /..         |\n")
+
+    def testDumpRange(self):
+        p = monjon.core.Packet(bytes(100), None)
+        lines = list(p.dump_lines(32, 20))
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith("0020   00"))
+        self.assertTrue(lines[1].startswith("0030   00 00 00 00    "))
+
+
+class TestTrafficHistory(unittest.TestCase):
+
+    def testSpill(self):
+        history = monjon.core.TrafficHistory(memory=30, perConnection=20,
+                                             disk=20)
+        a = monjon.core.Connection()
+        b = monjon.core.Connection()
+        try:
+            for i in range(3):
+                history.record(a, "server_recv", b"a%u" % i * 5)
+            segs = a.get_history()
+            self.assertEqual(len(segs), 3)
+            self.assertTrue(segs[0].is_spilled())
+            self.assertFalse(segs[2].is_spilled())
+            self.assertEqual(bytes(segs[0].get_payload()), b"a0" * 5)
+
+            for i in range(3):
+                history.record(b, "client_recv", b"b%u" % i * 5)
+            self.assertTrue(history.get_memory_bytes() <= 30)
+
+            # Disk holds two segments: the oldest is lost.
+            segs = a.get_history()
+            self.assertEqual(len(segs), 2)
+            self.assertEqual(bytes(segs[0].get_payload()), b"a1" * 5)
+            self.assertEqual(len(b.get_history("client_recv")), 3)
+            self.assertEqual(b.get_history("server_recv"), [])
+        finally:
+            history.close()
+
+    def testClose(self):
+        history = monjon.core.TrafficHistory(memory=100, perConnection=10,
+                                             disk=100)
+        a = monjon.core.Connection()
+        for i in range(3):
+            history.record(a, "server_recv", b"a%u" % i * 5)
+        self.assertTrue(a.get_history()[0].is_spilled())
+
+        # Closing loses spilled segments, but not those in memory.
+        history.close()
+        segs = a.get_history()
+        self.assertEqual(len(segs), 1)
+        self.assertEqual(bytes(segs[0].get_payload()), b"a2" * 5)
+        return
+
+
+class BreakListener(monjon.core.Listener):
+
+    def __init__(self):
+        self.breaks = []
+        return
+
+    def on_break(self, breakpoint, event):
+        self.breaks.append((breakpoint, event))
+        return
+
+
+def make_recv_event(source, payload):
+    e = monjon.core.ServerReceiveEvent(source)
+    e.set_packet(monjon.core.Packet(memoryview(payload), None))
+    e.set_action(lambda event: None)
+    return e
+
+
+class TestByteStream(unittest.TestCase):
+
+    def setUp(self):
+        self.stream = monjon.core.ByteStream()
+        self.stream.BLOCK = 16
+        return
+
+    def testSlice(self):
+        st = self.stream
+        for chunk in (b"0123456789", b"abcdef", b"ABCDEFGHIJ"):
+            st.append(memoryview(chunk))
+
+        self.assertEqual(len(st), 26)
+        self.assertEqual(bytes(st[8:12]), b"89ab")
+        self.assertEqual(bytes(st[-3:]), b"HIJ")
+        self.assertEqual(bytes(st[14:20]), b"efABCD")
+        self.assertEqual(st[16], ord("A"))
+        self.assertEqual(st.find(b"fAB"), 15)
+        self.assertEqual(st.find(b"fAB", 16), -1)
+
+        # Views are not copies, and stay valid as the stream grows.
+        view = st[16:18]
+        self.assertTrue(isinstance(view.obj, bytearray))
+        st.append(b"K")
+        self.assertEqual(bytes(view), b"AB")
+        self.assertEqual(bytes(st[24:27]), b"IJK")
+
+    def testRetention(self):
+        st = self.stream
+        st.set_retention(20)
+        for i in range(10):
+            st.append(b"%u" % i * 8)
+
+        self.assertEqual(st.get_end(), 80)
+        self.assertTrue(st.get_start() <= 60)
+        self.assertRaises(IndexError, st.__getitem__, slice(0, 8))
+        self.assertEqual(bytes(st[-20:]), b"7777" + b"8" * 8 + b"9" * 8)
+
+        # Data a reader hasn't consumed is kept.
+        st.consume(72)
+        for i in range(4):
+            st.append(b"x" * 8)
+        self.assertTrue(st.get_start() <= 72)
+        self.assertEqual(bytes(st[72:80]), b"9" * 8)
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.wheel = monjon.core.TimerWheel()
+        self.calls = []
+        return
+
+    def run_until(self, n, timeout=2):
+        """Advance the wheel until 'n' callbacks have been made."""
+
+        deadline = time.monotonic() + timeout
+        while len(self.calls) < n and time.monotonic() < deadline:
+            time.sleep(self.wheel.get_timeout() or 0.001)
+            self.wheel.advance()
+        return
+
+    def testOrder(self):
+        # 0.1 seconds is beyond the first level, so must be moved down.
+        for delay in (0.1, 0.03, 0.0, 0.01):
+            self.wheel.schedule(delay, self.calls.append, delay)
+        self.assertEqual(len(self.wheel), 4)
+
+        start = time.monotonic()
+        self.run_until(4)
+        self.assertEqual(self.calls, [0.0, 0.01, 0.03, 0.1])
+        self.assertTrue(time.monotonic() - start >= 0.099)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.wheel.get_timeout(), None)
+
+    def testCancel(self):
+        timer = self.wheel.schedule(0.01, self.calls.append, "cancelled")
+        self.wheel.schedule(0.02, self.calls.append, "kept")
+        timer.cancel()
+        self.assertTrue(timer.cancelled())
+
+        self.run_until(1)
+        time.sleep(0.01)
+        self.wheel.advance()
+        self.assertEqual(self.calls, ["kept"])
+
+    def testTimeout(self):
+        self.wheel.schedule(0.05, self.calls.append, 1)
+        timeout = self.wheel.get_timeout()
+        self.assertTrue(0 <= timeout <= 0.05 + self.wheel.get_tick())
+
+        # The Dispatcher polls no longer than its next timer.
+        d = monjon.core.Dispatcher()
+        d.call_later(0.02, self.calls.append, 2)
+        self.assertEqual(d.get_timer_count(), 1)
+        deadline = time.monotonic() + 2
+        while not self.calls and time.monotonic() < deadline:
+            d._generate()
+        self.assertEqual(self.calls, [2])
+        self.assertEqual(d.get_timer_count(), 0)
+
+
+class TestBreakpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = monjon.core.Dispatcher()
+        self.listener = BreakListener()
+        self.dispatcher.set_listener(self.listener)
+        self.source = monjon.core.EventSource()
+        return
+
+    def testCondition(self):
+        self.dispatcher.set_breakpoint(None, "server_recv",
+                                       "payload[:3] == b'GET'")
+        self.dispatcher.dispatch(make_recv_event(self.source, b"PUT /"))
+        self.assertEqual(self.listener.breaks, [])
+
+        self.dispatcher.dispatch(make_recv_event(self.source, b"GET /"))
+        self.assertEqual(len(self.listener.breaks), 1)
+
+    def testSourceBeforeGlobal(self):
+        self.dispatcher.set_breakpoint(self.source, "server_recv", "False")
+        self.dispatcher.set_breakpoint(None, "server_recv", "True")
+        self.dispatcher.dispatch(make_recv_event(self.source, b"x"))
+        self.assertEqual(self.listener.breaks[0][0].get_name(), 1)
+
+    def testPatternStream(self):
+        d = self.dispatcher
+        d.set_breakpoint(self.source, "server_recv",
+                         "bytes(payload) in (b'E', b'x')")
+        d.set_breakpoint(None, "server_recv", "True", match=[b"GET"])
+
+        # The global breakpoint's stream sees payloads that break on the
+        # source's breakpoint, so finds a match spanning one ...
+        for payload in (b"G", b"E", b"T"):
+            d.dispatch(make_recv_event(self.source, payload))
+        self.assertEqual([bp.get_name() for bp, e in self.listener.breaks],
+                         [0, 1])
+        self.assertEqual(self.listener.breaks[1][0].get_found(),
+                         [(b"GET", 3)])
+
+        # ... and doesn't match across one.
+        for payload in (b"GE", b"x", b"T"):
+            d.dispatch(make_recv_event(self.source, payload))
+        self.assertEqual([bp.get_name() for bp, e in self.listener.breaks],
+                         [0, 1, 0])
+
+    def testWantsEvent(self):
+        d = self.dispatcher
+        self.assertFalse(d.wants_event(self.source, "server_recv"))
+
+        d.set_breakpoint(self.source, "server_recv", "True")
+        self.assertTrue(d.wants_event(self.source, "server_recv"))
+        self.assertFalse(d.wants_event(self.source, "client_recv"))
+
+        d.get_breakpoints()[0].clear()
+        self.assertFalse(d.wants_event(self.source, "server_recv"))
+
+        d.set_breakpoint(None, "client_recv", "True")
+        self.assertTrue(d.wants_event(self.source, "client_recv"))
+
+    def testSyntaxError(self):
+        self.assertRaises(SyntaxError, self.dispatcher.set_breakpoint,
+                          None, "server_recv", "payload ==")
+        self.assertEqual(self.dispatcher.get_breakpoints(), {})
+
+
+class TestWatchpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = monjon.core.Dispatcher()
+        self.source = monjon.core.EventSource()
+        return
+
+    def testDependencies(self):
+        d = self.dispatcher
+        wp = d.set_watchpoint(self.source, "bytes > 100")
+        self.assertEqual(wp.get_events(), {"client_recv", "server_recv"})
+
+        wp = d.set_watchpoint(self.source,
+                              "[x for x in range(server_recv_packets)]")
+        self.assertEqual(wp.get_events(), {"server_recv"})
+
+        wp = d.set_watchpoint(self.source, "1")
+        self.assertEqual(wp.get_events(), set(monjon.core.Watchpoint.ALL))
+
+        self.assertTrue(d.wants_event(self.source, "server_recv"))
+        self.assertTrue(d.wants_event(self.source, "accept"))
+
+    def testErrors(self):
+        self.assertRaises(SyntaxError, self.dispatcher.set_watchpoint,
+                          self.source, "bytes >")
+        self.assertRaises(ValueError, self.dispatcher.set_watchpoint,
+                          None, "bytes")
+        self.assertEqual(self.dispatcher.get_watchpoints(), {})
+
+
+if __name__ == "__main__":
+    unittest.main()
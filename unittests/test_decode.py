@@ -0,0 +1,126 @@
+#! /usr/bin/env python
+
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.core
+import monjon.decode
+
+
+class DecoderTestCase(unittest.TestCase):
+
+    def decode(self, decoder, chunks, direction="server", close=False):
+        """Feed 'chunks' through 'decoder', returning the messages."""
+
+        stream = monjon.core.ByteStream()
+        state = decoder.new_state(direction)
+        start = 0
+        messages = []
+        for chunk in chunks:
+            stream.append(chunk)
+            while True:
+                end = decoder.frame(stream, start, state)
+                if end is None:
+                    break
+                messages.append(decoder.get_message(stream, start, end,
+                                                    state))
+                start = end
+        if close:
+            end = decoder.finish(stream, start, state)
+            if end is not None:
+                messages.append(decoder.get_message(stream, start, end,
+                                                    state))
+        return [m for m in messages if m is not None]
+
+
+class TestLineDecoder(DecoderTestCase):
+
+    def testLines(self):
+        messages = self.decode(monjon.decode.LineDecoder(b"\r\n"),
+                               [b"USER a\r", b"\nPASS", b" b\r\nQU"])
+        self.assertEqual([m.get_text() for m in messages],
+                         ["USER a", "PASS b"])
+        self.assertEqual(messages[1].get_start(), 8)
+
+
+class TestLengthPrefixDecoder(DecoderTestCase):
+
+    def testFrames(self):
+        data = b"\x00\x03abc\x00\x00\x00\x01z"
+        messages = self.decode(monjon.decode.LengthPrefixDecoder(2),
+                               [data[i:i + 1] for i in range(len(data))])
+        self.assertEqual([bytes(m.get_body()) for m in messages],
+                         [b"abc", b"", b"z"])
+        self.assertEqual(messages[0].get_length(), 3)
+
+    def testAdjust(self):
+        # Length includes the 4-byte header.
+        decoder = monjon.decode.LengthPrefixDecoder(4, "little", adjust=-4)
+        messages = self.decode(decoder, [b"\x06\x00\x00\x00hi\x04\x00"])
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(bytes(messages[0].get_body()), b"hi")
+
+
+class TestHttpDecoder(DecoderTestCase):
+
+    def testRequests(self):
+        data = (b"POST /a HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\n"
+                b"hello"
+                b"GET /b HTTP/1.1\r\nHost: x\r\n\r\n")
+        messages = self.decode(monjon.decode.HttpDecoder(),
+                               [data[:20], data[20:60], data[60:]])
+        self.assertEqual(len(messages), 2)
+        post, get = messages
+        self.assertEqual(post.get_method(), "POST")
+        self.assertEqual(post.get_target(), "/a")
+        self.assertEqual(post.get_header("content-length"), "5")
+        self.assertEqual(bytes(post.get_body()), b"hello")
+        self.assertEqual(get.get_method(), "GET")
+        self.assertEqual(get.get_start(), len(post))
+
+    def testFieldsAreLazy(self):
+        messages = self.decode(monjon.decode.HttpDecoder(),
+                               [b"GET / HTTP/1.1\r\n\r\n"])
+        self.assertEqual(messages[0]._headers, None)
+        self.assertEqual(messages[0].get_version(), "HTTP/1.1")
+        self.assertEqual(messages[0]._headers, [])
+
+    def testChunked(self):
+        data = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nhello\r\n3;x=y\r\nabc\r\n0\r\n\r\n"
+                b"HTTP/1.1 204 No Content\r\n\r\n")
+        messages = self.decode(monjon.decode.HttpDecoder(),
+                               [data[i:i + 7] for i in range(0, len(data), 7)],
+                               "client")
+        self.assertEqual([m.get_status() for m in messages], [200, 204])
+        self.assertTrue(bytes(messages[0].get_body()).endswith(b"0\r\n\r\n"))
+
+    def testBadChunkSize(self):
+        data = (b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n"
+                b"5\r\nhello\r\nzz\r\n0\r\n\r\n")
+        later = b"HTTP/1.1 204 No Content\r\n\r\n"
+        messages = self.decode(monjon.decode.HttpDecoder(), [data, later],
+                               "client", True)
+
+        # The message ends at the error, which is recorded, and nothing
+        # after it is framed as a message.
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0].get_status(), 200)
+        self.assertEqual(messages[0].get_end(), len(data))
+        self.assertEqual(messages[0].get_error(),
+                         "invalid chunk size b'zz' at offset 57")
+
+    def testUntilClose(self):
+        data = b"HTTP/1.0 200 OK\r\n\r\nall of it"
+        decoder = monjon.decode.HttpDecoder()
+        self.assertEqual(self.decode(decoder, [data], "client"), [])
+        messages = self.decode(decoder, [data], "client", True)
+        self.assertEqual(bytes(messages[0].get_body()), b"all of it")
+
+
+if __name__ == "__main__":
+    unittest.main()
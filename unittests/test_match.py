@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+
+import re
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.match
+
+
+class TestStreamMatcher(unittest.TestCase):
+
+    def scan(self, matcher, chunks):
+        stream = matcher.new_stream()
+        found = []
+        for chunk in chunks:
+            found.append(matcher.scan(stream, memoryview(chunk)))
+        return found
+
+    def testLiterals(self):
+        m = monjon.match.StreamMatcher([b"he", b"she", b"his", b"hers"])
+        found = self.scan(m, [b"ushe", b"rs his"])
+        self.assertEqual(found[0], [(b"she", 4), (b"he", 4)])
+        self.assertEqual(found[1], [(b"hers", 6), (b"his", 10)])
+
+    def testSplitEveryByte(self):
+        m = monjon.match.StreamMatcher([b"GET /admin"])
+        data = b"GET /index GET /admin GET /admin"
+        found = self.scan(m, [data[i:i + 1] for i in range(len(data))])
+        ends = [end for chunk in found for pattern, end in chunk]
+        self.assertEqual(ends, [21, 32])
+
+    def testRegex(self):
+        m = monjon.match.StreamMatcher([r"Cookie: \w+;",
+                                        re.compile(rb"\r\n\r\n")])
+        found = self.scan(m, [b"GET / HTTP/1.1\r\nCoo", b"kie: abc",
+                              b";\r\n", b"\r\n"])
+        self.assertEqual(found[:2], [[], []])
+        self.assertEqual(len(found[2]), 1)
+        self.assertEqual(found[2][0][1], 28)
+        self.assertEqual(found[3][0][1], 32)
+
+    def testRegexReportedOnce(self):
+        m = monjon.match.StreamMatcher([r"ab"])
+        found = self.scan(m, [b"xab", b"x", b"xabab"])
+        self.assertEqual([len(f) for f in found], [1, 0, 2])
+
+    def testInvalid(self):
+        self.assertRaises(TypeError, monjon.match.StreamMatcher, [42])
+        self.assertRaises(TypeError, monjon.match.StreamMatcher,
+                          [re.compile("text")])
+        self.assertRaises(ValueError, monjon.match.StreamMatcher, [b""])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,107 @@
+#! /usr/bin/env python
+
+import time
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.core
+import monjon.profiler
+
+
+def make_recv_event(source, payload):
+    e = monjon.core.ServerReceiveEvent(source)
+    e.set_packet(monjon.core.Packet(memoryview(payload), None))
+    e.set_action(lambda event: None)
+    return e
+
+
+class TestHistogram(unittest.TestCase):
+
+    def testPercentiles(self):
+        h = monjon.profiler.Histogram()
+        for us in range(1, 1001):
+            h.record(us / 1e6)
+
+        self.assertEqual(h.get_count(), 1000)
+        self.assertAlmostEqual(h.get_mean(), 500.5e-6)
+        self.assertAlmostEqual(h.get_max(), 1000e-6)
+
+        # Buckets are accurate to within 1/16th.
+        for percent in (50, 90, 99):
+            value = h.get_percentile(percent)
+            self.assertTrue(percent * 1e-5 <= value <= percent * 1.07e-5,
+                            (percent, value))
+        self.assertAlmostEqual(h.get_percentile(100), 1000e-6)
+
+    def testSmallValues(self):
+        h = monjon.profiler.Histogram()
+        for ns in range(16):
+            h.record(ns / 1e9)
+        self.assertAlmostEqual(h.get_percentile(50), 7e-9)
+
+    def testMerge(self):
+        a = monjon.profiler.Histogram()
+        b = monjon.profiler.Histogram()
+        a.record(1e-6)
+        b.record(1.0)
+        a.merge(b)
+        self.assertEqual(a.get_count(), 2)
+        self.assertAlmostEqual(a.get_max(), 1.0)
+        self.assertTrue(1e-6 <= a.get_percentile(50) < 1.07e-6)
+
+
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = monjon.core.Dispatcher()
+        self.source = monjon.core.EventSource()
+        return
+
+    def testHooks(self):
+        d = self.dispatcher
+        p = monjon.profiler.Profiler(d)
+        p.start()
+        d.set_breakpoint(None, "server_recv", "False")
+        for i in range(3):
+            d.dispatch(make_recv_event(self.source, b"x"))
+
+        report = p.get_report()
+        self.assertEqual(report["phases"]["match"]["count"], 3)
+        self.assertEqual(report["phases"]["action"]["count"], 3)
+        self.assertEqual(report["events"]["server_recv"]["count"], 3)
+        self.assertEqual(d.get_stats()["events"], 3)
+
+        # Once stopped, the hooks are gone entirely.
+        p.stop()
+        self.assertEqual(d._hooks, None)
+        d.dispatch(make_recv_event(self.source, b"x"))
+        self.assertEqual(p.get_report()["phases"]["match"]["count"], 3)
+
+    def testPoll(self):
+        d = self.dispatcher
+        p = monjon.profiler.Profiler(d)
+        p.start()
+        d.queue_event(make_recv_event(self.source, b"x"))
+        d.step()
+        p.stop()
+        self.assertEqual(p.get_report()["events"]["server_recv"]["count"],
+                         1)
+
+    def testSampling(self):
+        p = monjon.profiler.Profiler(self.dispatcher, 0.001)
+        p.start()
+        time.sleep(0.1)
+        p.stop()
+
+        samples = p.get_report()["samples"]
+        self.assertTrue(samples["total"] > 0)
+        self.assertEqual(samples["phases"], {"other": samples["total"]})
+        self.assertTrue(samples["functions"][0][0].startswith("testSampling"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -7,6 +7,112 @@ if not hasattr(unittest, "SkipTest"):
     except:
         raise ImportError("monjon unittests need unittest2 for python2.x")
 
+import errno, os, socket, time
+from unittest import mock
+import monjon.core
+import monjon.decode
+import monjon.proxy
+
+
+class BreakListener(monjon.core.Listener):
+
+    def __init__(self):
+        self.events = []
+        self.watches = []
+        return
+
+    def on_break(self, breakpoint, event):
+        event.retain()
+        self.events.append(event)
+        return
+
+    def on_watch(self, watchpoint, value, event):
+        self.watches.append((watchpoint, value, event.get_type()))
+        return
+
+
+class TCPProxyTestCase(unittest.TestCase):
+    """Runs a TCPListener in front of a local server socket.
+
+    The Dispatcher is pumped from the test, without threads: the
+    kernel completes connections to the listening sockets."""
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.listen(16)
+        self.server.settimeout(2)
+        self.dispatcher = self.create_dispatcher()
+        self.breaks = BreakListener()
+        self.dispatcher.set_listener(self.breaks)
+        self.listener = monjon.proxy.TCPListener(self.dispatcher, 0,
+                                                 "127.0.0.1",
+                                                 self.server.getsockname()[1])
+        self.dispatcher.register_source(self.listener)
+        self.sockets = [self.server]
+        return
+
+    def tearDown(self):
+        for sock in self.sockets:
+            sock.close()
+        for session in self.listener.get_sessions():
+            session._do_close()
+        self.listener.socket.close()
+        return
+
+    def create_dispatcher(self):
+        return monjon.core.Dispatcher()
+
+    def pump(self, until, timeout=2):
+        """Run the Dispatcher until 'until()' is true."""
+
+        d = self.dispatcher
+        deadline = time.time() + timeout
+        while not until():
+            if time.time() > deadline:
+                self.fail("timed out")
+            d._generate()
+            d._handle_ready(d._poller.poll(0.01))
+            while len(d._queue):
+                d.dispatch(d._queue.get())
+        return
+
+    def connect(self):
+        """Connect a client through the proxy.
+
+        Returns the client socket, the server's end and the session."""
+
+        n = len(self.listener.get_sessions())
+        client = socket.create_connection(("127.0.0.1",
+                                           self.listener.localPort))
+        self.sockets.append(client)
+        self.pump(lambda: len(self.listener.get_sessions()) > n)
+        session = self.listener.get_sessions()[-1]
+
+        upstream, address = self.server.accept()
+        self.sockets.append(upstream)
+        self.pump(lambda: session.get_state() == "connected")
+        return client, upstream, session
+
+    def receive(self, sock, n):
+        """Read 'n' bytes (or to EOF) from 'sock', pumping the Dispatcher."""
+
+        sock.setblocking(False)
+        data = bytearray()
+
+        def ready():
+            try:
+                chunk = sock.recv(n - len(data))
+            except BlockingIOError:
+                return False
+            if not chunk:
+                return True
+            data.extend(chunk)
+            return len(data) >= n
+
+        self.pump(ready)
+        return bytes(data)
+
 
 class TestProxy(unittest.TestCase):
 
@@ -14,5 +120,619 @@ class TestProxy(unittest.TestCase):
         pass
 
 
+class TestAccept(TCPProxyTestCase):
+
+    def open_clients(self, n):
+        for i in range(n):
+            self.sockets.append(socket.create_connection(
+                ("127.0.0.1", self.listener.localPort)))
+        time.sleep(0.05)
+        return
+
+    def testBatch(self):
+        self.listener.ACCEPT_BUDGET = 3
+        self.open_clients(5)
+
+        # One notification accepts up to the budget.
+        self.listener.on_readable(self.listener.socket)
+        self.assertEqual(len(self.listener.get_sessions()), 3)
+        self.listener.on_readable(self.listener.socket)
+        self.assertEqual(len(self.listener.get_sessions()), 5)
+        return
+
+    def testBatchEvents(self):
+        self.dispatcher.set_breakpoint(self.listener, "accept", "True")
+        self.open_clients(3)
+        self.listener.on_readable(self.listener.socket)
+        self.assertEqual(self.dispatcher.get_queue_depth(self.listener), 3)
+        self.assertEqual(self.listener.get_sessions(), [])
+
+        self.pump(lambda: len(self.listener.get_sessions()) == 3)
+        self.assertEqual(len(self.breaks.events), 3)
+        return
+
+    def testBacklog(self):
+        listener = monjon.proxy.TCPListener(self.dispatcher, 0, "127.0.0.1",
+                                            self.server.getsockname()[1],
+                                            backlog=1)
+        self.sockets.append(listener.socket)
+
+        # Connections beyond the backlog aren't completed by the kernel.
+        clients = []
+        for i in range(8):
+            c = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            c.setblocking(False)
+            c.connect_ex(("127.0.0.1", listener.localPort))
+            clients.append(c)
+        self.sockets.extend(clients)
+        time.sleep(0.1)
+        accepted = 0
+        while True:
+            try:
+                listener.socket.accept()[0].close()
+                accepted += 1
+            except BlockingIOError:
+                break
+        self.assertTrue(1 <= accepted < 8)
+        return
+
+    def testOutOfDescriptors(self):
+        self.listener.ACCEPT_RETRY = 0.05
+        self.open_clients(1)
+
+        # Stop polling the listener, rather than spinning.
+        error = OSError(errno.EMFILE, "Too many open files")
+        with mock.patch.object(socket.socket, "accept", side_effect=error):
+            self.listener.on_readable(self.listener.socket)
+        self.assertEqual(self.dispatcher._interest[self.listener.socket], 0)
+        self.assertEqual(self.listener.get_sessions(), [])
+
+        # Then resume, and accept it.
+        self.pump(lambda: self.listener.get_sessions())
+        self.assertEqual(self.dispatcher._interest[self.listener.socket],
+                         monjon.core.POLL_READ)
+        return
+
+
+class TestBackpressure(TCPProxyTestCase):
+
+    def testPauseResume(self):
+        client, upstream, session = self.connect()
+        interest = self.dispatcher._interest
+        read, write = monjon.core.POLL_READ, monjon.core.POLL_WRITE
+        self.assertEqual(interest[session._server], read)
+
+        # Send to a server that isn't reading until the proxy stops
+        # reading from the client.
+        client.setblocking(False)
+        chunk = b"x" * 65536
+        sent = [0]
+
+        def fill():
+            try:
+                sent[0] += client.send(chunk)
+            except BlockingIOError:
+                pass
+            return session._clientPaused
+
+        self.pump(fill)
+        self.assertTrue(len(session._toServer) >= session.HIGH_WATER)
+        self.assertEqual(interest[session._client] & read, 0)
+        self.assertEqual(interest[session._server], read | write)
+
+        # Reading stays paused until the buffer is below LOW_WATER.
+        upstream.setblocking(False)
+        received = [0]
+
+        def drain(paused=True):
+            try:
+                received[0] += len(upstream.recv(65536))
+            except BlockingIOError:
+                pass
+            if paused and len(session._toServer) > session.LOW_WATER:
+                self.assertTrue(session._clientPaused)
+            return not session._clientPaused
+
+        self.pump(drain)
+        self.assertTrue(len(session._toServer) <= session.LOW_WATER)
+        self.assertEqual(interest[session._client] & read, read)
+
+        # Once everything is sent, write interest is dropped.
+        self.pump(lambda: drain(False) is not None and
+                  received[0] == sent[0])
+        self.assertEqual(len(session._toServer), 0)
+        self.assertEqual(interest[session._server], read)
+        self.assertEqual(interest[session._client], read)
+        return
+
+
+class TestStats(TCPProxyTestCase):
+
+    def testCounters(self):
+        client, upstream, session = self.connect()
+        client.sendall(b"hello")
+        self.assertEqual(self.receive(upstream, 5), b"hello")
+        upstream.sendall(b"hi")
+        self.assertEqual(self.receive(client, 2), b"hi")
+
+        values = self.dispatcher.get_stats(session)
+        self.assertEqual(values["server_recv_bytes"], 5)
+        self.assertEqual(values["client_recv_bytes"], 2)
+        self.assertEqual(values["queued"], 0)
+
+        # The listener's figures include closed sessions.
+        client.close()
+        self.pump(lambda: session.get_state() == "closed")
+        values = self.dispatcher.get_stats(self.listener)
+        self.assertEqual(values["accepts"], 1)
+        self.assertEqual(values["closes"], 1)
+        self.assertEqual(values["server_recv_bytes"], 5)
+        self.assertEqual(values["sessions"], 0)
+
+        total = self.dispatcher.get_stats()
+        self.assertEqual(total["client_recv_bytes"], 2)
+        self.assertEqual(total["events"], 1)
+        return
+
+
+class TestMatch(TCPProxyTestCase):
+
+    def testAcrossPackets(self):
+        self.dispatcher.set_breakpoint(None, "server_recv", "True",
+                                       [b"DELETE /", r"X-Id: \d+\r\n"])
+        client, upstream, session = self.connect()
+
+        # Each part arrives as a separate packet.
+        for part in (b"GET / HTTP/1.1\r\nX-I", b"d: 12", b"3\r\nDEL",
+                     b"ETE / HTTP/1.1\r\n"):
+            client.sendall(part)
+            self.assertEqual(self.receive(upstream, len(part)), part)
+
+        events = self.breaks.events
+        self.assertEqual(len(events), 2)
+        self.assertEqual(bytes(events[0].get_packet().get_payload()),
+                         b"3\r\nDEL")
+        self.assertEqual(bytes(events[1].get_packet().get_payload()),
+                         b"ETE / HTTP/1.1\r\n")
+        return
+
+
+class TestStreams(TCPProxyTestCase):
+
+    def testStreams(self):
+        self.listener.set_streams(True)
+        self.dispatcher.set_breakpoint(None, "client_recv", "offset >= 5")
+        client, upstream, session = self.connect()
+
+        for part in (b"GET / HTTP/1.1\r\n", b"Host: x\r\n\r\n"):
+            client.sendall(part)
+            self.assertEqual(self.receive(upstream, len(part)), part)
+        for part in (b"HTTP/", b"1.1 200 OK\r\n"):
+            upstream.sendall(part)
+            self.assertEqual(self.receive(client, len(part)), part)
+
+        stream = session.server_stream
+        self.assertEqual(len(stream), 27)
+        self.assertEqual(bytes(stream[16:20]), b"Host")
+        self.assertEqual(stream.find(b"\r\n\r\n"), 23)
+        self.assertEqual(bytes(session.client_stream[:]),
+                         b"HTTP/1.1 200 OK\r\n")
+
+        # Conditions see stream offsets.
+        self.assertEqual(len(self.breaks.events), 1)
+        self.assertEqual(self.breaks.events[0].get_packet().get_offset(), 5)
+
+        session.set_streams(False)
+        self.assertEqual(session.client_stream, None)
+        return
+
+
+class TestDecoder(TCPProxyTestCase):
+
+    def testHttp(self):
+        self.listener.set_decoder(monjon.decode.HttpDecoder())
+        self.dispatcher.set_breakpoint(None, "http_request",
+                                       "message.get_method() == 'POST'")
+        client, upstream, session = self.connect()
+
+        request = (b"GET / HTTP/1.1\r\n\r\n"
+                   b"POST /x HTTP/1.1\r\nContent-Length: 2\r\n\r\nhi")
+        for part in (request[:25], request[25:]):
+            client.sendall(part)
+            self.assertEqual(self.receive(upstream, len(part)), part)
+
+        events = self.breaks.events
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].get_type(), "http_request")
+        self.assertEqual(events[0].get_message().get_target(), "/x")
+        self.assertEqual(events[0].get_packet().get_offset(), 18)
+
+        # Framed data is released from the stream.
+        self.assertEqual(session.server_stream.get_consumed(), len(request))
+        return
+
+
+class TestWatchpoint(TCPProxyTestCase):
+
+    def testSessions(self):
+        d = self.dispatcher
+        wp = d.set_watchpoint(self.listener, "sessions")
+        self.assertEqual(wp.get_value(), 0)
+        self.assertEqual(wp.get_events(), {"accept", "close"})
+
+        client, upstream, session = self.connect()
+        self.assertEqual(self.breaks.watches, [(wp, 1, "accept")])
+
+        # Data isn't watched, so it still takes the fast path.
+        self.assertFalse(d.wants_event(session, "server_recv"))
+        client.sendall(b"hello")
+        self.assertEqual(self.receive(upstream, 5), b"hello")
+        self.assertEqual(len(self.breaks.watches), 1)
+
+        client.close()
+        self.pump(lambda: session.get_state() == "closed")
+        self.assertEqual(self.breaks.watches[-1], (wp, 0, "close"))
+
+        wp.clear()
+        self.assertFalse(d.wants_event(self.listener, "accept"))
+        self.assertEqual(d.get_watchpoints(), {})
+        return
+
+    def testPayload(self):
+        client, upstream, session = self.connect()
+        wp = self.dispatcher.set_watchpoint(session, "payload[:3]")
+        self.assertEqual(wp.get_value().__class__, TypeError)
+
+        for data in (b"GET /", b"GET /x", b"PUT /"):
+            client.sendall(data)
+            self.assertEqual(self.receive(upstream, len(data)), data)
+
+        values = [value for w, value, eventType in self.breaks.watches]
+        self.assertEqual(values, [b"GET", b"PUT"])
+        return
+
+
+class TestConnect(TCPProxyTestCase):
+
+    def refused(self):
+        """Point the listener at a closed port."""
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        self.listener.remotePort = sock.getsockname()[1]
+        sock.close()
+
+        client = socket.create_connection(("127.0.0.1",
+                                           self.listener.localPort))
+        self.sockets.append(client)
+        self.pump(lambda: self.listener.get_sessions())
+        return client, self.listener.get_sessions()[0]
+
+    def testConnectFailed(self):
+        self.dispatcher.set_breakpoint(None, "connect_failed", "True")
+        client, session = self.refused()
+        self.pump(lambda: self.breaks.events)
+
+        event = self.breaks.events[0]
+        self.assertEqual(event.get_type(), "connect_failed")
+        self.assertIsInstance(event.get_error(), ConnectionRefusedError)
+        self.assertEqual(session.get_state(), "closed")
+        return
+
+    def testConnectFailedClosesClient(self):
+        client, session = self.refused()
+        self.assertEqual(self.receive(client, 1), b"")
+        self.assertEqual(session.get_state(), "closed")
+        self.assertEqual(self.breaks.events, [])
+        return
+
+    def testSendWhileConnecting(self):
+        client = socket.create_connection(("127.0.0.1",
+                                           self.listener.localPort))
+        self.sockets.append(client)
+        client.sendall(b"early")
+
+        # Accept, but don't let the session see that it's connected.
+        self.listener.on_readable(self.listener.socket)
+        session = self.listener.get_sessions()[0]
+        self.assertEqual(session.get_state(), "connecting")
+        time.sleep(0.05)
+        session.on_readable(session._client)
+        self.assertEqual(bytes(session._toServer), b"early")
+
+        upstream, address = self.server.accept()
+        self.sockets.append(upstream)
+        self.assertEqual(self.receive(upstream, 5), b"early")
+        self.assertEqual(session.get_state(), "connected")
+        return
+
+
+@unittest.skipUnless(monjon.proxy.RELAY_SUPPORTED, "needs splice()")
+class TestRelay(TCPProxyTestCase):
+
+    def testRelay(self):
+        self.listener.set_relay(True)
+        client, upstream, session = self.connect()
+        self.assertTrue(session.get_relay())
+
+        # Nothing can break on this, so it's spliced, not received.
+        calls = []
+        relay = session._relay_from
+        session._relay_from = lambda s, d: (calls.append(s), relay(s, d))
+        client.sendall(b"hello")
+        self.assertEqual(self.receive(upstream, 5), b"hello")
+        upstream.sendall(b"world")
+        self.assertEqual(self.receive(client, 5), b"world")
+        self.assertEqual(len(calls), 2)
+
+        # Once a breakpoint applies, data is queued as events again.
+        self.dispatcher.set_breakpoint(None, "server_recv", "True")
+        client.sendall(b"again")
+        self.assertEqual(self.receive(upstream, 5), b"again")
+        self.assertEqual(len(calls), 2)
+        self.assertEqual([bytes(e.get_packet().get_payload())
+                          for e in self.breaks.events], [b"again"])
+        return
+
+    def testPipeBeforeBuffer(self):
+        self.listener.set_relay(True)
+        client, upstream, session = self.connect()
+
+        # Relayed data still in the pipe was received first, so it's
+        # sent before later buffered data.
+        pipe = session._pipes[session._server]
+        os.write(pipe[1], b"first ")
+        pipe[2] += 6
+        session._send_to_server(b"second")
+        self.assertEqual(self.receive(upstream, 12), b"first second")
+        return
+
+    def testUnsupported(self):
+        supported = monjon.proxy.RELAY_SUPPORTED
+        monjon.proxy.RELAY_SUPPORTED = False
+        try:
+            self.assertRaises(OSError, self.listener.set_relay, True)
+        finally:
+            monjon.proxy.RELAY_SUPPORTED = supported
+        self.assertFalse(self.listener.get_relay())
+        return
+
+
+class TestShaping(TCPProxyTestCase):
+
+    def testDelay(self):
+        self.listener.set_shaping(monjon.proxy.Shaping(delay=0.05),
+                                  "server")
+        client, upstream, session = self.connect()
+        self.assertEqual(session.get_shaping("client"), None)
+
+        # Data is held back, but still arrives in order.
+        start = time.time()
+        client.sendall(b"first ")
+        self.pump(lambda: session._held["server"] == 6)
+        client.sendall(b"second")
+        self.assertEqual(self.receive(upstream, 12), b"first second")
+        self.assertTrue(time.time() - start >= 0.05)
+        self.assertEqual(session._held["server"], 0)
+
+        # The other direction isn't shaped.
+        upstream.sendall(b"reply")
+        self.assertEqual(self.receive(client, 5), b"reply")
+        return
+
+    def testRate(self):
+        client, upstream, session = self.connect()
+        session.set_shaping(monjon.proxy.Shaping(rate=100000))
+
+        start = time.time()
+        data = b"x" * 10000
+        client.sendall(data)
+        self.assertEqual(self.receive(upstream, len(data)), data)
+        self.assertTrue(time.time() - start >= 0.09)
+
+        session.set_shaping(None)
+        self.assertEqual(session.get_shaping("server"), None)
+        return
+
+
+class TestAsyncioDispatcher(TCPProxyTestCase):
+    """Runs sessions to completion under AsyncioDispatcher.run()."""
+
+    def create_dispatcher(self):
+        return monjon.core.AsyncioDispatcher()
+
+    def tearDown(self):
+        super().tearDown()
+        self.dispatcher.close()
+        return
+
+    def pump(self, until, timeout=2):
+        """Run the Dispatcher until 'until()' is true, checking from a
+        timer on the event loop."""
+
+        d = self.dispatcher
+        deadline = time.time() + timeout
+
+        def check():
+            if until() or time.time() > deadline:
+                d.stop()
+            else:
+                d.call_later(0.001, check)
+            return
+
+        if not until():
+            d.call_later(0, check)
+            d.run()
+            if time.time() > deadline:
+                self.fail("timed out")
+        return
+
+    def testSession(self):
+        client, upstream, session = self.connect()
+        client.sendall(b"hello")
+        self.assertEqual(self.receive(upstream, 5), b"hello")
+        upstream.sendall(b"world")
+        self.assertEqual(self.receive(client, 5), b"world")
+
+        client.close()
+        self.pump(lambda: session.get_state() == "closed")
+        self.assertEqual(self.receive(upstream, 1), b"")
+        return
+
+    def testStep(self):
+        client, upstream, session = self.connect()
+        self.dispatcher.set_breakpoint(session, "server_recv", "True")
+        client.sendall(b"hello")
+
+        # step() waits on the loop for the event, and forwards it.
+        self.assertTrue(self.dispatcher.step())
+        self.assertEqual(len(self.breaks.events), 1)
+        self.assertEqual(self.receive(upstream, 5), b"hello")
+        return
+
+    def testTimers(self):
+        d = self.dispatcher
+        calls = []
+        d.call_later(0.02, calls.append, 2)
+        d.call_later(0.01, calls.append, 1).cancel()
+        d.call_later(0.03, d.stop)
+
+        # stop() from a timer returns from run(), with nothing queued.
+        start = time.time()
+        d.run()
+        self.assertEqual(calls, [2])
+        self.assertTrue(0.03 <= time.time() - start < 1)
+        return
+
+
+class TestUDPListener(unittest.TestCase):
+
+    def setUp(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.server.bind(("127.0.0.1", 0))
+        self.server.settimeout(2)
+        self.dispatcher = monjon.core.Dispatcher()
+        self.listener = monjon.proxy.UDPListener(self.dispatcher, 0,
+                                                 "127.0.0.1",
+                                                 self.server.getsockname()[1],
+                                                 idleTimeout=0.5)
+        self.dispatcher.register_source(self.listener)
+        return
+
+    def tearDown(self):
+        self.server.close()
+        return
+
+    def poll(self):
+        # Bound the wait: with no sessions, generate() has no deadline.
+        d = self.dispatcher
+        timeout = d._generate()
+        if timeout is None or timeout > 0.01:
+            timeout = 0.01
+        d._handle_ready(d._poller.poll(timeout))
+        return
+
+    def testFlows(self):
+        clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                   for i in range(2)]
+        for i, c in enumerate(clients):
+            c.settimeout(2)
+            c.sendto(b"ping %u" % i, ("127.0.0.1", self.listener.localPort))
+
+        # One session, with its own outbound address, per client.
+        addresses = set()
+        while len(addresses) < 2:
+            self.poll()
+            try:
+                self.server.settimeout(0.01)
+                data, address = self.server.recvfrom(100)
+            except socket.timeout:
+                continue
+            addresses.add(address)
+            self.server.sendto(data.replace(b"ping", b"pong"), address)
+        self.assertEqual(len(self.listener.get_sessions()), 2)
+
+        # Replies go back to the right client.
+        for i, c in enumerate(clients):
+            c.setblocking(False)
+            deadline = time.time() + 2
+            data = None
+            while data is None and time.time() < deadline:
+                try:
+                    data = c.recv(100)
+                except BlockingIOError:
+                    self.poll()
+            self.assertEqual(data, b"pong %u" % i)
+
+        # Idle sessions are evicted.
+        deadline = time.time() + 2
+        while self.listener.get_sessions() and time.time() < deadline:
+            self.poll()
+        self.assertEqual(self.listener.get_sessions(), [])
+        self.assertEqual(list(self.dispatcher.get_sources().values()),
+                         [self.listener])
+
+        for c in clients:
+            c.close()
+        return
+
+    def testEvictionOrder(self):
+        self.listener.set_idle_timeout(0.3)
+        clients = [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                   for i in range(2)]
+        port = self.listener.localPort
+
+        # Flows interleave: the first is active again after the second
+        # starts, so is newer in the table.
+        for i in (0, 1):
+            clients[i].sendto(b"ping %u" % i, ("127.0.0.1", port))
+            while len(self.listener.get_sessions()) <= i:
+                self.poll()
+        a, b = self.listener.get_sessions()
+        time.sleep(0.1)
+        clients[0].sendto(b"again", ("127.0.0.1", port))
+        while a._lastActive < b._lastActive:
+            self.poll()
+        self.assertEqual(self.listener.get_sessions(), [b, a])
+
+        # The idle flow is evicted first, on time.
+        deadline = time.time() + 2
+        while b in self.listener.get_sessions() and time.time() < deadline:
+            self.poll()
+        self.assertTrue(time.time() - b._lastActive < 0.35)
+        self.assertEqual(self.listener.get_sessions(), [a])
+
+        deadline = time.time() + 2
+        while self.listener.get_sessions() and time.time() < deadline:
+            self.poll()
+        self.assertEqual(self.listener.get_sessions(), [])
+
+        for c in clients:
+            c.close()
+        return
+
+    def testServerTraffic(self):
+        # A flow where only the server sends stays alive.
+        self.listener.set_idle_timeout(0.2)
+        c = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        c.sendto(b"subscribe", ("127.0.0.1", self.listener.localPort))
+        address = None
+        while address is None:
+            self.poll()
+            try:
+                self.server.settimeout(0.01)
+                data, address = self.server.recvfrom(100)
+            except socket.timeout:
+                pass
+
+        end = time.time() + 0.8
+        while time.time() < end:
+            self.server.sendto(b"tick", address)
+            self.poll()
+        self.assertEqual(len(self.listener.get_sessions()), 1)
+        c.close()
+        return
+
+
 if __name__ == "__main__":
     unittest.main()
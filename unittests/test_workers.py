@@ -0,0 +1,121 @@
+#! /usr/bin/env python
+
+import json, socket
+import unittest
+if not hasattr(unittest, "SkipTest"):
+    try:
+        import unittest2 as unittest
+    except:
+        raise ImportError("monjon unittests need unittest2 for python2.x")
+
+import monjon.core
+import monjon.workers
+
+
+class TestChannel(unittest.TestCase):
+
+    def testMessages(self):
+        dispatcher = monjon.core.Dispatcher()
+        received = []
+        a, b = socket.socketpair()
+        channel = monjon.workers.Channel(dispatcher, a,
+                                         lambda c, m: received.append(m))
+
+        # Split one message across two writes.
+        b.sendall(b'{"cmd": "listen", "localPort": 0}\n{"cmd"')
+        b.sendall(b': "stop"}\n')
+        while len(received) < 2:
+            dispatcher._handle_ready(dispatcher._poller.poll(1))
+        self.assertEqual(received, [{"cmd": "listen", "localPort": 0},
+                                    {"cmd": "stop"}])
+
+        b.close()
+        while len(received) < 3:
+            dispatcher._handle_ready(dispatcher._poller.poll(1))
+        self.assertEqual(received[2], None)
+        self.assertEqual(dispatcher.get_sources(), {})
+        return
+
+
+class TestWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.dispatcher = monjon.core.Dispatcher()
+        self.a, self.b = socket.socketpair()
+        self.worker = monjon.workers.Worker(self.dispatcher, 0, self.a)
+        self.b.settimeout(2)
+        self.messages = []
+        return
+
+    def tearDown(self):
+        self.b.close()
+        return
+
+    def command(self, message):
+        self.b.sendall(json.dumps(message).encode() + b"\n")
+        d = self.dispatcher
+        d._handle_ready(d._poller.poll(1))
+        return
+
+    def receive(self, messageType):
+        """Return the next message of 'messageType' from the worker."""
+
+        buf = b""
+        while True:
+            while b"\n" not in buf:
+                buf += self.b.recv(4096)
+            line, buf = buf.split(b"\n", 1)
+            message = json.loads(line.decode())
+            if message["type"] == messageType:
+                return message
+
+    def testListenError(self):
+        # A port that's in use (without SO_REUSEPORT) is reported, and
+        # doesn't stop the worker.
+        busy = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        busy.bind(("0.0.0.0", 0))
+        busy.listen(1)
+        port = busy.getsockname()[1]
+        try:
+            self.command({"cmd": "listen", "localPort": port,
+                          "remoteHost": "localhost", "remotePort": 1,
+                          "backlog": 1})
+            message = self.receive("error")
+            self.assertIn("listen on port %u" % port, message["message"])
+
+            # Breakpoints on it are ignored, and keep their identifiers.
+            self.command({"cmd": "breakpoint", "id": 0, "listener": 0,
+                          "event": "accept", "condition": "True"})
+            self.command({"cmd": "breakpoint", "id": 1, "listener": None,
+                          "event": "accept", "condition": "True"})
+            self.assertEqual(list(self.worker._breakpoints.keys()), [1])
+        finally:
+            busy.close()
+
+        self.dispatcher._generate()
+        self.assertEqual(self.receive("stats")["listeners"], 0)
+        return
+
+
+class TestController(unittest.TestCase):
+
+    def testStats(self):
+        controller = monjon.workers.Controller(monjon.core.Dispatcher(), 2)
+        try:
+            controller.listen(0, "localhost", 1)
+            for worker in range(2):
+                controller._on_message(None, {"type": "stats",
+                                              "worker": worker,
+                                              "listeners": 1,
+                                              "sessions": 3})
+            stats = controller.get_stats()
+            self.assertEqual(stats["workers"], 2)
+            self.assertEqual(stats["listeners"], 1)
+            self.assertEqual(stats["sessions"], 6)
+        finally:
+            controller.stop()
+        return
+
+
+if __name__ == "__main__":
+    unittest.main()